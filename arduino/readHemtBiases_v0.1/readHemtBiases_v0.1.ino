@@ -1,3 +1,5 @@
+#include <util/crc16.h>
+
 const byte numChars = 64;
 char receivedChars[numChars];
 
@@ -5,6 +7,26 @@ boolean newData = false;
 
 byte ledPin = 13;   // the onboard LED
 
+/* Binary frame, sent in reply to <raw>:
+ * 0xA5 | seq | n | n x uint16 raw ADC counts, little endian, pins A1-A15 in order | CRC16, little endian
+ * seq goes up by one per frame (wrapping at 255) so the host can tell when frames were lost. The CRC is
+ * CRC-16/CCITT-FALSE (_crc_xmodem_update from 0xFFFF) over everything after the start byte.
+ * 35 bytes for all 15 pins, against ~110 bytes for the ASCII reply to <all>.
+ *
+ * <stream ms> makes the board push a frame every ms milliseconds on its own, until <stream 0>. Streamed frames
+ * have the top bit of n set and carry the millis() time of the reading as a uint32 (little endian) between n and
+ * the counts, 39 bytes in all. If the previous frame is still waiting in the serial transmit buffer when the next
+ * one is due, the new frame is dropped rather than stalling the loop (and with it command handling). Its sequence
+ * number is used up, so the host sees the gap.
+ */
+const byte frameStart = 0xA5;
+const byte timestampFlag = 0x80;
+const byte numBiasPins = 15;
+const byte biasPins[numBiasPins] = {A1, A2, A3, A4, A5, A6, A7, A8, A9, A10, A11, A12, A13, A14, A15};
+byte frameSeq = 0;
+unsigned long streamInterval = 0;   // ms between streamed frames, 0 when not streaming
+unsigned long nextStream = 0;
+
 //===============
 
 /* HEMT-to-Analog Pin map
@@ -81,7 +103,65 @@ void recvWithStartEndMarkers() {
 
 //====================================
 
+void sendBinaryFrame(boolean timestamped) {
+    byte frame[7 + 2 * numBiasPins + 2];
+    byte len = 0;
+    uint16_t crc = 0xFFFF;
+    unsigned long now = millis();
+    unsigned int counts;
+    byte i;
+
+    frame[len++] = frameStart;
+    frame[len++] = frameSeq++;
+    frame[len++] = timestamped ? (numBiasPins | timestampFlag) : numBiasPins;
+    if (timestamped) {
+        for (i = 0; i < 4; i++) {
+            frame[len++] = (now >> (8 * i)) & 0xFF;
+        }
+    }
+    for (i = 0; i < numBiasPins; i++) {
+        counts = analogRead(biasPins[i]);
+        frame[len++] = counts & 0xFF;
+        frame[len++] = counts >> 8;
+        delay(1);
+    }
+    for (i = 1; i < len; i++) {
+        crc = _crc_xmodem_update(crc, frame[i]);
+    }
+    frame[len++] = crc & 0xFF;
+    frame[len++] = crc >> 8;
+    if (timestamped && Serial.availableForWrite() < len) {
+        return;
+    }
+    Serial.write(frame, len);
+}
+
+void streamFrames() {
+    if (streamInterval == 0 || (long)(millis() - nextStream) < 0) {
+        return;
+    }
+    nextStream += streamInterval;
+    if ((long)(millis() - nextStream) >= 0) {
+        // Fell more than a period behind. Carry on from now rather than sending a burst
+        nextStream = millis() + streamInterval;
+    }
+    sendBinaryFrame(true);
+}
+
+//====================================
+
 void replyToPython() {
+    if (newData == true && String(receivedChars)=="raw") {
+        sendBinaryFrame(false);
+        digitalWrite(ledPin, ! digitalRead(ledPin));
+        newData = false;
+    }
+    if (newData == true && strncmp(receivedChars, "stream", 6) == 0) {
+        streamInterval = strtoul(receivedChars + 6, NULL, 10);
+        nextStream = millis();
+        digitalWrite(ledPin, ! digitalRead(ledPin));
+        newData = false;
+    }
     if (newData == true) {
         unsigned int i;
         unsigned int sensorValue[16];
@@ -231,4 +311,5 @@ void replyToPython() {
 void loop() {
     recvWithStartEndMarkers();
     replyToPython();
+    streamFrames();
 }
@@ -0,0 +1,205 @@
+"""
+Decoders for the framed messages the PICTURE-C Arduinos (HEMT bias, one-wire thermometry, magnet) send back to the
+host. Bytes are fed in as whole chunks, frames are located with bytes.find, and any partial frame is held on to
+until the rest of it arrives on a later read.
+
+FrameDecoder handles the ASCII '<...>' replies. BinaryFrameDecoder handles the compact binary frames the HEMT bias
+sketch sends in reply to '<raw>':
+
+    0xA5 | seq | n | n x uint16 little-endian ADC counts | CRC16 little-endian
+
+seq counts frames modulo 256 so lost frames can be detected. Frames the board streams on its own ('<stream ms>')
+have the top bit of n set and a uint32 little-endian millis() timestamp between n and the counts. The CRC is
+CRC-16/CCITT-FALSE over everything after the start byte, which is what binascii.crc_hqx(data, 0xFFFF) computes.
+"""
+
+import binascii
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+import metrics
+
+START_MARKER = b'<'
+END_MARKER = b'>'
+BINARY_START = 0xA5
+BINARY_OVERHEAD = 5
+TIMESTAMP_FLAG = 0x80
+TIMESTAMP_SIZE = 4
+COUNTS_DTYPE = np.dtype('<u2')
+
+# millis is the board's millis() at the reading for streamed frames, None for frames sent in reply to '<raw>'
+BinaryFrame = namedtuple('BinaryFrame', ['seq', 'counts', 'missed', 'millis'])
+
+log = logging.getLogger(__name__)
+
+DISCARDED = metrics.REGISTRY.counter('arduino_bytes_discarded_total', "Bytes of unterminated frame data thrown away")
+CRC_ERRORS = metrics.REGISTRY.counter('arduino_crc_errors_total', "Binary frames that failed their CRC check")
+MISSED = metrics.REGISTRY.counter('arduino_frames_missed_total', "Binary frames lost, from gaps in the sequence numbers")
+
+
+class FrameDecoder(object):
+    def __init__(self, start=START_MARKER, end=END_MARKER, maxFrameLength=1024):
+        """
+        :param start: Single byte that opens a frame
+        :param end: Single byte that closes a frame
+        :param maxFrameLength: A frame that grows past this many bytes without an end marker is assumed to be garbage
+        (e.g. a lost end marker) and is discarded
+        """
+        self.start = start
+        self.end = end
+        self.maxFrameLength = maxFrameLength
+        self._buffer = bytearray()
+
+    def __len__(self):
+        """
+        :return: Number of buffered bytes that have not yet been returned as part of a frame
+        """
+        return len(self._buffer)
+
+    def reset(self):
+        """
+        Drop any partially received frame. Used after resetting the Arduino or clearing the serial buffers
+        :return: None
+        """
+        self._buffer.clear()
+
+    def feed(self, data):
+        """
+        Add newly read bytes to the buffer and pull out every complete frame.
+        :param data: bytes (or bytearray) read from the serial port
+        :return: List of frame payloads (bytes, markers stripped) in the order they were received
+        """
+        buf = self._buffer
+        buf += data
+        frames = []
+        pos = 0
+
+        while True:
+            startIdx = buf.find(self.start, pos)
+            if startIdx < 0:
+                # Nothing that could ever become a frame, nothing worth keeping
+                pos = len(buf)
+                break
+            endIdx = buf.find(self.end, startIdx + 1)
+            if endIdx < 0:
+                pos = startIdx
+                break
+            # If a frame was cut short (e.g. by an Arduino reset) the last start marker before the end is the real one
+            startIdx = buf.rfind(self.start, startIdx, endIdx)
+            frames.append(bytes(buf[startIdx + 1:endIdx]))
+            pos = endIdx + 1
+
+        del buf[:pos]
+        if len(buf) > self.maxFrameLength:
+            log.warning(f"Discarding {len(buf)} bytes of unterminated frame data")
+            DISCARDED.inc(len(buf))
+            buf.clear()
+
+        return frames
+
+    def read_from(self, port):
+        """
+        Drain everything waiting on a serial port in a single read and decode it.
+        :param port: serial.Serial (or anything with in_waiting and read(n))
+        :return: List of complete frame payloads, possibly empty
+        """
+        waiting = port.in_waiting
+        if not waiting:
+            return []
+        return self.feed(port.read(waiting))
+
+
+class BinaryFrameDecoder(object):
+    def __init__(self, maxChannels=16):
+        """
+        :param maxChannels: Largest channel count a frame can claim. A start byte followed by a larger count is not
+        a frame start
+        """
+        self.maxChannels = maxChannels
+        self.lastSeq = None
+        self.missed = 0
+        self.crcErrors = 0
+        self._buffer = bytearray()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def reset(self):
+        """
+        Drop any partial frame and forget the sequence number, e.g. after resetting the Arduino (which restarts it
+        at 0)
+        :return: None
+        """
+        self._buffer.clear()
+        self.lastSeq = None
+
+    def _sequence(self, seq):
+        missed = 0 if self.lastSeq is None else (seq - self.lastSeq - 1) & 0xFF
+        self.lastSeq = seq
+        if missed:
+            log.warning(f"{missed} binary frame(s) lost before frame {seq}")
+            self.missed += missed
+            MISSED.inc(missed)
+        return missed
+
+    def feed(self, data):
+        """
+        Add newly read bytes to the buffer and pull out every complete frame that passes its CRC check. After a bad
+        CRC the decoder steps one byte past the false start and looks for the next start byte.
+        :param data: bytes (or bytearray) read from the serial port
+        :return: List of BinaryFrames (seq, uint16 counts array, frames missed just before this one, board millis)
+        """
+        buf = self._buffer
+        buf += data
+        frames = []
+        pos = 0
+        skipped = 0
+
+        while True:
+            startIdx = buf.find(BINARY_START, pos)
+            if startIdx < 0:
+                skipped += len(buf) - pos
+                pos = len(buf)
+                break
+            skipped += startIdx - pos
+            pos = startIdx
+            if len(buf) - startIdx < 3:
+                break
+            n = buf[startIdx + 2] & ~TIMESTAMP_FLAG
+            stamped = buf[startIdx + 2] & TIMESTAMP_FLAG
+            header = 2 + (TIMESTAMP_SIZE if stamped else 0)
+            end = startIdx + 2 * n + BINARY_OVERHEAD + (TIMESTAMP_SIZE if stamped else 0)
+            if n > self.maxChannels:
+                skipped += 1
+                pos += 1
+                continue
+            if len(buf) < end:
+                break
+            body = bytes(buf[startIdx + 1:end - 2])
+            if binascii.crc_hqx(body, 0xFFFF) != int.from_bytes(buf[end - 2:end], 'little'):
+                self.crcErrors += 1
+                CRC_ERRORS.inc()
+                skipped += 1
+                pos += 1
+                continue
+            counts = np.frombuffer(body, dtype=COUNTS_DTYPE, count=n, offset=header)
+            millis = int.from_bytes(body[2:header], 'little') if stamped else None
+            frames.append(BinaryFrame(body[0], counts, self._sequence(body[0]), millis))
+            pos = end
+
+        del buf[:pos]
+        if skipped:
+            DISCARDED.inc(skipped)
+        return frames
+
+    def read_from(self, port):
+        """
+        Drain everything waiting on a serial port in a single read and decode it.
+        :return: List of BinaryFrames, possibly empty
+        """
+        waiting = port.in_waiting
+        if not waiting:
+            return []
+        return self.feed(port.read(waiting))
@@ -0,0 +1,301 @@
+"""
+End-to-end benchmark of the acquisition path: simulated serial device -> agent -> BufferedStreamWriter -> Redis.
+Each agent is polled against a device from the simulator package, run in a separate process so that its CPU time is
+not charged to the agent. A reader thread follows the agent's stream with blocking XREADs and timestamps every entry
+as it becomes visible, which gives the end-to-end latency from the request going out to the reading being in Redis.
+Readings are paired with their requests by stream entry ID: the writer notes the send time of the poll that queued
+each entry. A poll that queues nothing (e.g. a timed-out reply) or more than one entry therefore does not shift the
+pairing for the polls after it.
+
+For each agent it reports:
+    samples/s       readings that reached Redis per second
+    latency p50/p99 request sent -> entry readable from Redis, in ms
+    CPU/sample      process CPU time (agent, writer and reader threads) per reading, in us
+    RSS growth      resident memory at the end of the run minus at the start, in kB
+
+Needs a Redis server. Streams are written to a scratch database (--db, default 15), which is emptied first.
+
+Run from the picturec directory, e.g.:
+    python benchmarks/acquisitionBench.py hemttemp sim921 --seconds 60 --save baseline.json
+    python benchmarks/acquisitionBench.py hemttemp sim921 --seconds 60 --compare baseline.json
+--compare exits with status 1 if any agent got more than --tolerance worse than the baseline.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+PICTUREC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PICTUREC_DIR)
+sys.path.insert(0, os.path.join(PICTUREC_DIR, 'original_scripts', 'instruments'))
+import walrus
+from redisWriter import BufferedStreamWriter
+
+# Metrics where a higher value is better. For all the others, lower is better
+HIGHER_IS_BETTER = {'samplesPerSecond'}
+COMPARED = ('samplesPerSecond', 'latencyP50', 'latencyP99', 'cpuPerSample')
+
+
+class Simulator(object):
+    def __init__(self, device, latency=0.0, noBaud=False):
+        """
+        Run one simulated device with 'python -m simulator' and find out which pty it is on.
+        """
+        args = [sys.executable, '-m', 'simulator', device, '--latency', str(latency)]
+        if noBaud:
+            args.append('--no-baud')
+        self.process = subprocess.Popen(args, cwd=PICTUREC_DIR, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"Simulator for {device} did not start")
+        self.port = line.split(':', 1)[1].strip()
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _instrument(cls, port):
+    """
+    Instance of an instrument class that connects to port instead of looking its VID/PID up.
+    """
+    return type(cls.__name__, (cls,), {'_find_port': lambda self: port})()
+
+
+def hemttemp_agent(port, redis, writer, binary=False):
+    from hemttempAgent import Hemtduino, STREAM_KEYS
+    hemtduino = Hemtduino(port=port, baudrate=9600, timeout=1, redis=redis, writer=writer, binary=binary)
+    hemtduino.arduino_ping()
+    # Throw away the reply to the ping so the first poll gets its own reply
+    time.sleep(0.5)
+    hemtduino.reset_input_buffer()
+    hemtduino.decoder.reset()
+    hemtduino.binaryDecoder.reset()
+    hemtduino._frames.clear()
+    return hemtduino.poll, STREAM_KEYS['hemt.biases'], hemtduino.close
+
+
+def sim921_agent(port, redis, writer):
+    from SIM921 import SIM921
+    sim921 = _instrument(SIM921, port)
+    sim921.connect()
+
+    def poll():
+        writer.add('sim921.temperature', {'temperature': float(sim921.query("TVAL?"))})
+
+    return poll, 'sim921.temperature', sim921.disconnect
+
+
+def sim960_agent(port, redis, writer):
+    from SIM960 import SIM960
+    sim960 = _instrument(SIM960, port)
+    sim960.connect()
+
+    def poll():
+        writer.add('sim960.output', {'omon': float(sim960.query("OMON?"))})
+
+    return poll, 'sim960.output', sim960.disconnect
+
+
+def ls240_agent(port, redis, writer):
+    from LS240 import LS240
+    ls240 = _instrument(LS240, port)
+    ls240.connect()
+
+    def poll():
+        reading = ls240.read_temperatures()
+        writer.add('ls240.temperatures', {name: float(reading[name]) for name in reading.dtype.names[1:]},
+                   timestamp=float(reading['time']))
+
+    return poll, 'ls240.temperatures', ls240.disconnect
+
+
+# Agent name: (simulator device, setup function)
+AGENTS = {'hemttemp': ('hemtduino', hemttemp_agent),
+          'hemttemp-binary': ('hemtduino', lambda port, redis, writer: hemttemp_agent(port, redis, writer, True)),
+          'sim921': ('sim921', sim921_agent),
+          'sim960': ('sim960', sim960_agent),
+          'ls240': ('ls240', ls240_agent)}
+
+
+class TaggingWriter(BufferedStreamWriter):
+    def __init__(self, redis, key=None, **kwargs):
+        """
+        BufferedStreamWriter that records, for each entry it queues for key, the send time of the poll that produced
+        it. Set pollSent to time.time() just before each poll, or to None to stop recording.
+        """
+        super(TaggingWriter, self).__init__(redis, **kwargs)
+        self.key = key
+        self.pollSent = None
+        self.sent = {}
+
+    def _next_id(self, key, timestamp):
+        entryId = super(TaggingWriter, self)._next_id(key, timestamp)
+        if key == self.key and self.pollSent is not None:
+            self.sent[entryId] = self.pollSent
+        return entryId
+
+
+class StreamFollower(threading.Thread):
+    def __init__(self, redis, key):
+        """
+        Records the wall-clock time at which each new entry of a stream becomes readable, by entry ID.
+        """
+        super(StreamFollower, self).__init__(daemon=True)
+        self.redis = redis
+        self.key = key
+        self.arrivals = {}
+        self._done = threading.Event()
+
+    def run(self):
+        lastId = '0-0'
+        while not self._done.is_set():
+            reply = self.redis.xread({self.key: lastId}, count=1000, block=200)
+            now = time.time()
+            for _, entries in reply or ():
+                for entryId, _ in entries:
+                    self.arrivals[entryId.decode() if isinstance(entryId, bytes) else entryId] = now
+                lastId = entries[-1][0]
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def run_agent(name, seconds, rate, redis, warmup=2.0, latency=0.0, noBaud=False, maxDelay=1.0):
+    """
+    Poll one agent against its simulated device for the given number of seconds.
+    :param rate: Polls per second, 0 for as fast as the agent can go
+    :param maxDelay: The BufferedStreamWriter's maxDelay, which bounds how long a reading can wait for its batch
+    :return: Dict of results. samples counts the readings queued during the run that were seen in Redis
+    """
+    device, setup = AGENTS[name]
+    simulator = Simulator(device, latency=latency, noBaud=noBaud)
+    writer = TaggingWriter(redis, maxDelay=maxDelay)
+    try:
+        poll, key, close = setup(simulator.port, redis, writer)
+        writer.key = key
+        writer.start()
+
+        # Warm up (connection setup, first allocations) without measuring
+        warmupEnd = time.monotonic() + warmup
+        while time.monotonic() < warmupEnd:
+            poll()
+        writer.flush()
+        redis.delete(key)
+
+        follower = StreamFollower(redis, key)
+        follower.start()
+        errors = 0
+        rss0 = _rss()
+        cpu0 = time.process_time()
+        start = time.monotonic()
+        nextPoll = start
+        while time.monotonic() - start < seconds:
+            writer.pollSent = time.time()
+            try:
+                poll()
+            except Exception:
+                errors += 1
+            if rate:
+                nextPoll += 1 / rate
+                time.sleep(max(nextPoll - time.monotonic(), 0))
+        elapsed = time.monotonic() - start
+        writer.pollSent = None
+        writer.flush()
+
+        # Give the follower time to see the last batch
+        deadline = time.monotonic() + 2
+        while len(follower.arrivals) < len(writer.sent) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        follower.stop()
+        cpu = time.process_time() - cpu0
+        rss = _rss() - rss0
+        close()
+    finally:
+        writer.stop()
+        simulator.close()
+
+    matched = [entryId for entryId in writer.sent if entryId in follower.arrivals]
+    samples = len(matched)
+    latencies = np.array([follower.arrivals[entryId] - writer.sent[entryId] for entryId in matched]) * 1000
+    return {'samples': samples,
+            'errors': errors,
+            'samplesPerSecond': samples / elapsed,
+            'latencyP50': float(np.percentile(latencies, 50)) if samples else float('nan'),
+            'latencyP99': float(np.percentile(latencies, 99)) if samples else float('nan'),
+            'cpuPerSample': cpu / samples * 1e6 if samples else float('nan'),
+            'rssGrowth': rss / 1024}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: List of (agent, metric, baseline value, new value) that got worse by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        for metric in COMPARED:
+            old = baseline.get(name, {}).get(metric)
+            new = result.get(metric)
+            if old is None or new is None or not old:
+                continue
+            change = (old - new) / old if metric in HIGHER_IS_BETTER else (new - old) / old
+            if change > tolerance:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PICTURE-C acquisition benchmark")
+    parser.add_argument('agents', nargs='*', default=sorted(AGENTS), help=f"Agents to run, from {sorted(AGENTS)}")
+    parser.add_argument('--seconds', type=float, default=30, help="Measured run length per agent")
+    parser.add_argument('--rate', type=float, default=0, help="Polls per second, 0 for as fast as possible")
+    parser.add_argument('--latency', type=float, default=0.0, help="Simulated device response latency in s")
+    parser.add_argument('--no-baud', action='store_true', help="Don't pace the simulated devices at their baud rate")
+    parser.add_argument('--max-delay', type=float, default=1.0, help="Write-behind buffer maxDelay in s")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help="Scratch Redis database. It is flushed!")
+    parser.add_argument('--save', help="Write the results to this JSON file as a new baseline")
+    parser.add_argument('--compare', help="Baseline JSON file to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed fractional regression")
+    args = parser.parse_args()
+
+    redis = walrus.Walrus(host=args.host, port=args.port, db=args.db)
+    redis.flushdb()
+
+    results = {}
+    for name in args.agents:
+        try:
+            results[name] = run_agent(name, args.seconds, args.rate, redis, latency=args.latency,
+                                      noBaud=args.no_baud, maxDelay=args.max_delay)
+        except ImportError as e:
+            print(f"{name:10} skipped: {e}")
+            continue
+        r = results[name]
+        print(f"{name:10} {r['samplesPerSecond']:9.1f} samples/s   latency p50 {r['latencyP50']:8.2f} ms  "
+              f"p99 {r['latencyP99']:8.2f} ms   {r['cpuPerSample']:8.1f} us CPU/sample   "
+              f"RSS {r['rssGrowth']:+8.0f} kB   ({r['samples']} samples, {r['errors']} errors)")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old:.2f} -> {new:.2f}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,112 @@
+"""
+Microbenchmark comparing the original byte-at-a-time Arduino receive loop with the chunked FrameDecoder on the two
+reply shapes the hemttemp agent sees: 31 tokens (15 HEMT bias pins) and 25 tokens (12 one-wire thermometers).
+
+Run with: python frameDecoderBench.py [number of replies]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from arduinoFraming import FrameDecoder
+
+START_MARKER = '<'
+END_MARKER = '>'
+
+
+class FakePort(object):
+    """
+    Stand-in for serial.Serial that serves a fixed byte string, at most arrivalSize bytes "arriving" at a time.
+    Counts read() calls, which on real hardware are syscalls.
+    """
+    def __init__(self, data, arrivalSize):
+        self.data = data
+        self.arrivalSize = arrivalSize
+        self.pos = 0
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.pos, self.arrivalSize)
+
+    def read(self, size=1):
+        self.reads += 1
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+def legacy_receive(port):
+    """
+    Copy of the original Hemtduino._arduino_receive loop
+    """
+    dataStarted = False
+    messageComplete = False
+    dataBuffer = ""
+
+    while True:
+        if port.in_waiting > 0 and not messageComplete:
+            x = port.read().decode("utf-8")
+
+            if dataStarted:
+                if x is not END_MARKER:
+                    dataBuffer += x
+                else:
+                    dataStarted = False
+                    messageComplete = True
+            elif x == START_MARKER:
+                dataStarted = True
+                dataBuffer = ""
+
+        elif messageComplete:
+            messageComplete = False
+            return dataBuffer
+        else:
+            return "XXX"
+
+
+def hemt_reply():
+    # 15 'pin voltage ' pairs with a trailing space -> 31 tokens when split on ' '
+    return "<" + "".join(f"{i} {(-1) ** i * 0.01 * i:.2f} " for i in range(1, 16)) + ">"
+
+
+def one_wire_reply():
+    # 12 'position temperature ' pairs with a trailing space -> 25 tokens when split on ' '
+    return "<" + "".join(f"{i} {20 + 0.25 * i:.2f} " for i in range(1, 13)) + ">"
+
+
+def bench(name, reply, n):
+    data = reply.encode("utf-8") * n
+    assert len(reply[1:-1].split(' ')) in (31, 25)
+
+    def run_legacy():
+        port = FakePort(data, len(reply))
+        for _ in range(n):
+            legacy_receive(port)
+        return port.reads
+
+    def run_decoder():
+        port = FakePort(data, len(reply))
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < n:
+            frames.extend(decoder.read_from(port))
+        return port.reads
+
+    legacyReads = run_legacy()
+    decoderReads = run_decoder()
+    legacyTime = min(timeit.repeat(run_legacy, number=1, repeat=5))
+    decoderTime = min(timeit.repeat(run_decoder, number=1, repeat=5))
+
+    print(f"{name} ({len(reply)} bytes/reply, {n} replies)")
+    print(f"  legacy : {legacyTime * 1e6 / n:8.2f} us/reply, {legacyReads / n:6.1f} reads/reply")
+    print(f"  decoder: {decoderTime * 1e6 / n:8.2f} us/reply, {decoderReads / n:6.1f} reads/reply")
+    print(f"  speedup: {legacyTime / decoderTime:.1f}x")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench("HEMT biases", hemt_reply(), n)
+    bench("One-wire temps", one_wire_reply(), n)
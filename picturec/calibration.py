@@ -0,0 +1,127 @@
+"""
+Host-side calibration curves for converting raw sensor readings to temperature. This covers the RX-102A table used by
+SIM921.loadCurve (RX-102A_Mean_Curve.tbl: column 0 is T in K, column 1 is R in Ohms) and LakeShore .340 files such
+as those loaded into the LS240 with MeasureLink. It lets archived resistance or sensor-unit readings be
+re-calibrated after a curve update without involving the instruments.
+
+Each curve file is parsed once and cached until the file changes. Interpolation is piecewise linear in log(R)-log(T),
+which follows the shape of resistance thermometer curves much better than linear interpolation. It is done with
+np.interp, so converting a whole array is a single vectorized call. Readings outside the curve come back as NaN.
+"""
+
+import functools
+import logging
+import os
+import re
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class CalibrationCurve(object):
+    def __init__(self, temperature, sensor, name=""):
+        """
+        :param temperature: Calibration temperatures in K
+        :param sensor: Sensor reading (e.g. resistance in Ohms) at each temperature. Must be positive
+        :param name: Label for log messages
+        """
+        temperature = np.asarray(temperature, dtype=np.float64)
+        sensor = np.asarray(sensor, dtype=np.float64)
+        if temperature.shape != sensor.shape or temperature.size < 2:
+            raise ValueError(f"Curve {name} needs at least two matching temperature/sensor points")
+
+        self.name = name
+        self.temperature = temperature
+        self.sensor = sensor
+
+        # np.interp needs increasing abscissae, and NTC sensors like the RX-102A decrease with T
+        bySensor = np.argsort(sensor)
+        self._logS = np.log10(sensor[bySensor])
+        self._logTbyS = np.log10(temperature[bySensor])
+        byTemperature = np.argsort(temperature)
+        self._logT = np.log10(temperature[byTemperature])
+        self._logSbyT = np.log10(sensor[byTemperature])
+
+    def __len__(self):
+        return self.temperature.size
+
+    def to_temperature(self, sensor):
+        """
+        :param sensor: Scalar or array of sensor readings (e.g. resistance in Ohms)
+        :return: Temperatures in K, NaN where the reading is outside the curve
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logS = np.log10(np.asarray(sensor, dtype=np.float64))
+        return 10 ** np.interp(logS, self._logS, self._logTbyS, left=np.nan, right=np.nan)
+
+    def to_sensor(self, temperature):
+        """
+        :param temperature: Scalar or array of temperatures in K
+        :return: Sensor readings at those temperatures, NaN outside the curve
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logT = np.log10(np.asarray(temperature, dtype=np.float64))
+        return 10 ** np.interp(logT, self._logT, self._logSbyT, left=np.nan, right=np.nan)
+
+
+def _numeric_rows(lines, ncols):
+    rows = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) < ncols:
+            continue
+        try:
+            rows.append([float(p) for p in parts[:ncols]])
+        except ValueError:
+            continue
+    return np.array(rows, dtype=np.float64).reshape(-1, ncols)
+
+
+def _parse_tbl(lines, name):
+    data = _numeric_rows(lines, 2)
+    return CalibrationCurve(data[:, 0], data[:, 1], name)
+
+
+def _parse_340(lines, name):
+    """
+    LakeShore .340 curve: header lines, then rows of 'point number, sensor units, temperature'. Data format 4 stores
+    log10(Ohms) in the units column.
+    """
+    logUnits = False
+    for line in lines:
+        match = re.match(r"\s*Data Format:\s*(\d)", line)
+        if match:
+            logUnits = match.group(1) == '4'
+            break
+    data = _numeric_rows(lines, 3)
+    sensor = 10 ** data[:, 1] if logUnits else data[:, 1]
+    return CalibrationCurve(data[:, 2], sensor, name)
+
+
+@functools.lru_cache(maxsize=32)
+def _load(path, mtime):
+    with open(path) as f:
+        lines = f.readlines()
+    name = os.path.basename(path)
+    curve = _parse_340(lines, name) if path.lower().endswith('.340') else _parse_tbl(lines, name)
+    log.info(f"Loaded calibration curve {name} ({len(curve)} points)")
+    return curve
+
+
+def load_curve(path):
+    """
+    Load a curve file (.tbl two-column T/R table or LakeShore .340). Parsed curves are cached, and a file is only
+    re-read once its modification time changes.
+    :return: CalibrationCurve
+    """
+    path = os.path.abspath(path)
+    return _load(path, os.path.getmtime(path))
+
+
+def to_temperature(path, sensor):
+    """
+    Convenience wrapper: convert raw readings with the (cached) curve in the given file.
+    :return: Temperatures in K
+    """
+    return load_curve(path).to_temperature(sensor)
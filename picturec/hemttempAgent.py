@@ -11,54 +11,162 @@ TODO: Work with publish/subscribe to redis for hemt.enabled changes, and write t
 """
 
 import serial
+import selectors
+import threading
 import time, logging
-from datetime import datetime
+from collections import deque
+import numpy as np
 import walrus
+import metrics
+import packedEncoding
+from arduinoFraming import FrameDecoder, BinaryFrameDecoder
+from messageSchemas import MessageParser, HEMT_BIASES, ONE_WIRE_TEMPS
+from pipeline import Pipeline, DROP_OLDEST, READ_TIMEOUT
+from redisWriter import BufferedStreamWriter
+from retention import RetentionPolicy, StreamCompactor
+from rollups import RollupEngine, rollup_retention
 
 START_MARKER = '<'
 END_MARKER = '>'
 REDIS_DB = 0
+STREAM_KEYS = {'hemt.biases': 'hemt_biases', 'one.wire.temps': 'one.wire.temps'}
+# Keep 3 days of raw readings (with a hard cap in case of faster polling). Longer history lives in the rollups, which
+# the RollupEngine builds as readings are written, so the compactor only has to trim
+RETENTION = {key: RetentionPolicy(maxlen=1000000, window=3 * 24 * 3600, rollupInterval=None)
+             for key in STREAM_KEYS.values()}
+RETENTION.update(rollup_retention(STREAM_KEYS.values()))
+PACKED_SCHEMAS = {'hemt_biases': packedEncoding.HEMT_BIASES, 'one.wire.temps': packedEncoding.ONE_WIRE_TEMPS}
+METRICS_PORT = 9108
+# Binary frames carry raw 10-bit ADC counts for pins 1-15. The gate voltage pins read 5 V low on the readout board
+VOLTS_PER_COUNT = 5.0 / 1023
+GATE_PINS = (1, 4, 7, 10, 13)
+COUNT_OFFSETS = np.array([-5.0 if pin in GATE_PINS else 0.0 for pin in range(1, 16)])
+
+AGENT = {'agent': 'hemttemp'}
+ROUND_TRIP = metrics.REGISTRY.histogram('serial_round_trip_seconds', "Query sent to complete reply received", AGENT)
+PARSE_SECONDS = metrics.REGISTRY.histogram('parse_seconds', "Time to parse one reply", AGENT)
+FRAMES = metrics.REGISTRY.counter('frames_total', "Replies received", AGENT)
+MALFORMED = metrics.REGISTRY.counter('frames_malformed_total', "Replies that could not be parsed", AGENT)
+TIMEOUTS = metrics.REGISTRY.counter('serial_timeouts_total', "Queries that got no reply in time", AGENT)
+OVERRUNS = metrics.REGISTRY.counter('stream_overruns_total', "Streamed frames overwritten before being published", AGENT)
+SERIAL_BACKLOG = metrics.REGISTRY.gauge('serial_input_backlog_bytes', "Bytes left in the serial input buffer after a "
+                                                                      "read while streaming", AGENT)
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
+def counts_to_volts(counts):
+    """
+    :param counts: Raw ADC counts with pins 1-15 along the last axis, for one frame or a stack of them
+    :return: Float array of volts, the same values the ASCII reply gives
+    """
+    return counts * VOLTS_PER_COUNT + COUNT_OFFSETS
+
+
+class BoardClock(object):
+    """
+    Maps the millis() timestamps of streamed frames onto Unix time. The offset is taken from the frame that spent the
+    least time in transit, i.e. the smallest (arrival - board time) seen so far. It is allowed to creep up by
+    maxDrift seconds per second so that a board clock running slow is followed too. millis() wrapping (every 49.7
+    days) is unwrapped, and a board reset (millis() starting again from 0) starts the mapping over.
+    """
+    def __init__(self, maxDrift=1e-3):
+        self.maxDrift = maxDrift
+        self.offset = None
+        self._wraps = 0
+        self._lastMillis = None
+        self._lastBoard = None
+
+    def reset(self):
+        self.offset = None
+        self._wraps = 0
+        self._lastMillis = None
+        self._lastBoard = None
+
+    def to_unix(self, millis, arrival):
+        """
+        :param millis: Board timestamp of a frame
+        :param arrival: time.time() when the frame was read
+        :return: Unix time of the reading
+        """
+        if self._lastMillis is not None and millis < self._lastMillis:
+            if self._lastMillis - millis > 2 ** 31:
+                self._wraps += 1
+            else:
+                log.info("Board clock went backwards, the Arduino was probably reset")
+                self.reset()
+        self._lastMillis = millis
+        board = (millis + self._wraps * 2 ** 32) / 1000
+        transit = arrival - board
+        if self.offset is None:
+            self.offset = transit
+        else:
+            self.offset = min(transit, self.offset + self.maxDrift * (board - self._lastBoard))
+        self._lastBoard = board
+        return board + self.offset
+
+
 class Hemtduino(serial.Serial):
-    def __init__(self, port, baudrate, timeout=None, queryTime=1):
+    def __init__(self, port, baudrate, timeout=None, queryTime=1, redis=None, writer=None, packed=False,
+                 binary=False):
+        """
+        :param binary: Query the bias board with '<raw>' and read its binary frames (raw ADC counts with a sequence
+        number and CRC) instead of the ASCII '<all>' reply, which is about three times longer on the wire
+        """
         super(Hemtduino, self).__init__(port=port, baudrate=baudrate, timeout=timeout)
         self.queryTime = queryTime
-        self.redis = walrus.Walrus(host='localhost', port=6379, db=REDIS_DB)
-        self.redis_ts = self.redis.time_series('hemttemp.stream', ['hemt_biases', 'one.wire.temps'])
+        self.binary = binary
+        self.query = "raw" if binary else "all"
+        self.redis = redis if redis is not None else walrus.Walrus(host='localhost', port=6379, db=REDIS_DB)
+        self.redis_ts = self.redis.time_series('hemttemp.stream', list(STREAM_KEYS.values()))
+        if writer is None:
+            writer = BufferedStreamWriter(self.redis, retention=RETENTION,
+                                          schemas=PACKED_SCHEMAS if packed else None)
+            writer.rollups = RollupEngine(writer, STREAM_KEYS.values())
+        self.writer = writer
+        self.compactor = StreamCompactor(self.redis, RETENTION)
+        self.decoder = FrameDecoder()
+        self.binaryDecoder = BinaryFrameDecoder()
+        self.clock = BoardClock()
+        self.parser = MessageParser([HEMT_BIASES, ONE_WIRE_TEMPS])
+        self._frames = deque()
 
     def _reset(self):
         self.setDTR(False)
         time.sleep(0.5)
         self.setDTR(True)
+        self.decoder.reset()
+        self.binaryDecoder.reset()
+        self._frames.clear()
 
     def _arduino_receive(self):
-        dataStarted = False
-        messageComplete = False
-        dataBuffer = ""
-
-        while True:
-            if self.in_waiting > 0 and not messageComplete:
-                x = self.read().decode("utf-8")
-
-                if dataStarted:
-                    if x is not END_MARKER:
-                        dataBuffer += x
-                    else:
-                        dataStarted = False
-                        messageComplete = True
-                elif x == START_MARKER:
-                    dataStarted = True
-                    dataBuffer = ""
-
-            elif messageComplete:
-                messageComplete = False
-                return dataBuffer
-            else:
+        """
+        Return the next complete '<...>' frame from the Arduino. Everything waiting on the port is read in one go and
+        any partial frame is kept by the decoder, so a message split across reads is no longer dropped. If no frame
+        is buffered, this blocks for up to the port timeout waiting for more bytes.
+        :return: Frame contents as a str, or "XXX" if no complete frame arrived in time
+        """
+        while not self._frames:
+            chunk = self.read(self.in_waiting or 1)
+            if not chunk:
                 return "XXX"
+            self._frames.extend(self.decoder.feed(chunk))
+
+        return self._frames.popleft().decode("utf-8")
+
+    def _receive_binary(self):
+        """
+        Binary counterpart of _arduino_receive. Blocks for up to the port timeout until at least one frame is in.
+        :return: List of BinaryFrames, empty if none arrived in time
+        """
+        frames = []
+        while not frames:
+            chunk = self.read(self.in_waiting or 1)
+            if not chunk:
+                return []
+            frames = self.binaryDecoder.feed(chunk)
+        return frames
 
     def arduino_ping(self):
         log.debug("Waiting for Arduino")
@@ -67,34 +175,197 @@ class Hemtduino(serial.Serial):
         msg = self._arduino_receive()
         log.info(msg)
 
-    def _arduino_send(self, command):
+    def _arduino_send(self, command, wait=0.5):
         cmdWMarkers = START_MARKER
         cmdWMarkers += command
         cmdWMarkers += END_MARKER
 
         log.debug("Writing...")
         self.write(cmdWMarkers.encode("utf-8"))
-        time.sleep(0.5)
+        if wait:
+            time.sleep(wait)
+
+    def _publish(self, arduinoReply):
+        log.debug(arduinoReply)
+        FRAMES.inc()
+        with PARSE_SECONDS.time():
+            parsed = self.parser.parse(arduinoReply)
+        if parsed is None:
+            MALFORMED.inc()
+            log.warning(f"Could not parse Arduino reply '{arduinoReply}': {self.parser.lastError}")
+            return
+        schema, values = parsed
+        log.debug(f"Queueing {schema.name} message for redis")
+        self.writer.add(STREAM_KEYS[schema.name], schema.fields(values))
+
+    def _publish_binary(self, frames, timestamps=None):
+        """
+        Convert every frame in a batch from counts to volts in one step and queue the readings.
+        :param frames: BinaryFrames from the binary decoder
+        :param timestamps: Unix time of each frame. Defaults to now
+        :return: None
+        """
+        FRAMES.inc(len(frames))
+        if timestamps is None:
+            timestamps = [None] * len(frames)
+        keep = [i for i, frame in enumerate(frames) if len(frame.counts) == len(HEMT_BIASES)]
+        good = [frames[i].counts for i in keep]
+        if len(good) < len(frames):
+            MALFORMED.inc(len(frames) - len(good))
+            log.warning(f"Dropped {len(frames) - len(good)} binary frame(s) without {len(HEMT_BIASES)} channels")
+        if not good:
+            return
+        start = time.perf_counter()
+        volts = counts_to_volts(np.stack(good))
+        PARSE_SECONDS.observe((time.perf_counter() - start) / len(good))
+        log.debug(f"Queueing {len(good)} hemt.biases message(s) for redis")
+        key = STREAM_KEYS[HEMT_BIASES.name]
+        for i, row in zip(keep, volts):
+            self.writer.add(key, HEMT_BIASES.fields(row), timestamp=timestamps[i])
+
+    def start_stream(self, interval):
+        """
+        Have the bias board push a timestamped binary frame every interval seconds (rounded to the ms) on its own
+        :return: None
+        """
+        self._arduino_send(f"stream {max(int(round(interval * 1000)), 1)}", wait=0)
+
+    def stop_stream(self):
+        self._arduino_send("stream 0", wait=0)
 
-    def format_value(self, message):
-        message = message.split(' ')
-        if len(message) == 31:
-            log.debug("Formatting HEMT bias values")
-            pins = message[0::2][-1]
-            biasValues = message[1::2]
-            msgtype = 'hemt.biases'
-            msg = {k: v for k,v in zip(pins, biasValues)}
+    def _stream_reader(self, ring, ready, done, resync, highWater, failure):
+        """
+        Reader thread for run_streaming(). Decodes frames as they arrive and appends them, with their arrival time, to
+        the bounded ring. If the publisher has fallen so far behind that the ring is full, the oldest frame is
+        overwritten and counted as an overrun. A growing serial input backlog means this thread itself is not keeping
+        up, and is warned about before the OS buffer overflows and bytes are lost. A serial error (e.g. the board
+        was unplugged) is put in failure for run_streaming() to raise. When resync is set, the decoder's sequence
+        number is forgotten here, between reads, rather than by another thread while feed() is using it.
+        """
+        behind = False
+        while not done.is_set():
+            try:
+                chunk = self.read(self.in_waiting or 1)
+                backlog = self.in_waiting
+            except serial.SerialException as e:
+                with ready:
+                    failure.append(e)
+                    ready.notify()
+                return
+            SERIAL_BACKLOG.set(backlog)
+            if backlog > highWater and not behind:
+                log.warning(f"{backlog} bytes waiting on the serial port, the host is falling behind the stream")
+            behind = backlog > highWater
+            if resync.is_set():
+                resync.clear()
+                self.binaryDecoder.lastSeq = None
+            if not chunk:
+                continue
+            frames = self.binaryDecoder.feed(chunk)
+            if not frames:
+                continue
+            arrival = time.time()
+            with ready:
+                overrun = max(len(ring) + len(frames) - ring.maxlen, 0)
+                ring.extend((arrival, frame) for frame in frames)
+                ready.notify()
+            if overrun:
+                OVERRUNS.inc(overrun)
+                log.warning(f"Stream ring full, {overrun} frame(s) overwritten before they were published")
 
-        elif len(message) == 25:
-            log.debug("Formatting One-wire thermometer values")
-            positions = message[0::2][-1]
-            temps = message[1::2]
-            msgtype = 'one.wire.temps'
-            msg = {k: v for k, v in zip(positions, temps)}
+    def run_streaming(self, interval=0.05, capacity=1024, highWater=2048, replyTimeout=None):
+        """
+        Subscribe-style replacement for polling. The bias board is told once to stream at the given interval, then
+        pushes timestamped binary frames without being asked. A reader thread moves them from the serial port into
+        a ring of the most recent capacity frames, and this thread drains the ring in batches, converts each batch
+        to volts in one step and queues it for Redis with the board's timestamps. Slow Redis writes therefore delay
+        publishing but not reading. Frames lost on either side are counted: on the board (transmit buffer full) from
+        gaps in the sequence numbers, on the host from ring overruns.
+        :param interval: Seconds between frames. At 9600 baud a 39-byte frame takes 41 ms on the wire
+        :param capacity: Frames the ring holds
+        :param highWater: Serial input backlog in bytes above which the reader warns that it is falling behind
+        :param replyTimeout: Seconds without a frame after which streaming is requested again (e.g. after the board
+        reset). Defaults to the larger of 10 intervals and 1 s
+        :return: None
+        """
+        if replyTimeout is None:
+            replyTimeout = max(10 * interval, 1)
+        if self.timeout is None:
+            # Otherwise the reader blocks in read() for good once the stream stops, and the join below never returns
+            self.timeout = READ_TIMEOUT
 
-        return msgtype, msg
+        self.writer.start()
+        self.compactor.start()
+        self.arduino_ping()
+        self.reset_input_buffer()
+        self.binaryDecoder.reset()
+        self.clock.reset()
+
+        ring = deque(maxlen=capacity)
+        ready = threading.Condition()
+        done = threading.Event()
+        resync = threading.Event()
+        failure = []
+        reader = threading.Thread(target=self._stream_reader, args=(ring, ready, done, resync, highWater, failure),
+                                  name="hemttemp-stream", daemon=True)
+        reader.start()
+        self.start_stream(interval)
+        metrics.REGISTRY.gauge('stream_ring_frames', "Streamed frames waiting to be published", AGENT,
+                               fn=ring.__len__)
+
+        try:
+            while True:
+                with ready:
+                    ready.wait_for(lambda: ring or failure, timeout=replyTimeout)
+                    batch = list(ring)
+                    ring.clear()
+                if failure:
+                    raise failure[0]
+                if not batch:
+                    TIMEOUTS.inc()
+                    log.warning(f"No streamed frames for {replyTimeout} s, asking the Arduino to stream again")
+                    # A reset board numbers its frames from 0 again, which is not a gap
+                    resync.set()
+                    self.start_stream(interval)
+                    continue
+                frames = [frame for _, frame in batch]
+                timestamps = [self.clock.to_unix(frame.millis, arrival) if frame.millis is not None else arrival
+                              for arrival, frame in batch]
+                self._publish_binary(frames, timestamps)
+        finally:
+            done.set()
+            if not failure:
+                self.stop_stream()
+            reader.join()
+
+    def poll(self):
+        """
+        Send a single "all" (or in binary mode "raw") query, wait (up to the port timeout) for the reply and publish
+        it. This is the unit of work the supervisor schedules for this board.
+        :return: None
+        """
+        sentAt = time.perf_counter()
+        self._arduino_send(self.query, wait=0)
+        if self.binary:
+            frames = self._receive_binary()
+            if not frames:
+                TIMEOUTS.inc()
+                log.warning("No reply from the Arduino")
+            else:
+                ROUND_TRIP.observe(time.perf_counter() - sentAt)
+                self._publish_binary(frames)
+            return
+        arduinoReply = self._arduino_receive()
+        if arduinoReply == "XXX":
+            TIMEOUTS.inc()
+            log.warning("No reply from the Arduino")
+        else:
+            ROUND_TRIP.observe(time.perf_counter() - sentAt)
+            self._publish(arduinoReply)
 
     def run(self):
+        self.writer.start()
+        self.compactor.start()
         self.arduino_ping()
         prevTime = time.time()
 
@@ -103,17 +374,141 @@ class Hemtduino(serial.Serial):
                 log.debug("Sending Query")
                 self._arduino_send("all")
                 arduinoReply = self._arduino_receive()
-                log.info(arduinoReply)
                 prevTime = time.time()
-                t, m = self.format_value(arduinoReply)
-                log.debug(f"Sending {t} messages to redis")
-                if t == "hemt.biases":
-                    self.redis_ts.hemt_biases.add(m, id=datetime.utcnow())
-                if t == "one.wire.temps":
-                    self.redis_ts.one_wire_temps.add(m, id=datetime.utcnow())
+                self._publish(arduinoReply)
+
+    def run_event_driven(self, replyTimeout=None):
+        """
+        Event-driven replacement for run(). Rather than spinning on time.time() and sleeping a fixed 0.5 s after each
+        query, the process sleeps in select() on the serial file descriptor until either a reply arrives or the next
+        query is due. Queries are scheduled every queryTime seconds on the monotonic clock; a reply is handled the
+        moment its end marker is read, and if it arrives after the next query was due that query goes out right away.
+        :param replyTimeout: Seconds to wait for a reply before giving up on it and carrying on with the schedule.
+        Defaults to the larger of queryTime and 1 s
+        :return: None
+        """
+        if replyTimeout is None:
+            replyTimeout = max(self.queryTime, 1)
+
+        self.writer.start()
+        self.compactor.start()
+        self.arduino_ping()
+        self._frames.clear()
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.fileno(), selectors.EVENT_READ)
+        nextQuery = time.monotonic()
+        sentAt = None
+
+        try:
+            while True:
+                now = time.monotonic()
+                if sentAt is None and now >= nextQuery:
+                    log.debug("Sending Query")
+                    self._arduino_send(self.query, wait=0)
+                    sentAt = now
+                    # Hold the cadence, but never try to catch up on missed queries with a burst
+                    nextQuery = max(nextQuery + self.queryTime, now)
+
+                deadline = nextQuery if sentAt is None else sentAt + replyTimeout
+                if selector.select(timeout=max(deadline - time.monotonic(), 0)):
+                    if self.binary:
+                        frames = self.binaryDecoder.read_from(self)
+                        if frames:
+                            if sentAt is not None:
+                                ROUND_TRIP.observe(time.monotonic() - sentAt)
+                            self._publish_binary(frames)
+                            sentAt = None
+                        continue
+                    for frame in self.decoder.read_from(self):
+                        if sentAt is not None:
+                            ROUND_TRIP.observe(time.monotonic() - sentAt)
+                        self._publish(frame.decode("utf-8"))
+                        sentAt = None
+                elif sentAt is not None and time.monotonic() - sentAt >= replyTimeout:
+                    TIMEOUTS.inc()
+                    log.warning(f"No reply from the Arduino within {replyTimeout} s")
+                    sentAt = None
+        finally:
+            selector.close()
+
+    def _parse_stage(self, raw):
+        """
+        Pipeline stage: ASCII frame -> (timestamp, stream key, fields), or None if it does not parse
+        """
+        FRAMES.inc()
+        reply = raw.frame.decode("utf-8", "replace")
+        with PARSE_SECONDS.time():
+            parsed = self.parser.parse(reply)
+        if parsed is None:
+            MALFORMED.inc()
+            log.warning(f"Could not parse Arduino reply '{reply}': {self.parser.lastError}")
+            return None
+        schema, values = parsed
+        return raw.time, STREAM_KEYS[schema.name], schema.fields(values)
+
+    def _calibrate_stage(self, raw):
+        """
+        Pipeline stage: binary frame -> (timestamp, stream key, fields in volts), or None for a frame with the wrong
+        number of channels
+        """
+        FRAMES.inc()
+        frame = raw.frame
+        if len(frame.counts) != len(HEMT_BIASES):
+            MALFORMED.inc()
+            log.warning(f"Dropped binary frame {frame.seq} with {len(frame.counts)} channels")
+            return None
+        timestamp = raw.time if frame.millis is None else self.clock.to_unix(frame.millis, raw.time)
+        return timestamp, STREAM_KEYS[HEMT_BIASES.name], HEMT_BIASES.fields(counts_to_volts(frame.counts))
+
+    def _publish_stage(self, reading):
+        timestamp, key, fields = reading
+        self.writer.add(key, fields, timestamp=timestamp)
+
+    def run_pipelined(self, queueSize=1000, policy=DROP_OLDEST):
+        """
+        Pipelined replacement for run(). A reader thread does nothing but read the port and timestamp frames as they
+        arrive. A parse stage (or, in binary mode, a calibrate stage that converts counts to volts) and a publish
+        stage each run in their own thread behind bounded queues (see pipeline.py). This thread only sends the queries
+        every queryTime seconds on the monotonic clock, so a slow Redis write or log flush delays neither the next
+        query nor the next read. Queue depths, drops and per-stage timings are in the metrics registry under
+        pipeline="hemttemp".
+        :param queueSize: Size of each stage's input queue
+        :param policy: Policy for the queue the reader fills: DROP_OLDEST (the reader never waits) or BLOCK
+        :return: None
+        """
+        self.writer.start()
+        self.compactor.start()
+        self.arduino_ping()
+        self.reset_input_buffer()
+        self.decoder.reset()
+        self.binaryDecoder.reset()
+        self.clock.reset()
+
+        pipe = Pipeline('hemttemp')
+        if self.binary:
+            pipe.add_stage('calibrate', self._calibrate_stage, maxsize=queueSize, policy=policy)
+        else:
+            pipe.add_stage('parse', self._parse_stage, maxsize=queueSize, policy=policy)
+        pipe.add_stage('publish', self._publish_stage, maxsize=queueSize)
+        pipe.add_reader(self, self.binaryDecoder if self.binary else self.decoder, name='hemtduino')
+        pipe.start()
+
+        nextQuery = time.monotonic()
+        try:
+            while pipe.failed is None:
+                self._arduino_send(self.query, wait=0)
+                # Hold the cadence, but never try to catch up on missed queries with a burst
+                nextQuery = max(nextQuery + self.queryTime, time.monotonic())
+                time.sleep(max(nextQuery - time.monotonic(), 0))
+            raise pipe.failed
+        finally:
+            pipe.stop()
 
 
 if __name__ == "__main__":
 
     hemtduino = Hemtduino(port="/dev/ttyS9", baudrate=9600, timeout=1)
-    hemtduino.run()
+    metrics.serve(METRICS_PORT)
+    metrics.RedisPublisher(hemtduino.redis, 'metrics:hemttemp').start()
+    hemtduino.run_event_driven()
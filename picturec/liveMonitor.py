@@ -0,0 +1,63 @@
+"""
+Live plot of a RingBuffer that redraws on its own timer. The lines are made once. Each tick hands them the newest
+rows with set_data and rescales the axes, which are never cleared. Acquisition runs in its own thread and only
+appends to the ring. The serial reader therefore never waits on rendering, and rendering never waits on the serial
+port.
+
+    ring = RingBuffer(500, 4)
+    threading.Thread(target=acquire, args=(ring,), daemon=True).start()
+    LiveMonitor(ring, ["Vg", "Id", "Vd"]).show()
+"""
+
+import matplotlib.pyplot as plt
+
+
+class LiveMonitor(object):
+    def __init__(self, ring, labels, interval=0.5, xlabel="Time elapsed (s)", title=None):
+        """
+        :param ring: RingBuffer with the x value (e.g. elapsed time) in column 0 and one channel per later column
+        :param labels: y-axis label of each channel. Each channel gets its own subplot
+        :param interval: Seconds between redraws
+        """
+        self.ring = ring
+        self.fig, axes = plt.subplots(len(labels), 1, sharex=True, squeeze=False)
+        self.axes = axes[:, 0]
+        self.lines = []
+        for ax, label in zip(self.axes, labels):
+            ax.set_ylabel(label)
+            line, = ax.plot([], [])
+            self.lines.append(line)
+        self.axes[-1].set_xlabel(xlabel)
+        if title:
+            self.fig.suptitle(title)
+        self._drawn = None
+        self.timer = self.fig.canvas.new_timer(interval=int(interval * 1000))
+        self.timer.add_callback(self.update)
+
+    def update(self):
+        """
+        Redraw with the current contents of the ring, if anything was added since the last redraw
+        :return: None
+        """
+        if self.ring.total == self._drawn:
+            return
+        self._drawn = self.ring.total
+        # A copy, since some matplotlib versions keep a reference to what set_data is given and the ring would
+        # change it under the artist
+        data = self.ring.snapshot()
+        if not len(data):
+            return
+        for i, (ax, line) in enumerate(zip(self.axes, self.lines)):
+            line.set_data(data[:, 0], data[:, i + 1])
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.canvas.draw_idle()
+
+    def show(self):
+        """
+        Start the redraw timer and hand the main thread to the matplotlib event loop until the window is closed
+        :return: None
+        """
+        self.timer.start()
+        plt.show()
+        self.timer.stop()
@@ -0,0 +1,119 @@
+"""
+Declared message types for the '<...>' replies of the PICTURE-C Arduinos. A reply is a run of space separated
+"channel value " pairs, e.g. '1 -0.52 2 1.23 3 2.01 ... 15 2.00 ' from the HEMT bias board. Each MessageSchema names a
+message type and lists the channels it carries. A MessageParser recognises a reply by its number of pairs and parses
+the values straight into a float array that belongs to the schema and is reused for every reply, indexed by the
+schema's channel order.
+
+A reply that does not parse (an odd number of tokens, an unknown pair count, an unexpected channel, a value that is
+not a number) is counted and skipped rather than raised, so one garbled frame does not stop an agent.
+
+To handle a new kind of reply, register() a schema for it and pass it to the agent's parser. Two schemas given to the
+same parser cannot have the same number of channels.
+"""
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+SCHEMAS = {}
+
+
+class MessageSchema(object):
+    def __init__(self, name, channels):
+        """
+        :param name: Message type, e.g. 'hemt.biases'
+        :param channels: Channel (pin or position) numbers in the order their values are stored
+        """
+        self.name = name
+        self.channels = tuple(str(c) for c in channels)
+        self.index = {}
+        for i, c in enumerate(self.channels):
+            # Look-ups work on tokens from both decoded (str) and raw (bytes) frames
+            self.index[c] = i
+            self.index[c.encode('ascii')] = i
+        self.values = np.full(len(self.channels), np.nan)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def fields(self, values=None):
+        """
+        :param values: Array in channel order. Defaults to the last parsed reply
+        :return: Dict of channel: float, e.g. for BufferedStreamWriter.add. Channels that were not in the reply are
+        left out
+        """
+        if values is None:
+            values = self.values
+        return {c: v for c, v in zip(self.channels, values.tolist()) if v == v}
+
+
+def register(name, channels):
+    """
+    Add a message type to the registry.
+    :return: The registered MessageSchema
+    """
+    schema = MessageSchema(name, channels)
+    existing = SCHEMAS.get(name)
+    if existing is not None and existing.channels != schema.channels:
+        raise ValueError(f"Message type {name} is already registered with channels {existing.channels}")
+    SCHEMAS[name] = schema
+    return schema
+
+
+HEMT_BIASES = register('hemt.biases', range(1, 16))
+ONE_WIRE_TEMPS = register('one.wire.temps', range(1, 13))
+MAGNET_CURRENT = register('magnet.current', [5])
+
+
+class MessageParser(object):
+    def __init__(self, schemas=None):
+        """
+        :param schemas: MessageSchemas to recognise. Defaults to every registered schema
+        """
+        if schemas is None:
+            schemas = SCHEMAS.values()
+        self.byPairs = {}
+        for schema in schemas:
+            other = self.byPairs.get(len(schema))
+            if other is not None and other is not schema:
+                raise ValueError(f"{schema.name} and {other.name} both have {len(schema)} channels")
+            self.byPairs[len(schema)] = schema
+        self.parsed = 0
+        self.malformed = 0
+        self.lastError = None
+
+    def _reject(self, reason):
+        self.malformed += 1
+        self.lastError = reason
+        return None
+
+    def parse(self, message):
+        """
+        :param message: Frame contents (str or bytes) with the markers stripped
+        :return: (MessageSchema, values) or None if the message is malformed (see lastError for why). values is the
+        schema's own array and is overwritten by the next reply of that type, so copy it to keep it
+        """
+        tokens = message.split()
+        if len(tokens) % 2:
+            return self._reject(f"odd number of tokens ({len(tokens)})")
+        schema = self.byPairs.get(len(tokens) // 2)
+        if schema is None:
+            return self._reject(f"no message type has {len(tokens) // 2} channels")
+
+        values = schema.values
+        values.fill(np.nan)
+        index = schema.index
+        for i in range(0, len(tokens), 2):
+            j = index.get(tokens[i])
+            if j is None:
+                return self._reject(f"unexpected channel {tokens[i]!r} in {schema.name}")
+            try:
+                values[j] = float(tokens[i + 1])
+            except ValueError:
+                return self._reject(f"bad value {tokens[i + 1]!r} for channel {tokens[i]!r} in {schema.name}")
+
+        self.parsed += 1
+        return schema, values
@@ -0,0 +1,278 @@
+"""
+Lightweight counters, gauges and histograms for the hot paths of the agents: serial round trips, frame parsing,
+Redis writes and buffer depths. Updating a metric takes a lock and, for a histogram, a bisect over its buckets. That
+costs on the order of a microsecond, which is cheap enough to leave on in flight where DEBUG logging is not.
+
+Metrics live in a Registry (REGISTRY by default) and can be read out in two ways:
+    serve(port)              Prometheus text format on http://127.0.0.1:<port>/metrics, from a daemon thread
+    RedisPublisher(redis)    the flattened values written to a Redis hash every few seconds, for the ground link
+
+    FRAMES = metrics.REGISTRY.counter('arduino_frames_total', "Frames received", labels={'agent': 'hemttemp'})
+    FRAMES.inc()
+    with ROUND_TRIP.time():
+        ...
+"""
+
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# Seconds. Spans a fast parse (~10 us) up to a serial timeout (~1 s)
+DEFAULT_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help="", labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, name, help="", labels=None, fn=None):
+        """
+        :param fn: Callable returning the current value, read whenever the gauge is exported (e.g. a queue's length).
+        If given, set()/inc() are not needed
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self):
+        value = self.value
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception as e:
+                log.debug(f"Gauge {self.name} failed to read: {e}")
+                value = float('nan')
+        return [(self.name, self.labels, value)]
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help="", labels=None, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Increasing upper bounds. A +Inf bucket is always added
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """
+        :return: Context manager that observes the time spent inside it, in seconds
+        """
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        :return: Upper bound of the bucket the q-th quantile falls in (an estimate, good to the bucket width)
+        """
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return float('nan')
+        target = q * total
+        running = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            running += n
+            if running >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self._lock:
+            counts, total, sum_ = list(self.counts), self.count, self.sum
+        samples = []
+        running = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            running += n
+            samples.append((self.name + '_bucket', dict(self.labels, le='+Inf' if bound == float('inf') else bound),
+                            running))
+        samples.append((self.name + '_sum', self.labels, sum_))
+        samples.append((self.name + '_count', self.labels, total))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, help, labels, **kwargs)
+                self._metrics[key] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            elif kwargs.get('fn') is not None:
+                # A re-created object (e.g. a reconnected agent) takes over its gauge
+                metric.fn = kwargs['fn']
+            return metric
+
+    def counter(self, name, help="", labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=None, fn=None):
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help="", labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics(), key=lambda m: m.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        :return: Dict of 'name{labels}': value for every sample, e.g. for publishing to Redis
+        """
+        return {f"{name}{_label_text(labels)}": value
+                for metric in self.metrics() for name, labels, value in metric.samples()}
+
+
+REGISTRY = Registry()
+
+
+def serve(port=9108, registry=REGISTRY, host='127.0.0.1'):
+    """
+    Serve the registry at http://host:port/metrics from a daemon thread.
+    :return: The ThreadingHTTPServer (call shutdown() to stop it)
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+class RedisPublisher(object):
+    def __init__(self, redis, key, period=10, registry=REGISTRY):
+        """
+        Periodically write registry.snapshot() to the Redis hash at key.
+        :param key: e.g. 'metrics:hemttemp'
+        """
+        self.redis = redis
+        self.key = key
+        self.period = period
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self):
+        try:
+            self.redis.hset(self.key, mapping=self.registry.snapshot())
+        except Exception as e:
+            log.warning(f"Could not publish metrics to {self.key}: {e}")
+
+    def _loop(self):
+        while not self._stop.wait(self.period):
+            self.publish()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="metrics-redis", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
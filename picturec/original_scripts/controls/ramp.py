@@ -1,312 +1,79 @@
 """
-TODO: Rewrite ramp loop
-"""
-
-import serial
-import time
-import numpy as np
-
-
-def setupSerial(baudRate, serialPortName):
-    global serialPort
-
-    serialPort = serial.Serial(port=serialPortName, baudrate=baudRate, timeout=0)
-    print("Serial port " + serialPortName + " opened  Baudrate " + str(baudRate))
-
-    serialPort.write(b"xyz\r\n")
-
-    serialPort.write(b"*IDN?\r\n")
-    time.sleep(.1)
-    module = serialPort.readline().decode('ascii').rstrip('\r\n')
-    print(f"Connected to {module}")
-
-    for i in range(5):
-        serialPort.reset_input_buffer()
-        time.sleep(.1)
-        serialPort.reset_output_buffer()
-        time.sleep(.1)
-
-    print("Closing...")
-    time.sleep(.2)
-    serialPort.close()
-
-    print("Opening...")
-    time.sleep(.2)
-    serialPort.open()
-
-    if module.split(",")[1] == 'SIM900':
-        serialPort.write(b"xyz\r\n")
-
-        print("Connecting to sub-module")
-        time.sleep(.2)
-        serialPort.write(b'CONN 5,"xyz"\r\n')
-        time.sleep(.2)
-        serialPort.write(b'*IDN?\r\n')
-        time.sleep(.2)
-        submodule = serialPort.readline().decode('ascii').rstrip('\r\n')
-        submodule = submodule.split(",")[1]
-        if submodule == 'SIM960':
-            print(f"Connected to sub-module {submodule}")
-        else:
-            print("Failed to connect!")
-    elif module.split(",")[1] == 'SIM960':
-        print("Connected to SIM960")
-
-
-def calculateInitialOffsetV():
-    offsetVals = []
-    serialPort.write(b'MOUT 0\r\n')
-    time.sleep(3)
-    for i in range(5):
-        serialPort.readline()
-        time.sleep(.1)
-
-    print("Starting offset calibration")
-    for i in range(10):
-        serialPort.write(b'OMON?\r\n')
-        time.sleep(0.15)
-        oV = serialPort.readline().decode('ascii').rstrip('\r\n')
-        print(oV)
-        offsetVals.append(float(oV))
-    offsetVals = np.array(offsetVals)
-    offset = round(np.average(offsetVals), 3)
-    if offset < 0:
-        offset = 0
-
-    print(f"Offset = {offset} V")
-
-    return offset
-
-
-def stepUp(startV, offset, stepSize):
-    stepSuccessful = False
-    originalV = round(startV, 3)
-    while stepSuccessful is False:
-        targetV = round(startV + stepSize, 3)
-        mOutCmd = round(targetV - offset, 3)
-
-        print(f"Set V_out from {originalV} to {targetV} with {offset} V offset. Commanding M_out to {mOutCmd}.")
-        cmdStr = "MOUT "+str(mOutCmd)+"\r\n"
-
-        commandSent = False
-        while commandSent is False:
-            serialPort.write(cmdStr.encode('ascii'))
-            time.sleep(0.1)
-            serialPort.write(b"MOUT?\r\n")
-            time.sleep(0.1)
-            checkMoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-
-            if mOutCmd == checkMoutVal:
-                print(f"M_out successfully sent to {mOutCmd} V.")
-                commandSent = True
-            else:
-                print("Failed to execute command")
-
-        serialPort.write(b"OMON?\r\n")
-        time.sleep(0.25)
-        checkVoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-        endV = checkVoutVal
-        print(f"V_out is {checkVoutVal} V.")
+Run one ADR magnet cycle (ramp up, soak, ramp down) on the SIM960 in slot 5 of the SIM900 mainframe. Every step is
+streamed to ramp_data.bin as it happens (see instruments/rampRecorder.py). At the end the recording is also written
+out as ramp_data.txt in the old text layout.
 
-        if abs(checkVoutVal - targetV) > 0.01:
-            offset = round(checkVoutVal - checkMoutVal, 3)
-        else:
-            stepSuccessful = True
+The ramp itself is done by instruments/rampEngine.py. It paces the setpoint against the clock, keeps a running
+estimate of the SIM960 output offset and verifies each step through pipelined MOUT?/OMON? queries. The old script
+instead did a blocking write/sleep/read cycle on every 1 mV step.
 
-    return[originalV, endV, offset, stepSize]
-
-def stepDown(startV, offset, stepSize):
-    stepSuccessful = False
-    originalV = round(startV, 3)
-    while stepSuccessful is False:
-        targetV = round(startV - stepSize, 3)
-        mOutCmd = round(targetV - offset, 3)
-
-        print(f"Set V_out from {originalV} to {targetV} with {offset} V offset. Commanding M_out to {mOutCmd}.")
-        cmdStr = "MOUT " + str(mOutCmd) + "\r\n"
-
-        commandSent = False
-        while commandSent is False:
-            serialPort.write(cmdStr.encode('ascii'))
-            time.sleep(0.1)
-            serialPort.write(b"MOUT?\r\n")
-            time.sleep(0.1)
-            checkMoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-
-            if mOutCmd == checkMoutVal:
-                print(f"M_out successfully sent to {mOutCmd} V.")
-                commandSent = True
-            else:
-                print("Failed to execute command")
-
-        serialPort.write(b"OMON?\r\n")
-        time.sleep(0.1)
-        checkVoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-        endV = checkVoutVal
-        print(f"V_out is {checkVoutVal} V.")
-
-        if abs(checkVoutVal - targetV) > 0.01:
-            offset = round(checkVoutVal - checkMoutVal, 3)
-        else:
-            stepSuccessful = True
-
-    return [originalV, endV, offset, stepSize]
-
-
-def soakStep(soakV, offset):
-    stepSuccessful = False
-    originalV = round(soakV, 3)
-
-    while stepSuccessful is False:
-        targetV = originalV
-
-        print(f"Soaking at {soakV}")
-
-        serialPort.write(b"OMON?\r\n")
-        time.sleep(0.1)
-        checkVoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-        endV = checkVoutVal
-        print(f"V_out is {checkVoutVal} V.")
-
-        commandSent = True
-        vDrifted = False
-        if abs(checkVoutVal - targetV) > 0.01:
-            offset = checkVoutVal - targetV
-            vDrifted = True
-            commandSent = False
-        else:
-            stepSuccessful = True
-
-        while commandSent is False and vDrifted is True:
-            targetMout = round(targetV - offset, 3)
-            cmdStr = "MOUT " + str(targetMout) + "\r\n"
-
-            serialPort.write(cmdStr.encode('ascii'))
-            time.sleep(0.1)
-            serialPort.write(b"MOUT?\r\n")
-            time.sleep(0.1)
-            checkMoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
+The SIM900 port is locked by whichever process opens it first (see instruments/SIM900.py). Stop the supervisor, whose
+SIM921/SIM960 readout holds the mainframe, before running this script. Readout is paused for the length of the ramp.
+"""
 
-            if targetMout == checkMoutVal:
-                print(f"M_out successfully sent to {targetMout} V.")
-                commandSent = True
-            else:
-                print("Failed to execute command")
+import os
+import sys
+import time
 
-            serialPort.write(b"OMON?\r\n")
-            time.sleep(0.1)
-            checkVoutVal = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-            endV = checkVoutVal
-            print(f"V_out is {checkVoutVal} V.")
+import serial
 
-            if abs(checkVoutVal - targetV) > .01:
-                offset = round(checkVoutVal - checkMoutVal, 3)
-            else:
-                vDrifted = False
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instruments'))
+from SIM900 import SIM900
+from SIM960 import SIM960
+from rampEngine import RampEngine, Ramp, Soak
+from rampRecorder import RampRecorder, export_text
 
-    return [originalV, endV, offset, 0]
+SIM960_SLOT = 5
 
 
 if __name__ == "__main__":
     print("Starting")
 
-    # Connect to serial port (configured for Noah's laptop, will change when moved to Linux computer)
-    setupSerial(9600, "COM3")
+    mainframe = SIM900()
+    sim960 = SIM960(link=mainframe.submodule(SIM960_SLOT))
+    # No initialize(): its *RST would drop the SIM960 output under a magnet that may still be carrying current, which
+    # the old script never did. RampEngine.run() puts the SIM960 in manual output mode itself
+    try:
+        sim960.connect(initialize=False)
+    except serial.SerialException as e:
+        sys.exit(f"Could not open the SIM900 ({e}). If the supervisor is running, stop it first: it holds the "
+                 f"mainframe port for the SIM921/SIM960 readout")
+    if not sim960.isConnected:
+        sys.exit("Could not connect to the SIM960")
+    print(f"Connected to {sim960.idn}")
 
-    # Calculate any offset in voltage between what is commanded and what the SIM960 outputs
-    vOffset = calculateInitialOffsetV()
-
-    # Set the 'true' output to 0 V.
-    print("Setting output to 0.000 V initially")
-    cmd1 = "MOUT "+str(0-vOffset)+"\r\n"
-    serialPort.write(cmd1.encode('ascii'))
-    time.sleep(1)
-    serialPort.write(b"OMON?\r\n")
-    time.sleep(.1)
-    oMonStart = round(float(serialPort.readline().decode('ascii').rstrip('\r\n')), 3)
-    print(f"Output is currently: {oMonStart} V\n")
-    time.sleep(1)
-
-    # Initialize arrays for data to be stored. Set the starting ramp mode to 'up'
-    count = 0
-    stepDelta = 0.001
     vMin = 0
     vMax = 1
+    rate = 1  # mA/s, the same 1 mV/s as the old 1 mV-per-second stepping
+    soakTime = 120
 
     if vMin < 0:
         vMin = 0
     if vMax > 9.5:
         vMax = 9.5
 
-    soakTime = 120
-    mode = 'up'
-    prevTime = time.time()
-    startTime = int(prevTime)
-    times = [int(prevTime)]
-    outputVals = [oMonStart]
-    setVals = [0]
-    offsets = [vOffset]
-    steps = [0]
-    stepNumber = 0
-
-    # Start the ramping loop
-    print(f"------------ Starting loop at {int(time.time())} ------------\n")
-    while True:
-        now = time.time()
-        if now - prevTime > 1:
-            stepNumber += 1
-            steps.append(stepNumber)
-            if (int(now)-startTime)%60 == 0:
-                print(f"*************TIME ELAPSED IS {int((now-startTime)/60)} MINUTES ***************")
-            print(stepNumber)
-            print(mode)
-            if setVals[-1] < vMin:
-                setVals[-1] = vMin
-            elif setVals[-1] > vMax:
-                setVals[-1] = vMax
-            if mode == 'up':
-                oldV, newV, offset, stepSize = stepUp(setVals[-1], offsets[-1], stepDelta)
-                setVals.append(round(oldV + stepDelta, 3))
-                outputVals.append(round(newV, 3))
-                offsets.append(round(offset, 3))
-                times.append(now)
-            elif mode == 'down':
-                oldV, newV, offset, stepSize = stepDown(setVals[-1], offsets[-1], stepDelta)
-                setVals.append(round(oldV - stepDelta, 3))
-                outputVals.append(round(newV, 3))
-                offsets.append(round(offset, 3))
-                times.append(now)
-            elif mode == 'soak':
-                oldV, newV, offset, stepSize = soakStep(setVals[-1], offsets[-1])
-                setVals.append(round(oldV, 3))
-                outputVals.append(round(newV, 3))
-                offsets.append(round(offset, 3))
-                times.append(now)
-            else:
-                break
-
-            if setVals[-1] == vMax and not all(o == vMax for o in setVals[-soakTime:]):
-                mode = 'soak'
-            elif setVals[-1] == vMin and not all(o == vMin for o in setVals[-soakTime:]):
-                mode = 'soak'
-            elif all(o == vMax for o in setVals[-soakTime:]):
-                mode = 'down'
-            elif all(o == vMin for o in setVals[-soakTime:]) and len(setVals) > 10:
-                break
-            else:
-                pass
+    recorder = RampRecorder('ramp_data.bin', append=False)
 
-            prevTime = time.time()
-            print("\n")
+    def record(step):
+        recorder.record(step)
+        if recorder.steps % 100 == 0:
+            print(f"{step.elapsed:8.1f} s  {step.mode:4} ({recorder.mode_duration():6.1f} s)  "
+                  f"set {step.setpoint:.3f} V  out {step.omon} V  offset {step.offset:.4f} V")
 
+    profile = [Ramp(vMax, rate), Soak(soakTime), Ramp(vMin, rate), Soak(soakTime)]
+    engine = RampEngine(sim960, profile, onStep=record)
+    engine.calibrate_offset()
 
-    times = np.array(times)
-    setVals = np.array(setVals)
-    outputVals = np.array(outputVals)
+    print(f"------------ Starting ramp at {int(time.time())}, planned to take {engine.duration():.0f} s ------------")
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        print("Ramp interrupted, output left where it was")
+    finally:
+        recorder.close()
 
-    data = np.transpose(np.array([times, setVals, outputVals, steps]))
-    np.savetxt('ramp_data.txt', data, fmt="%14.8f")
+    export_text('ramp_data.bin', 'ramp_data.txt')
 
     print("Closing serial connection")
-    serialPort.write(b"xyz\r\n")
-    serialPort.close()
+    sim960.disconnect()
+    mainframe.disconnect()
@@ -1,11 +1,21 @@
 """
 TODO: Combine readRackTemps.py and readHemtBiases.py
+
+Polls one HEMT's biases and plots the last HISTORY readings live. The serial port is read in its own thread into a
+RingBuffer. A LiveMonitor redraws from the ring on a timer in the main thread, so drawing never delays a reading.
 """
 
-import matplotlib.pyplot as plt
+import os
+import sys
+import threading
 import serial
 import time
-import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from ringBuffer import RingBuffer
+from liveMonitor import LiveMonitor
+
+HISTORY = 500
 
 startMarker = '<'
 endMarker = '>'
@@ -81,61 +91,37 @@ def waitForArduino():
             print(msg)
 
 
-if __name__ == "__main__":
-
-    setupSerial(9600, "COM6")
-    hemt_num = 5
-    prevTime = time.time()
-    count = 0
-
-    plt.ion()
-    fig, ax = plt.subplots(3, 1, sharex=True)
-    x = []
-    y1 = []  # Vg
-    y2 = []  # Id
-    y3 = []  # Vd
-    ax[0].set_ylabel("Vg")
-    ax[0].set_xlabel("Time elapsed (s)")
-    ax[0].plot(x, y1)
-    ax[0].set_ylabel("Id")
-    ax[1].plot(x, y2)
-    ax[0].set_ylabel("Vd")
-    ax[2].plot(x, y3)
-
+def acquire(ring, hemt_num, period=1.0):
+    """
+    Ask for HEMT hemt_num's biases every period seconds and append each reply to ring as [elapsed, Vg, Id, Vd]
+    """
     start = time.time()
+    prevTime = 0
     while True:
         # check for a reply
         arduinoReply = recvLikeArduino()
         if not (arduinoReply == 'XXX'):
             biasInfo = arduinoReply.split(" ")[:-1]
-            print(f"Pin {biasInfo[0]}: {biasInfo[1]} V. Pin {biasInfo[2]}: {biasInfo[3]} V. Pin {biasInfo[4]}: {biasInfo[5]} V.")
-            now = time.time()
-            elapsed = now-start
-            x.append(elapsed)
-            y1.append(float(biasInfo[1]))
-            y2.append(float(biasInfo[3]))
-            y3.append(float(biasInfo[5]))
-
-            x = x[-50:]
-            y1 = y1[-50:]
-            y2 = y2[-50:]
-            y3 = y3[-50:]
-            ax[0].cla()
-            ax[0].autoscale_view()
-            ax[0].plot(x, y1)
-            ax[1].cla()
-            ax[1].autoscale_view()
-            ax[1].plot(x, y2)
-            ax[2].cla()
-            ax[2].autoscale_view()
-            ax[2].plot(x, y3)
-            plt.pause(1)
-
-            # send a message at intervals
-        if time.time() - prevTime > 1.0:
+            try:
+                print(f"Pin {biasInfo[0]}: {biasInfo[1]} V. Pin {biasInfo[2]}: {biasInfo[3]} V. Pin {biasInfo[4]}: {biasInfo[5]} V.")
+                ring.append([time.time() - start, float(biasInfo[1]), float(biasInfo[3]), float(biasInfo[5])])
+            except (IndexError, ValueError):
+                print(f"Could not parse reply '{arduinoReply}'")
+        elif serialPort.inWaiting() == 0:
+            # The port has no timeout, so don't spin while waiting for the next reply
+            time.sleep(0.01)
+
+        # send a message at intervals
+        if time.time() - prevTime > period:
             sendToArduino(str(hemt_num))
             prevTime = time.time()
-            count += 1
 
-    plt.ioff()
-    plt.show()
+
+if __name__ == "__main__":
+
+    setupSerial(9600, "COM6")
+    hemt_num = 5
+
+    ring = RingBuffer(HISTORY, 4)
+    threading.Thread(target=acquire, args=(ring, hemt_num), name="hemt-bias-reader", daemon=True).start()
+    LiveMonitor(ring, ["Vg", "Id", "Vd"], interval=0.5, title=f"HEMT {hemt_num}").show()
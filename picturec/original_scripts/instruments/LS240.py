@@ -5,102 +5,63 @@ TODO: *Possibly* add functionality to add in curves directly from this script, a
 """
 
 import serial
-from serial.tools.list_ports import comports
-from time import sleep
+import time
 import numpy as np
-import logging
-from custom_logging import MyTimedRotatingFileHandler as trfHandler
-from os.path import expanduser
+from serialInstrument import SerialInstrument
 
 
-class LS240(serial.Serial):
-    def __init__(self):
+class LS240(SerialInstrument):
+    instrument = "LS240"
+    VALID_IDS = [(0x1FB9, 0x0205)]  # 240 Module
+    CONNECT_HINT = ("Look at device manager and make sure the COM port is there. Also make sure that MeasureLINK for "
+                    "the 240 Series is not currently connected to the 240 module.")
+
+    def __init__(self, serialNumber=None):
         """
         Initialize LS240 instrument class. Uses serial.Serial base class for communication through USB port
+        :param serialNumber: USB serial number of the 240 module, to pick it out if more than one is plugged in
         """
-        self.setUpLog()
         self.serial_params = {'baudrate': 115200,
                          'timeout': 2,
                          'parity': serial.PARITY_NONE,
                          'bytesize': serial.EIGHTBITS}
 
-        super(LS240, self).__init__(port=None, **self.serial_params)
-        self.isConnected = False
-        self.idn = None
-        self.instrument = "LS240"
-
-    def connect(self):
-        """
-        Manually open comport for communication with LS240.
-        :return: None
-        """
-        self.log.debug(f"Attempting to connect to {self.instrument}")
-        valid_id_combos = [(0x1FB9, 0x0205)]  # 240 Module
-
-        for port_name in comports():
-            print(port_name.vid, port_name.pid)
-            if (port_name.vid, port_name.pid) in valid_id_combos:
-                self.port = port_name.device
-                self.open()
-                self.isConnected = True
-                self.clearBuffers()
-                self.idn = self.query("*IDN?")
-                self.log.info(f"{self.instrument} connected")
-                break
-        else:
-            self.log.error(f"Cannot find {self.instrument}. Look at device manager and make sure the COM port is there."
-                           f" Also make sure that MeasureLINK for the 240 Series is not currently connected to the "
-                           f"240 module.")
-
-    def disconnect(self):
-        """
-        Manually disconnect from comport LS240 is using.
-        :return: None
-        """
-        self.close()
-        self.log.debug(f"{self.instrument} disconnected")
+        super(LS240, self).__init__(self.serial_params, serialNumber=serialNumber)
+        self.model = None
+        self.channels = None
+        self._dtype = None
+        self._incomplete = False
 
-    def clearBuffers(self):
+    def initialize(self):
         """
-        Clears data buffers to prevent messages that were sent/received that weren't processed properly from messing up
-        the data stream
+        Read the model and channel configuration once on connect, so every readout does not have to ask again.
         :return: None
         """
-        self.reset_input_buffer()
-        self.reset_output_buffer()
-        self.log.debug("Buffers cleared")
-        sleep(.1)
+        self.refresh_configuration()
 
-    def command(self, command_string):
+    def refresh_configuration(self):
         """
-        Writes command to SIM921 and encodes it to utf-8 so the device can interpret it
-        :param: Command must be a str. Commands for this device can be found in the manual
+        Query the model (*IDN?) and which channels have curves loaded (INTYPE?), and cache them. All of the INTYPE?
+        queries go out in a single write. Called on connect, after a failed readout, or by hand after the instrument
+        has been reconfigured (e.g. with MeasureLink).
         :return: None
         """
-        if self.isConnected:
-            cmd_str = str(command_string)+"\n"
-            self.write(cmd_str.encode('utf-8'))
-            self.log.debug(f"Command \'{cmd_str}\' sent")
-        else:
-            self.log.error(f"Cannot write command! {self.instrument} is not connected!")
-
-    def query(self, query_string):
-        """
-        Writes command to SIM921 and listens for an answer. Used for specific situations where a response is desired
-        :param: Same as command function, str or str-like
-        :return: Response to query
-        """
-        if self.isConnected:
-            self.command(query_string)
-            response = self.readline().decode('ascii').rstrip('\r\n')
-            if response:
-                self.log.debug(f"Query for \'{query_string}\' returned")
-            else:
-                self.log.error(f"No response from {self.instrument}")
-            return response
-        else:
-            self.log.error(f"Query failed! {self.instrument} is not connected!")
-            return 0
+        self.model = None
+        self.channels = None
+        self._dtype = None
+        if not self.isConnected:
+            return
+
+        self.model = int(self.query("*IDN?")[14])
+        with self.queue.batch() as q:
+            replies = [(channel, q.query("INTYPE? " + str(channel))) for channel in range(1, self.model + 1)]
+        # A missing, short or garbled INTYPE? reply leaves that channel out rather than failing the whole refresh.
+        # If any went missing, the configuration is read again before the next readout
+        self.channels = [channel for channel, reply in replies
+                         if reply.exception() is None and reply.result()[10:11] == '1']
+        self._incomplete = any(reply.exception() is not None for _, reply in replies)
+        self._dtype = np.dtype([('time', np.float64)] + [(str(channel), np.float64) for channel in self.channels])
+        self.log.debug("%s is a %s channel model, channels %s enabled", self.instrument, self.model, self.channels)
 
     def identify_model(self):
         """
@@ -108,7 +69,9 @@ class LS240(serial.Serial):
         :return: 2 or 8, depending on which number of channels one has.
         """
         if self.isConnected:
-            return int(self.query("*IDN?")[14])
+            if self.model is None:
+                self.refresh_configuration()
+            return self.model
         else:
             return 2
 
@@ -117,45 +80,47 @@ class LS240(serial.Serial):
         Determines which of the 2 or 8 channels are enabled and have curves loaded in.
         :return: List of channels (indexed from 1 to n, n = 2 or 8) with curves loaded
         """
-        channels = self.identify_model()
-        enabled = []
-
         if self.isConnected:
-            for channel in range(1, channels + 1):
-                if self.query("INTYPE? " + str(channel))[10] == '1':
-                    enabled.append(int(channel))
+            if self.channels is None:
+                self.refresh_configuration()
+            return list(self.channels)
         else:
-            enabled = [1, 2]
-
-        return enabled
+            return [1, 2]
+
+    def read_temperatures(self):
+        """
+        Read every enabled channel with one pipelined batch of KRDG? queries. The 240 has no multi-channel reading
+        command, but sending all of the queries in one write means the channels cost a single round trip. If a reply is
+        missing or garbled, the input buffer is cleared so a late reply cannot be paired with the next query, the cached
+        configuration is dropped (it is re-read on the next call) and the error is raised.
+        :return: NumPy record with a 'time' field (unix seconds, taken when the queries were sent) and one field per
+        enabled channel, named by channel number
+        """
+        if self.channels is None or self._incomplete:
+            self.refresh_configuration()
+        if not self.isConnected:
+            raise serial.SerialException(f"{self.instrument} is not connected")
+
+        record = np.zeros((), dtype=self._dtype)
+        record['time'] = time.time()
+        try:
+            with self.queue.batch() as q:
+                replies = [q.query("KRDG? " + str(channel)) for channel in self.channels]
+            for channel, reply in zip(self.channels, replies):
+                record[str(channel)] = float(reply.result())
+        except (TimeoutError, ValueError) as e:
+            self.log.error("%s readout failed (%s), configuration will be re-read", self.instrument, e)
+            # A garbled reply may be part of one that arrived out of step, so start the next query on a clean buffer
+            self.drainInput()
+            self.model = None
+            self.channels = None
+            raise
+        return record[()]
 
     def query_temperatures_all(self):
         """
         Returns a temperature reading for each of the enabled channels
         :return: Array of length of enabled channels, each element is the temperature reading from a given channel
         """
-        query_channels = self.enabled_channels()
-
-        readings = []
-
-        for channel in query_channels:
-            readings.append(float(self.query("KRDG? " + str(channel))))
-
-        return np.array(readings)
-
-    def setUpLog(self):
-        """
-        Set up logging to write data to an instrument log file and to the shell
-        :return: None
-        """
-        self.log = logging.getLogger(__name__)
-        self.log.setLevel(logging.DEBUG)
-        sh = logging.StreamHandler()
-        sh.setLevel(logging.INFO)
-        fh = trfHandler("instruments.log", whenTo='m', intervals=1, directory=expanduser("~"))
-        filefmt = logging.Formatter('%(asctime)s - %(name)s %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-        fmt = logging.Formatter('%(asctime)s - %(name)s %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-        fh.setFormatter(filefmt)
-        sh.setFormatter(fmt)
-        self.log.addHandler(sh)
-        self.log.addHandler(fh)
+        record = self.read_temperatures()
+        return np.array([record[str(channel)] for channel in self.channels])
@@ -0,0 +1,150 @@
+"""
+Class to manage the Stanford Research Systems (SRS) SIM900 mainframe, which the SIM921 and SIM960 modules sit in.
+The mainframe owns the one serial cable. Each module gets a SIM900Link to its slot, and the mainframe hands that link to
+the SIM921/SIM960 class instead of a port, e.g.:
+
+    mainframe = SIM900()
+    sim960 = SIM960(link=mainframe.submodule(5))
+    sim921 = SIM921(link=mainframe.submodule(1))
+    sim960.connect()  # Opens the mainframe port if it isn't already open
+    sim921.connect()
+
+Talking to a slot means sending 'CONN <slot>,"<escape>"' to the mainframe and, to leave it again, the escape string.
+The mainframe remembers which slot is connected and only switches when a transaction is for a different slot. A
+poller that keeps talking to one module therefore never pays for an escape/CONN pair. Every transaction holds the
+mainframe lock, so temperature readout and magnet control can share the cable from different threads.
+
+That lock only works within one process. Two processes each switching slots on the same cable would corrupt each
+other's traffic, so the mainframe port is opened with an exclusive lock and a second process cannot open it at all.
+Readout (the supervisor) and a magnet ramp (controls/ramp.py) therefore have to take turns: stop the supervisor
+before running a ramp script, and start it again afterwards.
+"""
+
+import threading
+
+import serial
+
+from serialInstrument import SerialInstrument
+
+
+class SIM900Link(object):
+    def __init__(self, mainframe, slot):
+        """
+        Handle on one slot of a SIM900. Used as a (reentrant) context manager, it holds the mainframe lock with the
+        slot selected. write()/readline() go straight to the mainframe port and expect to be called inside it
+        :param mainframe: SIM900 instance
+        :param slot: Slot number, or None for the mainframe itself
+        """
+        self.mainframe = mainframe
+        self.slot = slot
+
+    def __enter__(self):
+        self.mainframe._lock.acquire()
+        try:
+            self.mainframe._select(self.slot)
+        except Exception:
+            self.mainframe._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.mainframe._lock.release()
+        return False
+
+    def open(self):
+        """
+        Make sure the mainframe port is open.
+        :return: True if the mainframe is connected
+        """
+        with self.mainframe._lock:
+            if not self.mainframe.isConnected:
+                self.mainframe.connect()
+            return self.mainframe.isConnected
+
+    def write(self, data):
+        self.mainframe.write(data)
+
+    def readline(self):
+        return self.mainframe.readline()
+
+
+class SIM900(SerialInstrument):
+    instrument = "SIM900"
+    VALID_IDS = [(0x0403, 0x6001)]
+    ESCAPE = "xyz"
+
+    def __init__(self, serialNumber=None):
+        """
+        Initialize SIM900 mainframe class. Uses serial.Serial base class for communication through USB port
+        :param serialNumber: USB serial number of the mainframe's adapter
+        """
+        serial_params = {'baudrate': 9600,
+                         'timeout': 2,
+                         'parity': serial.PARITY_NONE,
+                         'bytesize': serial.EIGHTBITS,
+                         'stopbits': serial.STOPBITS_ONE,
+                         # Slot switching is only serialized within this process, so keep other processes off the port
+                         'exclusive': True
+                         }
+        self._lock = threading.RLock()
+        self._slot = None
+        self._links = {}
+        super(SIM900, self).__init__(serial_params, serialNumber=serialNumber)
+        # Mainframe-level transactions (e.g. its own *IDN?) must first leave whichever slot is connected
+        self.lock = self.submodule(None)
+        self.queue.lock = self.lock
+
+    def _write(self, data):
+        with self.lock:
+            self.write(data)
+
+    def _readline(self):
+        with self.lock:
+            return self.readline()
+
+    def initialize(self):
+        """
+        Send the escape string in case a previous session left a slot connected, so we start talking to the mainframe.
+        :return: None
+        """
+        with self._lock:
+            self.write(f"{self.ESCAPE}\n".encode('utf-8'))
+            self._slot = None
+
+    def submodule(self, slot):
+        """
+        :param slot: Slot number the module is installed in, or None for the mainframe itself
+        :return: The SIM900Link for that slot (the same object every time)
+        """
+        link = self._links.get(slot)
+        if link is None:
+            link = SIM900Link(self, slot)
+            self._links[slot] = link
+        return link
+
+    def _select(self, slot):
+        """
+        Route the cable to slot, sending as few escape/CONN commands as possible. Must hold self._lock.
+        """
+        if slot == self._slot:
+            return
+        if self._slot is not None:
+            self.write(f"{self.ESCAPE}\n".encode('utf-8'))
+            self._slot = None
+        if slot is not None:
+            self.write(f'CONN {slot},"{self.ESCAPE}"\n'.encode('utf-8'))
+            self._slot = slot
+        self.log.debug("Mainframe connected to slot %s", slot)
+
+    def disconnect(self):
+        """
+        Leave any connected slot and close the mainframe port.
+        :return: None
+        """
+        with self._lock:
+            if self.isConnected and self._slot is not None:
+                try:
+                    self._select(None)
+                except (serial.SerialException, OSError) as e:
+                    self.log.debug("Could not leave slot %s before closing: %s", self._slot, e)
+            super(SIM900, self).disconnect()
@@ -0,0 +1,145 @@
+"""
+Pipelined command queue shared by the SIM921, SIM960 and LS240 classes. Callers submit any number of commands and
+queries, each of which returns a concurrent.futures.Future. flush() writes the commands back to back in a single
+serial write and then reads the replies in order, resolving each query's future with its reply. Commands that need
+time to take effect (e.g. "*RST") are given a settle time. The write is split after them and the queue pauses only
+there, instead of sleeping after every command.
+
+    with instrument.queue.batch() as q:
+        q.command("RANG 6")
+        q.command("EXCI 2")
+        curve = q.query("CURV?")
+    curve.result()  # -> '1'
+"""
+
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import sleep
+
+log = logging.getLogger(__name__)
+
+
+class CommandQueue(object):
+    def __init__(self, write, readline, settle=None, lock=None, terminator="\n", discard=None):
+        """
+        :param write: Callable taking bytes to send, e.g. a serial.Serial's write
+        :param readline: Callable returning one reply line as bytes (b'' on timeout), e.g. serial.Serial.readline
+        :param settle: Dict of command mnemonic (e.g. "*RST"): seconds to wait after sending it
+        :param lock: Context manager held for the whole of a flush, so that batches from different threads sharing the
+        link do not interleave. Defaults to a private lock
+        :param terminator: Appended to every command
+        :param discard: Callable that throws away whatever is in the input buffer, e.g. serial.Serial's
+        reset_input_buffer. Called after a reply goes missing, so that it cannot turn up late and be read as the reply
+        to the next query
+        """
+        self.write = write
+        self.readline = readline
+        self.settle = {k.upper(): v for k, v in (settle or {}).items()}
+        self.lock = lock if lock is not None else threading.RLock()
+        self.terminator = terminator
+        self.discard = discard
+        self._pending = []
+        self._pendingLock = threading.Lock()
+
+    def _submit(self, cmd, isQuery):
+        future = Future()
+        with self._pendingLock:
+            self._pending.append((str(cmd), isQuery, future))
+        return future
+
+    def command(self, cmd):
+        """
+        Queue a command that produces no reply.
+        :return: Future resolved with None once the command has been written (and has settled)
+        """
+        return self._submit(cmd, False)
+
+    def query(self, cmd):
+        """
+        Queue a query.
+        :return: Future resolved with the reply, end characters stripped, once flush() has read it
+        """
+        return self._submit(cmd, True)
+
+    def _settle_time(self, cmd):
+        return self.settle.get(cmd.split(None, 1)[0].upper(), 0) if cmd.strip() else 0
+
+    @staticmethod
+    def _fail(items, error):
+        """
+        Fail every future among items that has not been resolved yet
+        """
+        for _, _, future in items:
+            if not future.done():
+                future.set_exception(error)
+
+    def _send(self, segment, settleTime):
+        """
+        Write one segment of commands in a single write, read its replies in order and wait out any settle time.
+        :return: False if a reply was missing, in which case every unresolved future in the segment has been failed
+        :raises: Whatever write or readline raised (e.g. serial.SerialException), after failing the segment's
+        unresolved futures with it
+        """
+        try:
+            self.write("".join(cmd + self.terminator for cmd, _, _ in segment).encode('utf-8'))
+            for cmd, isQuery, future in segment:
+                if not isQuery:
+                    continue
+                reply = self.readline().decode('ascii').rstrip('\r\n')
+                if not reply:
+                    self._fail(segment, TimeoutError(f"No reply to '{cmd}'"))
+                    return False
+                future.set_result(reply)
+
+            if settleTime:
+                sleep(settleTime)
+        except BaseException as e:
+            self._fail(segment, e)
+            raise
+        for _, isQuery, future in segment:
+            if not isQuery:
+                future.set_result(None)
+        return True
+
+    def flush(self):
+        """
+        Send everything queued so far and resolve its futures. If a query goes unanswered, the rest of the batch is
+        failed rather than risk pairing later replies with the wrong queries.
+        :return: True if every reply arrived
+        """
+        with self._pendingLock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return True
+
+        with self.lock:
+            segment = []
+            for n, item in enumerate(pending):
+                segment.append(item)
+                settleTime = self._settle_time(item[0])
+                if settleTime or n == len(pending) - 1:
+                    try:
+                        sent = self._send(segment, settleTime)
+                    except BaseException as e:
+                        self._fail(pending[n + 1:], e)
+                        raise
+                    if not sent:
+                        log.error(f"Reply missing, failing the remaining {len(pending) - n - 1} queued commands")
+                        self._fail(pending[n + 1:], TimeoutError("Earlier reply in the batch was missing"))
+                        if self.discard is not None:
+                            self.discard()
+                        return False
+                    segment = []
+        return True
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that flushes everything queued inside it on exit.
+        """
+        try:
+            yield self
+        finally:
+            self.flush()
@@ -0,0 +1,142 @@
+"""
+Process-wide logging for the instrument classes. Instrument loggers only get a QueueHandler, which puts the record on
+an in-memory queue and returns. One background QueueListener does the formatting and the console and file output.
+A thread polling a serial port therefore never waits on disk I/O or a slow terminal.
+
+The listener and its handlers are set up once per process, the first time get_logger() is called. Asking for the same
+logger again (e.g. from a second SIM921 instance) does not add another handler, so messages are not duplicated.
+
+Repeated warnings and errors (from the same logging call, e.g. "No response from SIM921" on every poll while a cable
+is out) are let through once per rateLimit seconds. The next one that gets through says how many were suppressed.
+Repeats are recognised by where the call is, not by its text, so instrument classes should log with %-style arguments
+rather than f-strings: a message that embeds the error or a reading still counts as the same message.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from os.path import expanduser
+
+LOG_FORMAT = '%(asctime)s - %(name)s %(levelname)s - %(message)s'
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_listener = None
+_queue = None
+_setupLock = threading.Lock()
+
+
+class MyTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    def __init__(self, filename, whenTo='midnight', intervals=1, directory=None, backupCount=30):
+        """
+        TimedRotatingFileHandler that takes the log directory separately and creates it if needed.
+        :param whenTo: Rotation unit, as TimedRotatingFileHandler's 'when' ('midnight', 'h', 'm', ...)
+        :param intervals: Number of units between rotations
+        :param backupCount: Rotated files to keep
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, filename)
+        super(MyTimedRotatingFileHandler, self).__init__(filename, when=whenTo, interval=intervals,
+                                                         backupCount=backupCount, delay=True)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the %-formatting of the message to the listener thread. The stock prepare() formats it in
+    the caller's thread so that the record can be pickled, which an in-process queue does not need.
+    """
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=60, level=logging.WARNING):
+        """
+        :param interval: Seconds during which a repeat of the same message is suppressed
+        :param level: Only records at this level or above are rate limited
+        """
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        self.level = level
+        # (logger, file, line): (time last let through, repeats suppressed since)
+        self._seen = {}
+        self._lastPurge = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        # Forget call sites whose interval has run out with nothing suppressed. Must hold self._lock
+        self._seen = {key: (last, suppressed) for key, (last, suppressed) in self._seen.items()
+                      if suppressed or now - last < self.interval}
+        self._lastPurge = now
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._lastPurge >= self.interval:
+                self._purge(now)
+            last, suppressed = self._seen.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} repeats suppressed)"
+        return True
+
+
+def setup(filename="instruments.log", directory=expanduser("~"), consoleLevel=logging.INFO, fileLevel=logging.DEBUG,
+          whenTo='midnight', rateLimit=60):
+    """
+    Start the process-wide listener. Only the first call does anything, so instrument classes can all call it.
+    :param filename: Log file name, rotated daily by default
+    :param directory: Directory for the log file. None for no file
+    :param rateLimit: Seconds between repeats of the same warning/error. 0 to let every one through
+    :return: The shared queue records are put on
+    """
+    global _listener, _queue
+    with _setupLock:
+        if _listener is not None:
+            return _queue
+
+        fmt = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+        handlers = []
+        sh = logging.StreamHandler()
+        sh.setLevel(consoleLevel)
+        sh.setFormatter(fmt)
+        handlers.append(sh)
+        if directory is not None:
+            fh = MyTimedRotatingFileHandler(filename, whenTo=whenTo, intervals=1, directory=directory)
+            fh.setLevel(fileLevel)
+            fh.setFormatter(fmt)
+            handlers.append(fh)
+
+        _queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+        _listener.rateLimit = RateLimitFilter(rateLimit) if rateLimit else None
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _queue
+
+
+def get_logger(name, level=logging.DEBUG):
+    """
+    :return: Logger that hands its records to the shared listener, configured at most once per name
+    """
+    q = setup()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not any(isinstance(h, _DeferredQueueHandler) for h in logger.handlers):
+        handler = _DeferredQueueHandler(q)
+        if _listener.rateLimit is not None:
+            handler.addFilter(_listener.rateLimit)
+        logger.addHandler(handler)
+        # The listener does the output, so don't also pass records up to any root handlers
+        logger.propagate = False
+    return logger
@@ -0,0 +1,163 @@
+"""
+Registry of the USB-serial ports on the host, shared by every instrument class in the process. connect() used to
+call comports() and scan it on every attempt. Instead, the registry enumerates the ports once and indexes them by
+(VID, PID). Lookups are then a dict access, and two instruments behind the same adapter type (the SIM921 and SIM960
+both use an FTDI 0403:6001) can be told apart by USB serial number.
+
+If pyudev is installed, a background observer listens for tty add/remove events and refreshes the index as cables
+come and go. wait_for_device() lets a reconnect loop wake up as soon as its device is plugged back in, rather than
+sleeping out a fixed retry delay. Without pyudev the index is only refreshed when a lookup misses, at most once every
+minRefresh seconds.
+"""
+
+import logging
+import threading
+import time
+
+from serial.tools.list_ports import comports
+
+log = logging.getLogger(__name__)
+
+
+class DeviceRegistry(object):
+    def __init__(self, minRefresh=1.0):
+        """
+        :param minRefresh: Minimum seconds between re-enumerations triggered by failed lookups
+        """
+        self.minRefresh = minRefresh
+        self._changed = threading.Condition()
+        self._byId = {}
+        self._added = {}
+        self._lastRefresh = None
+        self._observer = None
+
+    def refresh(self):
+        """
+        Enumerate the serial ports and rebuild the index. Wakes up anything in wait_for_device().
+        :return: None
+        """
+        ports = comports()
+        now = time.monotonic()
+        with self._changed:
+            byId = {}
+            added = {}
+            for port in ports:
+                if port.vid is None:
+                    continue
+                byId.setdefault((port.vid, port.pid), []).append(port)
+                added[port.device] = self._added.get(port.device, now)
+            self._byId = byId
+            self._added = added
+            self._lastRefresh = now
+            self._changed.notify_all()
+        log.debug(f"Found {len(added)} USB serial ports")
+
+    def _matches(self, ids, serialNumber):
+        return [port for vidpid in ids for port in self._byId.get(tuple(vidpid), ())
+                if serialNumber is None or port.serial_number == serialNumber]
+
+    def _lookup(self, ids, serialNumber):
+        matches = self._matches(ids, serialNumber)
+        return matches[0].device if matches else None
+
+    def find(self, ids, serialNumber=None):
+        """
+        :param ids: (vid, pid) pairs the device may appear as
+        :param serialNumber: USB serial number to match, or None to take the first port with a matching VID/PID. An
+        error is logged if that leaves more than one candidate, since the port picked is then down to enumeration order
+        :return: Device name (e.g. '/dev/ttyUSB0'), or None if no such port is present
+        """
+        with self._changed:
+            stale = self._lastRefresh is None or time.monotonic() - self._lastRefresh > self.minRefresh
+            matches = [] if self._lastRefresh is None else self._matches(ids, serialNumber)
+        if not matches and stale:
+            self.refresh()
+            with self._changed:
+                matches = self._matches(ids, serialNumber)
+        if not matches:
+            return None
+        if len(matches) > 1:
+            log.error(f"{len(matches)} ports match {ids} and no serial number was given, using {matches[0].device}. "
+                      f"Candidates: {', '.join(f'{p.device} (s/n {p.serial_number})' for p in matches)}")
+        return matches[0].device
+
+    def forget(self, device):
+        """
+        Drop a port that failed to open, so the next lookup enumerates again rather than returning it.
+        :return: None
+        """
+        with self._changed:
+            for ports in self._byId.values():
+                ports[:] = [port for port in ports if port.device != device]
+            self._added.pop(device, None)
+            self._lastRefresh = None
+
+    def wait_for_device(self, ids, serialNumber=None, since=None, timeout=None):
+        """
+        Block until a matching port is present that was plugged in after `since`. Without hot-plug monitoring this
+        just sleeps for the timeout, which is what a reconnect loop did before.
+        :param since: time.monotonic() value. None to accept a port that is already present
+        :param timeout: Seconds to wait at most
+        :return: Device name, or None on timeout
+        """
+        if self._observer is None:
+            if timeout:
+                time.sleep(timeout)
+            return self.find(ids, serialNumber)
+
+        def ready():
+            device = self._lookup(ids, serialNumber)
+            if device is not None and (since is None or self._added[device] > since):
+                return device
+            return None
+
+        with self._changed:
+            return self._changed.wait_for(ready, timeout)
+
+    def start_monitor(self):
+        """
+        Start listening for udev tty events. Does nothing if pyudev is not installed or the monitor is running.
+        :return: True if hot-plug monitoring is active
+        """
+        if self._observer is not None:
+            return True
+        try:
+            import pyudev
+        except ImportError:
+            log.info("pyudev is not installed, serial hot-plug detection is disabled")
+            return False
+
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('tty')
+        self._observer = pyudev.MonitorObserver(monitor, callback=self._on_event, name='device-registry')
+        self._observer.daemon = True
+        self._observer.start()
+        self.refresh()
+        log.debug("Serial hot-plug monitoring started")
+        return True
+
+    def stop_monitor(self):
+        if self._observer is not None:
+            self._observer.send_stop()
+            self._observer = None
+
+    def _on_event(self, device):
+        if device.action in ('add', 'remove'):
+            log.info(f"Serial port {device.device_node} {'added' if device.action == 'add' else 'removed'}")
+            self.refresh()
+
+
+_registry = None
+_registryLock = threading.Lock()
+
+
+def get_registry():
+    """
+    :return: The process-wide DeviceRegistry, with hot-plug monitoring started if pyudev is available
+    """
+    global _registry
+    with _registryLock:
+        if _registry is None:
+            _registry = DeviceRegistry()
+            _registry.start_monitor()
+        return _registry
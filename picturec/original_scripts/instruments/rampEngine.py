@@ -0,0 +1,229 @@
+"""
+Closed-loop magnet ramp for the SIM960 in manual output mode. A ramp is described by a profile: a list of Ramp and
+Soak segments, e.g. adr_cycle() for the usual up / soak / down ADR cycle. RampEngine plays the profile back against
+the monotonic clock. On every tick the setpoint moves by the rate times the time since the previous command, so
+small scheduling delays do not stretch the ramp. That time is capped at one period: after a stall (e.g. a serial
+timeout) the setpoint does not jump to catch up, since the magnet must never be slewed faster than the requested
+rate. The segment ends late instead.
+
+The SIM960 output (OMON) differs from the commanded manual output (MOUT) by a slowly drifting offset. The engine
+tracks that offset with an exponentially weighted moving average of OMON - MOUT and commands MOUT = setpoint - offset.
+Each tick is one pipelined batch: "MOUT x", "MOUT?" and "OMON?" go out in a single write, and both replies are read
+back. A readback that does not match is logged and corrected on the next tick, rather than retried in a blocking loop.
+"""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+# Highest control voltage the SIM960 is allowed to command the HCBoost board to
+MAX_OUTPUT = 9.5
+
+RampStep = namedtuple('RampStep', ['time', 'elapsed', 'mode', 'setpoint', 'mout', 'moutReadback', 'omon', 'offset'])
+
+
+class Ramp(object):
+    def __init__(self, target, rate):
+        """
+        Ramp the output to target at a constant rate.
+        :param target: Output (OMON) voltage to end the segment at
+        :param rate: Magnet current ramp rate in mA/s, greater than 0
+        """
+        if not rate > 0:
+            raise ValueError(f"Ramp rate must be greater than 0 mA/s, got {rate}")
+        self.target = target
+        self.rate = rate
+
+    def __repr__(self):
+        return f"Ramp({self.target} V at {self.rate} mA/s)"
+
+
+class Soak(object):
+    def __init__(self, duration):
+        """
+        Hold the output where the previous segment left it.
+        :param duration: Seconds
+        """
+        self.duration = duration
+
+    def __repr__(self):
+        return f"Soak({self.duration} s)"
+
+
+def adr_cycle(peak=9.5, rate=5, soakTime=20 * 60):
+    """
+    :param peak: Output voltage to soak at
+    :param rate: Ramp rate in mA/s, used both up and down
+    :param soakTime: Soak length in seconds
+    :return: Profile ramping up to peak, soaking and ramping back down to 0
+    """
+    return [Ramp(peak, rate), Soak(soakTime), Ramp(0, rate)]
+
+
+class OffsetEstimator(object):
+    def __init__(self, offset=0.0, alpha=0.2):
+        """
+        Exponentially weighted moving average of OMON - MOUT.
+        :param offset: Starting estimate in V
+        :param alpha: Weight of each new sample, between 0 and 1
+        """
+        self.value = offset
+        self.alpha = alpha
+
+    def update(self, mout, omon):
+        self.value += self.alpha * ((omon - mout) - self.value)
+        return self.value
+
+
+class RampEngine(object):
+    def __init__(self, sim960, profile, period=0.1, ampsPerVolt=1.0, maxRate=5, offset=None, alpha=0.2,
+                 onStep=None):
+        """
+        :param sim960: Connected SIM960 instance
+        :param profile: List of Ramp and Soak segments, starting from an output of 0 V
+        :param period: Seconds between setpoint updates
+        :param ampsPerVolt: Magnet current per volt of SIM960 output (set by the HCBoost board)
+        :param maxRate: Upper limit on any segment's rate in mA/s, greater than 0
+        :param offset: Starting OMON - MOUT offset in V. None to measure it with calibrate_offset() first
+        :param alpha: Weight of each new sample in the offset estimate
+        :param onStep: onStep(RampStep). Called after every tick, e.g. to record or display the ramp
+        """
+        if not maxRate > 0:
+            raise ValueError(f"maxRate must be greater than 0 mA/s, got {maxRate}")
+        if not ampsPerVolt > 0:
+            raise ValueError(f"ampsPerVolt must be greater than 0, got {ampsPerVolt}")
+        self.sim960 = sim960
+        self.profile = list(profile)
+        self.period = period
+        self.ampsPerVolt = ampsPerVolt
+        self.maxRate = maxRate
+        self.offset = OffsetEstimator(0.0 if offset is None else offset, alpha)
+        self._calibrated = offset is not None
+        self.onStep = onStep
+        self.missedCommands = 0
+        self._stop = threading.Event()
+
+    def _volts_per_second(self, rate):
+        rate = min(abs(rate), self.maxRate)
+        return rate / 1000 / self.ampsPerVolt
+
+    def duration(self):
+        """
+        :return: Planned length of the profile in seconds
+        """
+        total = 0
+        level = 0.0
+        for segment in self.profile:
+            if isinstance(segment, Soak):
+                total += segment.duration
+            else:
+                total += abs(segment.target - level) / self._volts_per_second(segment.rate)
+                level = segment.target
+        return total
+
+    def calibrate_offset(self, samples=10, settle=3):
+        """
+        Command MOUT 0, let the output settle, then average a batch of OMON? readings as the starting offset.
+        :return: Offset in V
+        """
+        self.sim960.command("MOUT 0")
+        time.sleep(settle)
+        with self.sim960.queue.batch() as q:
+            replies = [q.query("OMON?") for _ in range(samples)]
+        readings = [float(r.result()) for r in replies if r.exception() is None]
+        if not readings:
+            raise TimeoutError("No OMON? readings during offset calibration")
+        self.offset.value = max(round(sum(readings) / len(readings), 3), 0)
+        self._calibrated = True
+        log.info(f"Initial offset = {self.offset.value} V")
+        return self.offset.value
+
+    def _tick(self, setpoint):
+        """
+        Command one setpoint and update the offset estimate from the readback, all in one pipelined batch.
+        :return: (mout, moutReadback, omon). Readbacks are None if they did not arrive
+        """
+        mout = round(min(setpoint - self.offset.value, MAX_OUTPUT), 3)
+        with self.sim960.queue.batch() as q:
+            q.command(f"MOUT {mout}")
+            moutReply = q.query("MOUT?")
+            omonReply = q.query("OMON?")
+
+        try:
+            moutReadback = round(float(moutReply.result()), 3)
+            omon = round(float(omonReply.result()), 3)
+        except (TimeoutError, ValueError) as e:
+            self.missedCommands += 1
+            log.warning(f"No readback for MOUT {mout} ({e})")
+            return mout, None, None
+
+        if moutReadback != mout:
+            self.missedCommands += 1
+            log.warning(f"MOUT readback {moutReadback} V does not match commanded {mout} V")
+        self.offset.update(moutReadback, omon)
+        return mout, moutReadback, omon
+
+    def run(self):
+        """
+        Play the profile back. Blocks until it is finished or stop() is called.
+        :return: Output voltage the ramp ended at
+        """
+        if self.sim960.query("AMAN?") != "0":
+            self.sim960.command("AMAN 0")
+        if not self._calibrated:
+            self.calibrate_offset()
+
+        self._stop.clear()
+        level = 0.0
+        start = time.monotonic()
+        deadline = start
+        log.info(f"Starting ramp, planned length {self.duration():.0f} s")
+
+        for segment in self.profile:
+            segmentStart = time.monotonic()
+            if isinstance(segment, Soak):
+                mode, endLevel, rate = 'soak', level, 0.0
+            else:
+                rate = self._volts_per_second(segment.rate)
+                mode = 'up' if segment.target >= level else 'down'
+                endLevel = segment.target
+            log.info(f"Starting {segment}")
+
+            setpoint = level
+            lastCommand = segmentStart
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if mode == 'soak':
+                    finished = now - segmentStart >= segment.duration
+                else:
+                    # At most one period's worth of ramp per command, however long the last tick took
+                    step = rate * min(now - lastCommand, self.period)
+                    setpoint = min(setpoint + step, endLevel) if mode == 'up' else max(setpoint - step, endLevel)
+                    finished = setpoint == endLevel
+                lastCommand = now
+                mout, moutReadback, omon = self._tick(setpoint)
+                if self.onStep is not None:
+                    self.onStep(RampStep(time.time(), time.monotonic() - start, mode, round(setpoint, 4), mout,
+                                         moutReadback, omon, round(self.offset.value, 4)))
+                if finished:
+                    break
+                deadline = max(deadline + self.period, time.monotonic())
+                self._stop.wait(deadline - time.monotonic())
+
+            if self._stop.is_set():
+                log.warning(f"Ramp stopped during {segment} at {setpoint:.3f} V")
+                return setpoint
+            level = endLevel
+
+        log.info(f"Ramp finished in {time.monotonic() - start:.1f} s ({self.missedCommands} missed commands)")
+        return level
+
+    def stop(self):
+        """
+        Stop the ramp from another thread. The output is left where it is.
+        :return: None
+        """
+        self._stop.set()
@@ -0,0 +1,133 @@
+"""
+Streaming recorder for RampEngine steps. Every step is appended to a binary file as one fixed-width record, and the
+file is flushed every flushInterval seconds. A crash mid-ramp therefore loses at most that much data. Memory use and
+the time per step stay constant however long the soak is. The per-mode bookkeeping (steps and seconds spent in each
+mode, and the length of the current run) is kept in counters, so nothing rescans earlier steps.
+
+The file is a short text header followed by records of RECORD_DTYPE. Read it back with load(), or convert it to the
+old ramp_data.txt layout with export_text().
+"""
+
+import logging
+import os
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"PICTUREC-RAMP 1\n"
+MODES = ('up', 'soak', 'down')
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('elapsed', '<f8'), ('mode', 'u1'), ('setpoint', '<f4'), ('mout', '<f4'),
+                         ('moutReadback', '<f4'), ('omon', '<f4'), ('offset', '<f4')])
+
+
+class RampRecorder(object):
+    def __init__(self, path, flushInterval=5.0, append=True):
+        """
+        :param path: File to write records to. Created (with its header) if it does not exist
+        :param flushInterval: Seconds between flushes to disk
+        :param append: If False, start the file over instead of adding to an earlier recording
+        """
+        self.path = path
+        self.flushInterval = flushInterval
+        new = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab' if append else 'wb')
+        if new:
+            self._file.write(MAGIC)
+        self._record = np.zeros(1, dtype=RECORD_DTYPE)
+        self._lastFlush = time.monotonic()
+
+        self.steps = 0
+        self.stepsInMode = dict.fromkeys(MODES, 0)
+        self.secondsInMode = dict.fromkeys(MODES, 0.0)
+        self.mode = None
+        self.modeSteps = 0
+        self.modeStart = None
+        self._lastElapsed = None
+
+    def __call__(self, step):
+        self.record(step)
+
+    def record(self, step):
+        """
+        Append one RampStep. Usable directly as RampEngine's onStep.
+        :return: None
+        """
+        r = self._record[0]
+        r['time'] = step.time
+        r['elapsed'] = step.elapsed
+        r['mode'] = MODES.index(step.mode)
+        r['setpoint'] = step.setpoint
+        r['mout'] = step.mout
+        r['moutReadback'] = np.nan if step.moutReadback is None else step.moutReadback
+        r['omon'] = np.nan if step.omon is None else step.omon
+        r['offset'] = step.offset
+        self._file.write(self._record.tobytes())
+
+        if step.mode != self.mode:
+            self.mode = step.mode
+            self.modeSteps = 0
+            self.modeStart = step.elapsed
+        self.modeSteps += 1
+        self.steps += 1
+        self.stepsInMode[step.mode] += 1
+        if self._lastElapsed is not None:
+            self.secondsInMode[step.mode] += step.elapsed - self._lastElapsed
+        self._lastElapsed = step.elapsed
+
+        if time.monotonic() - self._lastFlush >= self.flushInterval:
+            self.flush()
+
+    def mode_duration(self):
+        """
+        :return: Seconds spent in the current mode so far
+        """
+        return 0.0 if self.modeStart is None else self._lastElapsed - self.modeStart
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lastFlush = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+            log.info(f"Recorded {self.steps} ramp steps to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def load(path):
+    """
+    :return: Structured array of RECORD_DTYPE with every complete record in the file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a ramp recording")
+        data = f.read()
+    n = len(data) // RECORD_DTYPE.itemsize
+    return np.frombuffer(data, dtype=RECORD_DTYPE, count=n)
+
+
+def export_text(path, textPath, chunk=100000):
+    """
+    Write a recording out in the old ramp_data.txt layout (time, setpoint, output, step number), a chunk at a time.
+    :return: None
+    """
+    n = (os.path.getsize(path) - len(MAGIC)) // RECORD_DTYPE.itemsize
+    with open(textPath, 'w') as f:
+        if n <= 0:
+            return
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=len(MAGIC), shape=(n,))
+        for start in range(0, len(records), chunk):
+            block = records[start:start + chunk]
+            data = np.column_stack([block['time'], block['setpoint'], block['omon'],
+                                    np.arange(start, start + len(block))])
+            np.savetxt(f, data, fmt="%14.8f")
@@ -0,0 +1,194 @@
+"""
+Base class for the PICTURE-C serial instruments (SIM921, SIM960, LS240, SIM900). Holds the connect / command / query /
+buffer handling that each instrument class used to carry its own copy of.
+
+An instrument either owns its own serial port, looked up by USB VID/PID (and serial number) in the shared
+DeviceRegistry on connect(), or talks through a link to a slot
+in a SIM900 mainframe (see SIM900.py). In the second case it never opens a port of its own. Every write and read is
+routed through the link, and the mainframe makes sure the right slot is selected. Either way, self.lock is held for
+each complete transaction (a query and its reply, or a whole CommandQueue batch). Threads that share the instrument,
+or the mainframe, therefore never interleave their traffic.
+"""
+
+import threading
+from time import monotonic, sleep
+
+import serial
+
+import custom_logging
+from commandQueue import CommandQueue
+from deviceRegistry import get_registry
+
+
+class SerialInstrument(serial.Serial):
+    # Name used in log messages
+    instrument = "Instrument"
+    # (vid, pid) pairs of the USB-serial adapter the instrument is found behind
+    VALID_IDS = []
+    # Seconds the instrument needs after a command before it will reliably accept the next one
+    SETTLE_TIMES = {}
+    # Extra advice logged when the instrument cannot be found
+    CONNECT_HINT = ""
+
+    def __init__(self, serial_params, link=None, serialNumber=None):
+        """
+        :param serial_params: Keyword arguments for serial.Serial (baudrate, timeout, ...)
+        :param link: SIM900Link to talk through instead of opening a port. None to use a port of our own
+        :param serialNumber: USB serial number of the instrument's adapter. Needed to tell apart instruments that sit
+        behind the same kind of adapter, e.g. a standalone SIM921 and SIM960
+        """
+        self.setUpLog()
+        super(SerialInstrument, self).__init__(port=None, **serial_params)
+        self.link = link
+        self.serialNumber = serialNumber
+        self.lock = link if link is not None else threading.RLock()
+        self.queue = CommandQueue(self._write, self._readline, settle=self.SETTLE_TIMES, lock=self.lock,
+                                  discard=self.drainInput)
+        self.isConnected = False
+        self.idn = None
+
+    def _write(self, data):
+        if self.link is not None:
+            with self.link:
+                self.link.write(data)
+        else:
+            self.write(data)
+
+    def _readline(self):
+        if self.link is not None:
+            with self.link:
+                return self.link.readline()
+        return self.readline()
+
+    def _find_port(self):
+        """
+        :return: Device name of the port whose VID/PID is in VALID_IDS (and serial number matches, if given), or None
+        """
+        return get_registry().find(self.VALID_IDS, self.serialNumber)
+
+    def connect(self, initialize=True):
+        """
+        Open the instrument's port (or the mainframe it sits in), clear the buffers, run initialize() and read the
+        identification string.
+        :param initialize: False to skip initialize() and leave the instrument configured as it is, e.g. to take over
+        a SIM960 that is holding the magnet current without resetting it
+        :return: None
+        """
+        self.log.debug("Attempting to connect to %s", self.instrument)
+
+        if self.link is not None:
+            if not self.link.open():
+                self.log.error("Cannot reach the mainframe %s is installed in", self.instrument)
+                return
+        else:
+            device = self._find_port()
+            if device is None:
+                self.log.error("Cannot find %s. Make sure %s is connected and powered on. %s", self.instrument,
+                               self.instrument, self.CONNECT_HINT)
+                return
+            self.port = device
+            try:
+                self.open()
+            except serial.SerialException:
+                get_registry().forget(device)
+                raise
+
+        self.isConnected = True
+        self.clearBuffers()
+        if initialize:
+            self.initialize()
+        self.idn = self.query("*IDN?")
+        self.log.info("%s connected", self.instrument)
+
+    def initialize(self):
+        """
+        Put the instrument into its operating configuration after connecting. Nothing to do by default
+        :return: None
+        """
+        pass
+
+    def disconnect(self):
+        """
+        Manually disconnect from the instrument. An instrument in a mainframe only lets go of its slot, the mainframe
+        port stays open for the other modules.
+        :return: None
+        """
+        if self.link is None:
+            self.close()
+        self.isConnected = False
+        self.log.debug("%s disconnected", self.instrument)
+
+    def clearBuffers(self):
+        """
+        Clears data buffers to prevent messages that were sent/received that weren't processed properly from messing up
+        the data stream
+        :return: None
+        """
+        with self.lock:
+            port = self.link.mainframe if self.link is not None else self
+            port.reset_input_buffer()
+            port.reset_output_buffer()
+            self.log.debug("Buffers cleared")
+            sleep(.1)
+
+    def drainInput(self, quiet=0.5, limit=5):
+        """
+        Throw away input until the line has been quiet for `quiet` seconds, e.g. after a reply timed out, so that a
+        late reply is not read as the answer to the next query
+        :param limit: Most seconds to spend draining a device that keeps talking
+        :return: None
+        """
+        with self.lock:
+            port = self.link.mainframe if self.link is not None else self
+            deadline = monotonic() + limit
+            port.reset_input_buffer()
+            while monotonic() < deadline:
+                sleep(quiet)
+                if not port.in_waiting:
+                    break
+                port.reset_input_buffer()
+            self.log.debug("Input drained")
+
+    def command(self, command):
+        """
+        Writes command to the instrument and encodes it to utf-8 so the device can interpret it
+        :param: Command must be a str. Commands for this device can be found in the manual
+        :return: None
+        """
+        if self.isConnected:
+            cmd_str = str(command)+"\n"
+            self._write(cmd_str.encode('utf-8'))
+            self.log.debug("Command '%s' sent", command)
+        else:
+            self.log.error("Cannot write command! %s is not connected!", self.instrument)
+
+    def query(self, command):
+        """
+        Writes command to the instrument and listens for an answer. Used for specific situations where a response is
+        desired
+        :param: Same as command function, str or str-like
+        :return: Response to query with end characters stripped
+        """
+        if self.isConnected:
+            with self.lock:
+                self.command(command)
+                response = self._readline().decode('ascii').rstrip('\r\n')
+                if not response:
+                    # Don't let the reply turn up late as the answer to the next query
+                    self.drainInput()
+            if response:
+                self.log.debug("Query for '%s' returned", command)
+            else:
+                self.log.error("No response from %s", self.instrument)
+            return response
+        else:
+            self.log.error("Query failed! %s is not connected!", self.instrument)
+            return 0
+
+    def setUpLog(self):
+        """
+        Log through the process-wide queue listener (see custom_logging), which writes to the shell and to
+        ~/instruments.log without blocking the caller
+        :return: None
+        """
+        self.log = custom_logging.get_logger(type(self).__module__)
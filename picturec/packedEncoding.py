@@ -0,0 +1,120 @@
+"""
+Compact encoding for Redis stream entries. A plain entry stores one string field/value pair per channel, e.g.
+{'1': '-0.52', '2': '1.23', ...}. A packed entry stores just two fields: the ID of a registered schema and a single
+blob of little-endian float32 values in the schema's channel order:
+
+    {'sid': 1, 'v': b'<15 x float32>'}
+
+The writers pack, and every reader goes through decode(), which accepts packed and plain entries alike. Existing
+history and packed history can therefore share a stream. Channels missing from a reading are stored as NaN.
+
+Schema IDs are stored in Redis, so once an ID is in use, never change its channel list. Register a new ID instead.
+"""
+
+import math
+import struct
+
+SCHEMA_FIELD = 'sid'
+VALUES_FIELD = 'v'
+
+SCHEMAS = {}
+
+
+class Schema(object):
+    def __init__(self, schemaId, channels):
+        """
+        :param schemaId: Small integer stored with every entry
+        :param channels: Channel names in the order their values are packed
+        """
+        self.id = schemaId
+        self.channels = tuple(str(c) for c in channels)
+        self.index = {c: i for i, c in enumerate(self.channels)}
+        self.struct = struct.Struct(f"<{len(self.channels)}f")
+
+    def __len__(self):
+        return len(self.channels)
+
+
+def register(schemaId, channels):
+    """
+    Add a schema to the registry shared by all writers and readers.
+    :return: The registered Schema
+    """
+    schema = Schema(schemaId, channels)
+    existing = SCHEMAS.get(schemaId)
+    if existing is not None and existing.channels != schema.channels:
+        raise ValueError(f"Schema {schemaId} is already registered with channels {existing.channels}")
+    SCHEMAS[schemaId] = schema
+    return schema
+
+
+HEMT_BIASES = register(1, range(1, 16))
+ONE_WIRE_TEMPS = register(2, range(1, 13))
+SIM921_TEMPERATURE = register(3, ['temperature'])
+SIM960_OUTPUT = register(4, ['omon'])
+LS240_TEMPERATURES = register(5, range(1, 9))
+
+
+def encode_values(schema, values):
+    """
+    :param values: Sequence of floats in schema channel order
+    :return: Packed stream entry fields
+    """
+    return {SCHEMA_FIELD: schema.id, VALUES_FIELD: schema.struct.pack(*values)}
+
+
+def encode(schema, fields):
+    """
+    :param fields: Dict of channel: value (numbers or numeric strings). Unknown channels are ignored
+    :return: Packed stream entry fields
+    """
+    values = [math.nan] * len(schema)
+    for channel, value in fields.items():
+        i = schema.index.get(str(channel))
+        if i is not None:
+            try:
+                values[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+    return encode_values(schema, values)
+
+
+def _get(fields, name):
+    value = fields.get(name)
+    if value is None:
+        value = fields.get(name.encode('ascii'))
+    return value
+
+
+def decode_values(fields):
+    """
+    :param fields: Stream entry fields as returned by redis-py (bytes keys) or as built by encode (str keys)
+    :return: (Schema, tuple of floats) for a packed entry, or None if the entry is not packed
+    """
+    schemaId = _get(fields, SCHEMA_FIELD)
+    if schemaId is None:
+        return None
+    schema = SCHEMAS[int(schemaId)]
+    return schema, schema.struct.unpack(_get(fields, VALUES_FIELD))
+
+
+def decode(fields):
+    """
+    Decode either kind of entry into a dict of channel: float. Channels stored as NaN (packed) or with non-numeric
+    values (plain) are left out.
+    :param fields: Stream entry fields, packed or plain
+    :return: Dict of channel name (str): value (float)
+    """
+    packed = decode_values(fields)
+    if packed is not None:
+        schema, values = packed
+        return {c: v for c, v in zip(schema.channels, values) if v == v}
+
+    decoded = {}
+    for channel, value in fields.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        decoded[channel.decode('utf-8') if isinstance(channel, bytes) else channel] = value
+    return decoded
@@ -0,0 +1,281 @@
+"""
+Producer/consumer pipeline that keeps serial acquisition apart from processing. One PortReader thread per serial
+port does nothing but read, split the bytes into frames and stamp each frame with its arrival time. The frames go
+into a bounded queue. Worker stages, one thread each, take items from their input queue, transform them (parse,
+calibrate, publish...) and pass the result on to the next stage's queue. A slow Redis call or log flush in a later
+stage then only makes a queue grow. The next read still happens on time, and the frame timestamps stay true.
+
+Every queue has a size limit and a policy for when it is full:
+    BLOCK        the producer waits for room. Nothing is lost, but the wait travels back upstream
+    DROP_OLDEST  the oldest waiting item is thrown away and counted. The producer never waits
+
+Each queue and stage reports to the metrics registry, labelled with the pipeline and stage name: queue depth, items
+dropped, time producers spent blocked, time items waited in the queue, per-item processing time, items processed,
+and errors.
+
+    pipe = Pipeline('hemttemp')
+    pipe.add_stage('parse', parse)
+    pipe.add_stage('publish', publish)
+    pipe.add_reader(port, FrameDecoder())
+    pipe.start()
+"""
+
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+import serial
+
+import metrics
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+POLICIES = (BLOCK, DROP_OLDEST)
+# Longest a PortReader's read may block, so that it notices stop() even on a port opened with timeout=None
+READ_TIMEOUT = 0.5
+
+log = logging.getLogger(__name__)
+
+# A frame as it came off a port: arrival time (time.time()), port name and whatever the decoder returned
+RawFrame = namedtuple('RawFrame', ['time', 'port', 'frame'])
+
+
+class Closed(Exception):
+    """
+    Raised by BoundedQueue.get() once the queue is closed and empty
+    """
+    pass
+
+
+class BoundedQueue(object):
+    def __init__(self, maxsize, policy=BLOCK, labels=None):
+        """
+        :param maxsize: Most items held
+        :param policy: BLOCK or DROP_OLDEST, what put() does when the queue is full
+        :param labels: Metric labels, e.g. {'pipeline': 'hemttemp', 'stage': 'parse'}
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, use one of {POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+        labels = labels or {}
+        self._depth = metrics.REGISTRY.gauge('pipeline_queue_depth', "Items waiting in a pipeline queue", labels,
+                                             fn=self.__len__)
+        self._dropped = metrics.REGISTRY.counter('pipeline_queue_dropped_total', "Items dropped from a full queue",
+                                                 labels)
+        self._blocked = metrics.REGISTRY.histogram('pipeline_queue_blocked_seconds',
+                                                   "Time a producer waited for room in a full queue", labels)
+        self._waited = metrics.REGISTRY.histogram('pipeline_queue_wait_seconds', "Time an item spent in a queue",
+                                                  labels)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Add an item, applying the queue's policy if it is full. Items put after close() are discarded.
+        :return: None
+        """
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    self._dropped.inc()
+                else:
+                    start = time.perf_counter()
+                    self._cond.wait_for(lambda: len(self._items) < self.maxsize or self._closed)
+                    self._blocked.observe(time.perf_counter() - start)
+                    if self._closed:
+                        return
+            self._items.append((time.perf_counter(), item))
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for an item, None to wait as long as it takes
+        :return: The oldest item, or None if the timeout passed
+        :raises Closed: If the queue was closed and everything in it has been taken
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._closed, timeout):
+                return None
+            if not self._items:
+                raise Closed()
+            queuedAt, item = self._items.popleft()
+            self._cond.notify_all()
+        self._waited.observe(time.perf_counter() - queuedAt)
+        return item
+
+    def close(self):
+        """
+        Stop accepting items. Consumers still get what is already queued, then Closed
+        :return: None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class PortReader(threading.Thread):
+    def __init__(self, port, decoder, outbox, name=None):
+        """
+        Reads a serial port in its own thread and puts every decoded frame on outbox as a RawFrame.
+        :param port: Open serial.Serial (or anything with in_waiting and read(n)). A port with timeout=None is given
+        READ_TIMEOUT instead, since a read that never returns would keep stop() from ever finishing
+        :param decoder: Object with feed(bytes) returning a list of frames, e.g. arduinoFraming.FrameDecoder
+        :param outbox: BoundedQueue for the frames. A Pipeline sets this when it starts
+        """
+        self.portName = name or getattr(port, 'port', None) or str(port)
+        super(PortReader, self).__init__(name=f"reader-{self.portName}", daemon=True)
+        if getattr(port, 'timeout', 0) is None:
+            port.timeout = READ_TIMEOUT
+        self.port = port
+        self.decoder = decoder
+        self.outbox = outbox
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            try:
+                chunk = self.port.read(self.port.in_waiting or 1)
+            except serial.SerialException as e:
+                log.error(f"Reading {self.portName} failed: {e}")
+                self.error = e
+                return
+            if not chunk:
+                continue
+            arrival = time.time()
+            for frame in self.decoder.feed(chunk):
+                self.outbox.put(RawFrame(arrival, self.portName, frame))
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class Stage(threading.Thread):
+    def __init__(self, name, fn, inbox, outbox=None, labels=None):
+        """
+        Worker thread that applies fn to each item from inbox and puts the result on outbox.
+        :param fn: Callable taking one item. It returns the item for the next stage, or None to pass nothing on.
+        An exception is logged and counted, and the item is skipped
+        :param outbox: BoundedQueue for the results, None for the last stage
+        """
+        super(Stage, self).__init__(name=f"stage-{name}", daemon=True)
+        self.stageName = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        labels = labels or {}
+        self._seconds = metrics.REGISTRY.histogram('pipeline_stage_seconds', "Time a stage spent on one item", labels)
+        self._items = metrics.REGISTRY.counter('pipeline_stage_items_total', "Items a stage has processed", labels)
+        self._errors = metrics.REGISTRY.counter('pipeline_stage_errors_total', "Items a stage failed on", labels)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.inbox.get()
+                except Closed:
+                    return
+                start = time.perf_counter()
+                try:
+                    result = self.fn(item)
+                except Exception:
+                    self._errors.inc()
+                    log.exception(f"Stage {self.stageName} failed on {item!r}")
+                    continue
+                finally:
+                    self._seconds.observe(time.perf_counter() - start)
+                self._items.inc()
+                if result is not None and self.outbox is not None:
+                    self.outbox.put(result)
+        finally:
+            if self.outbox is not None:
+                self.outbox.close()
+
+
+class Pipeline(object):
+    def __init__(self, name):
+        """
+        Readers feed the first stage's queue, and stages are chained in the order they are added.
+        :param name: Used in thread names and metric labels
+        """
+        self.name = name
+        self.readers = []
+        self.stages = []
+
+    @property
+    def source(self):
+        """
+        :return: The queue the readers put frames on (the first stage's input)
+        """
+        return self.stages[0].inbox
+
+    def add_reader(self, port, decoder, name=None):
+        """
+        Read port in its own thread, with its own decoder, into the first stage's queue
+        :return: The PortReader
+        """
+        reader = PortReader(port, decoder, None, name=name)
+        self.readers.append(reader)
+        return reader
+
+    def add_stage(self, name, fn, maxsize=1000, policy=None):
+        """
+        Append a worker stage that takes the previous stage's results (or, for the first stage, the readers' frames)
+        :param maxsize: Size of the stage's input queue
+        :param policy: Policy of that queue. Defaults to DROP_OLDEST for the first stage, so the readers never wait,
+        and to BLOCK for the others
+        :return: The Stage
+        """
+        if policy is None:
+            policy = BLOCK if self.stages else DROP_OLDEST
+        inbox = BoundedQueue(maxsize, policy, labels={'pipeline': self.name, 'stage': name})
+        stage = Stage(name, fn, inbox, labels={'pipeline': self.name, 'stage': name})
+        if self.stages:
+            self.stages[-1].outbox = inbox
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        """
+        Start the stages, then the readers
+        :return: None
+        """
+        for stage in self.stages:
+            stage.start()
+        for reader in self.readers:
+            reader.outbox = self.source
+            reader.start()
+
+    @property
+    def failed(self):
+        """
+        :return: The first reader error (e.g. a port that was unplugged), or None
+        """
+        for reader in self.readers:
+            if reader.error is not None:
+                return reader.error
+        return None
+
+    def stop(self):
+        """
+        Stop the readers, then let each stage finish what is queued for it before the next one is closed
+        :return: None
+        """
+        for reader in self.readers:
+            if reader.is_alive():
+                reader.stop()
+        self.source.close()
+        for stage in self.stages:
+            stage.join()
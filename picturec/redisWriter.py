@@ -0,0 +1,224 @@
+"""
+Write-behind buffer for the Redis time series streams. Agents add() readings and return straight to polling. Readings
+from every stream are collected and sent to Redis as one pipelined batch of XADDs. A flush happens when maxBatch
+readings are waiting or when the oldest has waited maxDelay seconds. The buffer is capped at maxPending readings. If
+Redis is unreachable long enough to fill it, the oldest readings are dropped and the drop is logged. Streams with a
+maxlen in their RetentionPolicy are trimmed (approximately) as part of each XADD. If a RollupEngine is attached as
+writer.rollups, every reading is also folded into its rollups as it is added. Streams given a packedEncoding
+Schema are stored packed (schema ID plus a float32 blob) rather than as one string pair per channel.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+import redis
+
+import metrics
+import packedEncoding
+
+log = logging.getLogger(__name__)
+
+FLUSH_SECONDS = metrics.REGISTRY.histogram('redis_flush_seconds', "Time to write one pipelined batch to Redis")
+WRITTEN = metrics.REGISTRY.counter('redis_entries_written_total', "Stream entries written to Redis")
+FAILED = metrics.REGISTRY.counter('redis_entries_failed_total', "Stream entries Redis rejected")
+DROPPED = metrics.REGISTRY.counter('redis_entries_dropped_total', "Readings dropped because the write buffer was full")
+
+
+class BufferedStreamWriter(object):
+    def __init__(self, redis, maxBatch=50, maxDelay=1.0, maxPending=10000, retention=None, schemas=None):
+        """
+        :param redis: redis.Redis (or walrus.Walrus) client to write through
+        :param maxBatch: Flush as soon as this many readings are waiting
+        :param maxDelay: Flush once the oldest waiting reading is this many seconds old
+        :param maxPending: Most readings held while Redis is unavailable. Older readings are dropped beyond this
+        :param retention: Dict of stream key: RetentionPolicy. Only the maxlen is used here
+        :param schemas: Dict of stream key: packedEncoding.Schema for streams to store packed
+        """
+        self.redis = redis
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.maxPending = maxPending
+        self.maxlens = {key: policy.maxlen for key, policy in (retention or {}).items() if policy.maxlen}
+        self.schemas = schemas or {}
+        self.rollups = None
+        self.dropped = 0
+
+        self._pending = deque()
+        self._oldest = None
+        self._retryAfter = 0
+        self._lastIds = {}
+        self._unreportedDrops = 0
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        metrics.REGISTRY.gauge('redis_write_pending', "Readings waiting in the write buffer", fn=self.__len__)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _next_id(self, key, timestamp):
+        """
+        Build an explicit 'milliseconds-sequence' stream ID that keeps increasing per stream, even for readings
+        that fall within the same millisecond
+        """
+        ms = int(timestamp * 1000)
+        lastMs, lastSeq = self._lastIds.get(key, (-1, 0))
+        if ms <= lastMs:
+            ms, seq = lastMs, lastSeq + 1
+        else:
+            seq = 0
+        self._lastIds[key] = (ms, seq)
+        return f"{ms}-{seq}"
+
+    def _trim(self):
+        # Must be called with self._lock held
+        excess = len(self._pending) - self.maxPending
+        for _ in range(excess):
+            self._pending.popleft()
+        if excess > 0:
+            DROPPED.inc(excess)
+            self.dropped += excess
+            self._unreportedDrops += excess
+
+    def add(self, key, fields, timestamp=None):
+        """
+        Queue a reading for the stream at key. Flushes in the caller's thread if a threshold has been reached.
+        :param key: Redis stream key, e.g. 'hemt_biases'
+        :param fields: Dict of field: value for the stream entry
+        :param timestamp: Unix time of the reading. Defaults to now
+        :return: None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.rollups is not None:
+            self.rollups.update(key, fields, timestamp)
+        schema = self.schemas.get(key)
+        if schema is not None:
+            fields = packedEncoding.encode(schema, fields)
+
+        with self._lock:
+            self._pending.append((key, self._next_id(key, timestamp), fields))
+            self._trim()
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            now = time.monotonic()
+            due = len(self._pending) >= self.maxBatch or now - self._oldest >= self.maxDelay
+
+        if due and now >= self._retryAfter:
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything that is waiting to Redis in one pipeline round trip. If the pipeline fails as a whole (connection
+        lost, timeout or any other RedisError) the readings are put back at the front of the buffer to be retried on
+        the next flush.
+        :return: Number of readings written
+        """
+        with self._flushLock:
+            with self._lock:
+                batch = list(self._pending)
+                self._pending.clear()
+                self._oldest = None
+            if not batch:
+                return 0
+
+            pipe = self.redis.pipeline(transaction=False)
+            for key, entryId, fields in batch:
+                pipe.xadd(key, fields, id=entryId, maxlen=self.maxlens.get(key), approximate=True)
+
+            try:
+                with FLUSH_SECONDS.time():
+                    results = pipe.execute(raise_on_error=False)
+            except redis.exceptions.RedisError as e:
+                log.error(f"Redis write failed, holding {len(batch)} readings for retry: {type(e).__name__}: {e}")
+                with self._lock:
+                    self._pending.extendleft(reversed(batch))
+                    self._trim()
+                    self._oldest = time.monotonic()
+                # Don't hammer a dead server from every add(), leave retries to the next maxDelay
+                self._retryAfter = time.monotonic() + self.maxDelay
+                results = []
+                batch = []
+
+            failed = [r for r in self._resequence(batch, results) if isinstance(r, Exception)]
+            WRITTEN.inc(len(batch) - len(failed))
+            if failed:
+                FAILED.inc(len(failed))
+                log.error(f"{len(failed)} of {len(batch)} stream writes failed, e.g.: {failed[0]}")
+
+        if self._unreportedDrops:
+            log.warning(f"Write buffer full, dropped {self._unreportedDrops} oldest readings "
+                        f"({self.dropped} in total)")
+            self._unreportedDrops = 0
+
+        return len(batch) - len(failed)
+
+    def _resequence(self, batch, results):
+        """
+        Retry entries that Redis rejected because their ID was not above the stream's last one, but whose millisecond
+        matches it. That happens after a restart, when _lastIds starts empty, e.g. for a rollup bucket that was
+        flushed partially on shutdown and is written again with the same start time. The entry gets the next sequence
+        number in that millisecond. Entries for an earlier millisecond are really out of order and stay failed.
+        :return: results, with the retried entries' errors replaced by their new IDs
+        """
+        results = list(results)
+        for i, ((key, entryId, fields), result) in enumerate(zip(batch, results)):
+            if not (isinstance(result, redis.exceptions.ResponseError) and 'equal or smaller' in str(result)):
+                continue
+            try:
+                top = self.redis.xrevrange(key, count=1)
+                if not top:
+                    continue
+                topId = top[0][0].decode() if isinstance(top[0][0], bytes) else top[0][0]
+                topMs, topSeq = map(int, topId.split('-'))
+                ms = int(entryId.split('-', 1)[0])
+                if ms != topMs:
+                    continue
+                newId = f"{ms}-{topSeq + 1}"
+                results[i] = self.redis.xadd(key, fields, id=newId, maxlen=self.maxlens.get(key), approximate=True)
+                with self._lock:
+                    if self._lastIds.get(key, (-1, 0)) < (ms, topSeq + 1):
+                        self._lastIds[key] = (ms, topSeq + 1)
+                log.debug(f"Stream {key} already had an entry at {ms} ms, wrote {entryId} as {newId}")
+            except redis.exceptions.RedisError as e:
+                results[i] = e
+        return results
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.maxDelay / 2):
+            now = time.monotonic()
+            with self._lock:
+                due = self._oldest is not None and now - self._oldest >= self.maxDelay
+            if due and now >= self._retryAfter:
+                try:
+                    self.flush()
+                except Exception:
+                    # Keep the thread alive, or maxDelay would never be enforced again
+                    log.exception("Background flush failed")
+
+    def start(self):
+        """
+        Start the background thread that enforces maxDelay when readings are added slowly. Safe to call more than once
+        :return: None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name="redis-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and flush whatever is left, including the open buckets of an attached RollupEngine.
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.rollups is not None:
+            self.rollups.flush()
+        self.flush()
@@ -0,0 +1,164 @@
+"""
+Retention for the Redis time series streams. Without it the streams grow for the whole of a campaign and every RDB
+snapshot (see etc/redis/redis.conf) gets slower and larger.
+
+Each stream can be given a RetentionPolicy:
+ - maxlen: an approximate MAXLEN applied on every XADD by the BufferedStreamWriter. Cheap hard cap on entry count
+ - window: seconds of raw data to keep. The StreamCompactor trims anything older on a background thread, but first
+   folds it into min/mean/max rollups written to a separate '<key>:rollup:<interval>s' stream
+"""
+
+import logging
+import threading
+import time
+
+import redis
+
+import packedEncoding
+
+log = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    def __init__(self, maxlen=None, window=None, rollupInterval=60):
+        """
+        :param maxlen: Approximate cap on the number of raw entries, enforced on each XADD. None for no cap
+        :param window: Seconds of raw data to keep. Older entries are rolled up and trimmed. None to keep everything
+        :param rollupInterval: Bucket width in seconds for the min/mean/max rollups of trimmed data. None to trim
+        without keeping rollups
+        """
+        self.maxlen = maxlen
+        self.window = window
+        self.rollupInterval = rollupInterval
+
+
+def rollup_key(key, interval):
+    """
+    :return: Key of the stream holding the interval-second rollups of the stream at key
+    """
+    return f"{key}:rollup:{interval}s"
+
+
+class StreamCompactor(object):
+    def __init__(self, redis, policies, period=300, pageSize=1000):
+        """
+        :param redis: redis.Redis (or walrus.Walrus) client
+        :param policies: Dict of stream key: RetentionPolicy
+        :param period: Seconds between compaction passes when running in the background
+        :param pageSize: Entries fetched per XRANGE call while rolling up
+        """
+        self.redis = redis
+        self.policies = policies
+        self.period = period
+        self.pageSize = pageSize
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rollup(self, key, cutoffMs, intervalMs):
+        """
+        Fold every entry before cutoffMs into intervalMs-wide buckets, returning [(bucketStartMs, fields), ...] in
+        time order. Non-numeric values are ignored.
+        """
+        buckets = []
+        current = None
+        start = '-'
+
+        while True:
+            entries = self.redis.xrange(key, min=start, max=cutoffMs - 1, count=self.pageSize)
+            for entryId, fields in entries:
+                ms = int(entryId.split(b'-', 1)[0])
+                bucket = ms - ms % intervalMs
+                if current is None or bucket != current[0]:
+                    current = (bucket, {})
+                    buckets.append(current)
+                stats = current[1]
+                for field, value in packedEncoding.decode(fields).items():
+                    s = stats.get(field)
+                    if s is None:
+                        stats[field] = [value, value, value, 1]
+                    else:
+                        s[0] = min(s[0], value)
+                        s[1] = max(s[1], value)
+                        s[2] += value
+                        s[3] += 1
+            if len(entries) < self.pageSize:
+                break
+            start = b'(' + entries[-1][0]
+
+        rollups = []
+        for bucket, stats in buckets:
+            fields = {}
+            for field, (lo, hi, total, n) in stats.items():
+                fields[f"{field}:min"] = lo
+                fields[f"{field}:mean"] = total / n
+                fields[f"{field}:max"] = hi
+            if fields:
+                rollups.append((bucket, fields))
+        return rollups
+
+    def compact(self, key, policy, now=None):
+        """
+        Roll up and trim raw entries of one stream that have fallen out of the policy's window.
+        :return: Number of rollup entries written
+        """
+        if policy.window is None:
+            return 0
+        if now is None:
+            now = time.time()
+
+        cutoffMs = int((now - policy.window) * 1000)
+        rollups = []
+        if policy.rollupInterval:
+            intervalMs = int(policy.rollupInterval * 1000)
+            # Only ever roll up whole buckets, so the partially expired one is left for the next pass
+            cutoffMs -= cutoffMs % intervalMs
+            rollups = self._rollup(key, cutoffMs, intervalMs)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for bucket, fields in rollups:
+            pipe.xadd(rollup_key(key, policy.rollupInterval), fields, id=f"{bucket}-0")
+        pipe.xtrim(key, minid=cutoffMs, approximate=False)
+        results = pipe.execute(raise_on_error=False)
+
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            log.error(f"Compaction of {key} had {len(failed)} failed writes, e.g.: {failed[0]}")
+        else:
+            log.debug(f"Compacted {key}: {len(rollups)} rollups, trimmed {results[-1]} entries")
+        return len(rollups)
+
+    def compact_all(self):
+        """
+        Run one compaction pass over every stream with a policy.
+        :return: None
+        """
+        for key, policy in self.policies.items():
+            try:
+                self.compact(key, policy)
+            except redis.exceptions.RedisError as e:
+                log.error(f"Could not compact {key}: {e}")
+
+    def _loop(self):
+        while not self._stop.wait(self.period):
+            self.compact_all()
+
+    def start(self):
+        """
+        Start compacting in a background thread every period seconds. Safe to call more than once
+        :return: None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="stream-compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread. Any pass in progress is allowed to finish.
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,114 @@
+"""
+Fixed-size multi-channel ring buffer for live monitoring. Rows (e.g. [time, Vg, Id, Vd]) go into a NumPy array
+allocated once. Every row is written twice, at i and i + capacity, so the most recent n rows are always one
+contiguous slice. view() therefore hands readers a plain 2D array (ready for Line2D.set_data, np.mean, ...) without
+copying or np.roll, and append() costs the same however full the buffer is.
+
+A view is not a copy. Rows in it are overwritten once the writer has added capacity more rows after them, so a reader
+on another thread that holds on to a view for longer than that, or needs the values to stay fixed, should use
+snapshot() instead.
+
+    ring = RingBuffer(500, 4)
+    ring.append([t, vg, idrain, vd])
+    recent = ring.view()          # shape (len(ring), 4), oldest row first
+"""
+
+import threading
+
+import numpy as np
+
+
+class RingBuffer(object):
+    def __init__(self, capacity, nChannels, dtype=np.float64):
+        """
+        :param capacity: Most rows held. Older rows are overwritten
+        :param nChannels: Values per row
+        """
+        self.capacity = capacity
+        self.nChannels = nChannels
+        self._data = np.full((2 * capacity, nChannels), np.nan, dtype=dtype)
+        self._next = 0
+        self._count = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def overwritten(self):
+        """
+        :return: Rows that have been pushed out of the buffer since it was created or cleared
+        """
+        return self.total - self._count
+
+    def clear(self):
+        with self._lock:
+            self._next = 0
+            self._count = 0
+            self.total = 0
+
+    def append(self, row):
+        """
+        Add one row of nChannels values.
+        :return: None
+        """
+        with self._lock:
+            i = self._next
+            self._data[i] = row
+            self._data[i + self.capacity] = row
+            self._next = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+            self.total += 1
+
+    def extend(self, rows):
+        """
+        Add a block of rows (shape (n, nChannels)) with at most four slice assignments. Only the last capacity rows
+        of a block longer than the buffer are kept.
+        :return: None
+        """
+        rows = np.asarray(rows, dtype=self._data.dtype).reshape(-1, self.nChannels)
+        n = len(rows)
+        with self._lock:
+            self.total += n
+            if n > self.capacity:
+                rows = rows[-self.capacity:]
+                self._next = (self._next + n - self.capacity) % self.capacity
+                n = self.capacity
+            i = self._next
+            first = min(n, self.capacity - i)
+            for offset in (0, self.capacity):
+                self._data[i + offset:i + offset + first] = rows[:first]
+                self._data[offset:offset + n - first] = rows[first:]
+            self._next = (i + n) % self.capacity
+            self._count = min(self._count + n, self.capacity)
+
+    def view(self, n=None):
+        """
+        :param n: Number of most recent rows. Defaults to all held rows
+        :return: Read-only (n, nChannels) view, oldest row first
+        """
+        with self._lock:
+            n = self._count if n is None else min(n, self._count)
+            start = self._next + self.capacity - n
+            view = self._data[start:start + n]
+        view.flags.writeable = False
+        return view
+
+    def snapshot(self, n=None):
+        """
+        :return: Copy of view(n) that later appends cannot change
+        """
+        with self._lock:
+            n = self._count if n is None else min(n, self._count)
+            start = self._next + self.capacity - n
+            return self._data[start:start + n].copy()
+
+    def latest(self):
+        """
+        :return: Copy of the newest row, or None if the buffer is empty
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            return self._data[self._next + self.capacity - 1].copy()
@@ -0,0 +1,189 @@
+"""
+Multi-resolution rollups of the thermometry and bias streams. The RollupEngine is attached to the
+BufferedStreamWriter. Each reading that passes through add() updates the open 10 s, 1 min and 10 min buckets
+(min, max, mean, count, last) of every channel in place. Each bucket is written once, to '<key>:rollup:<res>s', when
+the first reading of the next bucket arrives, so nothing is ever recomputed from the raw stream. On shutdown,
+flush() writes out the buckets that are still open. Such a bucket only covers the readings seen so far, and after a
+restart the rest of its interval is written as a second entry in the same millisecond (the writer gives it the next
+sequence number, '<start ms>-1'), so readers should expect more than one entry per bucket start.
+
+query() reads history at the coarsest resolution that still gives the requested number of points, so hours of data
+for a dashboard come from a few hundred rollup entries instead of tens of thousands of raw ones. Resolutions whose
+retention window no longer reaches back to the start of the range are skipped, since they have already been trimmed.
+"""
+
+import logging
+import threading
+import time
+
+import packedEncoding
+from retention import RetentionPolicy, rollup_key
+
+RESOLUTIONS = (10, 60, 600)
+# How much of each rollup resolution to keep. None keeps it forever
+ROLLUP_WINDOWS = {10: 14 * 24 * 3600, 60: 90 * 24 * 3600, 600: None}
+
+log = logging.getLogger(__name__)
+
+
+class _Bucket(object):
+    __slots__ = ('start', 'stats')
+
+    def __init__(self, start):
+        self.start = start
+        # channel: [min, max, sum, count, last]
+        self.stats = {}
+
+    def fields(self):
+        fields = {}
+        for channel, (lo, hi, total, n, last) in self.stats.items():
+            fields[f"{channel}:min"] = lo
+            fields[f"{channel}:max"] = hi
+            fields[f"{channel}:mean"] = total / n
+            fields[f"{channel}:count"] = n
+            fields[f"{channel}:last"] = last
+        return fields
+
+
+class RollupEngine(object):
+    def __init__(self, writer, keys, resolutions=RESOLUTIONS):
+        """
+        :param writer: BufferedStreamWriter the finished buckets are written through
+        :param keys: Raw stream keys to roll up. Readings for any other key are ignored
+        :param resolutions: Bucket widths in seconds
+        """
+        self.writer = writer
+        self.keys = set(keys)
+        self.resolutions = tuple(resolutions)
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, fields, timestamp):
+        """
+        Fold one reading into the open bucket of every resolution, writing out any bucket it closes.
+        :param key: Raw stream key the reading was written to
+        :param fields: Dict of channel: value. Non-numeric values are ignored
+        :param timestamp: Unix time of the reading
+        :return: None
+        """
+        if key not in self.keys:
+            return
+
+        values = []
+        for channel, value in fields.items():
+            try:
+                values.append((channel, float(value)))
+            except (TypeError, ValueError):
+                continue
+
+        with self._lock:
+            for res in self.resolutions:
+                start = timestamp - timestamp % res
+                bucket = self._open.get((key, res))
+                if bucket is None or start > bucket.start:
+                    if bucket is not None and bucket.stats:
+                        self.writer.add(rollup_key(key, res), bucket.fields(), timestamp=bucket.start)
+                    bucket = _Bucket(start)
+                    self._open[(key, res)] = bucket
+                elif start < bucket.start:
+                    log.debug(f"Reading for {key} is older than the open {res} s bucket, not rolled up")
+                    continue
+
+                stats = bucket.stats
+                for channel, value in values:
+                    s = stats.get(channel)
+                    if s is None:
+                        stats[channel] = [value, value, value, 1, value]
+                    else:
+                        if value < s[0]:
+                            s[0] = value
+                        if value > s[1]:
+                            s[1] = value
+                        s[2] += value
+                        s[3] += 1
+                        s[4] = value
+
+    def flush(self):
+        """
+        Write out every open bucket that has readings, e.g. before the writer stops, so that up to the widest
+        resolution's worth of aggregates is not lost
+        :return: Number of buckets written
+        """
+        with self._lock:
+            written = 0
+            for (key, res), bucket in self._open.items():
+                if bucket.stats:
+                    self.writer.add(rollup_key(key, res), bucket.fields(), timestamp=bucket.start)
+                    written += 1
+            self._open.clear()
+        return written
+
+
+def rollup_retention(keys, resolutions=RESOLUTIONS):
+    """
+    :return: Dict of rollup stream key: RetentionPolicy for the rollups of every key, using ROLLUP_WINDOWS
+    """
+    return {rollup_key(key, res): RetentionPolicy(window=ROLLUP_WINDOWS.get(res), rollupInterval=None)
+            for key in keys for res in resolutions}
+
+
+def choose_resolution(start, end, points, resolutions=RESOLUTIONS, windows=None, now=None):
+    """
+    :param windows: Dict of resolution (None for the raw stream): seconds of history kept, None to keep everything.
+    Resolutions that are missing keep everything
+    :param now: Unix time the windows are measured back from. Defaults to now
+    :return: The coarsest resolution that still gives at least points buckets between start and end, or None if
+    only the raw stream is fine enough. Resolutions trimmed past start are skipped, and if none of the remaining ones
+    is fine enough, the finest of them is returned
+    """
+    windows = windows or {}
+    if now is None:
+        now = time.time()
+    # Finest first, with None for the raw stream
+    covering = [res for res in [None] + sorted(resolutions)
+                if windows.get(res) is None or now - windows[res] <= start]
+    if not covering:
+        # Everything has been trimmed that far back. The coarsest rollup holds the longest history
+        return max(resolutions)
+    for res in reversed(covering):
+        if res is not None and (end - start) / res >= points:
+            return res
+    return covering[0]
+
+
+def query(redis, key, start, end=None, points=500, resolutions=RESOLUTIONS, pageSize=1000, retention=None):
+    """
+    Read history for a stream at the coarsest resolution that meets the requested point density.
+    :param redis: redis.Redis (or walrus.Walrus) client
+    :param key: Raw stream key, e.g. 'hemt_biases'
+    :param start: Unix time of the start of the range
+    :param end: Unix time of the end of the range. Defaults to now
+    :param points: Minimum number of points wanted across the range
+    :param retention: Dict of stream key: RetentionPolicy, e.g. supervisor.RETENTION. Used to skip streams that have
+    been trimmed past start. The rollups default to ROLLUP_WINDOWS, and the raw stream is assumed to be kept unless
+    its policy is given
+    :return: (resolution, entries). resolution is the bucket width in seconds, or None for raw data. entries is a list
+    of (unix time, {field: float}). Rollup fields are named '<channel>:<min|max|mean|count|last>'
+    """
+    if end is None:
+        end = time.time()
+
+    policies = dict(rollup_retention([key], resolutions), **(retention or {}))
+    windows = {res: policies[rollup_key(key, res)].window for res in resolutions if rollup_key(key, res) in policies}
+    if key in policies:
+        windows[None] = policies[key].window
+    res = choose_resolution(start, end, points, resolutions, windows)
+    streamKey = key if res is None else rollup_key(key, res)
+
+    entries = []
+    lo = int(start * 1000)
+    while True:
+        page = redis.xrange(streamKey, min=lo, max=int(end * 1000), count=pageSize)
+        for entryId, fields in page:
+            t = int(entryId.split(b'-', 1)[0]) / 1000
+            entries.append((t, packedEncoding.decode(fields)))
+        if len(page) < pageSize:
+            break
+        lo = b'(' + page[-1][0]
+
+    return res, entries
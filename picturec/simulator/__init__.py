@@ -0,0 +1,10 @@
+"""
+Pseudo-terminal simulators of the PICTURE-C instruments, for benchmarking and regression testing the agents without
+the cryostat. See __main__.py to run them from the shell.
+"""
+
+from .ptyDevice import Faults, PtyDevice, LineDevice
+from .srsModules import SIM921Sim, SIM960Sim, SIM900Sim
+from .lakeshore import LS240Sim
+from .arduinos import HemtduinoSim, OneWireSim, MagnetduinoSim
+from .replay import ReplayDevice, load_session
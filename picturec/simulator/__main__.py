@@ -0,0 +1,80 @@
+"""
+Start simulated instruments and print the port each one is on. Run from the picturec directory:
+
+    python -m simulator hemtduino sim921 ls240 --latency 0.005 --drop 0.01 --record /tmp/sessions
+    python -m simulator --replay /tmp/sessions/hemtduino.jsonl
+
+sim900 is a mainframe with a SIM921 in slot 1 and a SIM960 in slot 5, the way the PICTURE-C rack is wired.
+With --links, a symlink to each port is made in the given directory (e.g. /tmp/sim/hemtduino). Agents can then be
+pointed at fixed paths.
+"""
+
+import argparse
+import logging
+import os
+import signal
+
+from .ptyDevice import Faults
+from .srsModules import SIM921Sim, SIM960Sim, SIM900Sim
+from .lakeshore import LS240Sim
+from .arduinos import HemtduinoSim, OneWireSim, MagnetduinoSim
+from .replay import ReplayDevice
+
+DEVICES = {'sim921': SIM921Sim, 'sim960': SIM960Sim, 'ls240': LS240Sim, 'hemtduino': HemtduinoSim,
+           'onewire': OneWireSim, 'magnetduino': MagnetduinoSim}
+
+
+def build(name, **kwargs):
+    if name == 'sim900':
+        return SIM900Sim(modules={1: SIM921Sim(), 5: SIM960Sim()}, **kwargs)
+    return DEVICES[name](**kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PICTURE-C instrument simulator")
+    parser.add_argument('devices', nargs='*', choices=sorted(DEVICES) + ['sim900'], help="Devices to simulate")
+    parser.add_argument('--replay', nargs='+', default=[], help="Recorded sessions to replay")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    parser.add_argument('--latency', type=float, default=0.0, help="Response latency in s")
+    parser.add_argument('--no-baud', action='store_true', help="Don't pace replies at the device baud rate")
+    parser.add_argument('--drop', type=float, default=0.0, help="Probability of dropping a reply")
+    parser.add_argument('--garble', type=float, default=0.0, help="Probability of corrupting a reply")
+    parser.add_argument('--stall', type=float, default=0.0, help="Probability of stalling a reply by 2 s")
+    parser.add_argument('--seed', type=int, default=None, help="RNG seed for noise and faults")
+    parser.add_argument('--record', help="Directory to record each device's session to")
+    parser.add_argument('--links', help="Directory to make symlinks to the ports in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s %(levelname)s - %(message)s')
+
+    devices = {}
+    for name in args.devices:
+        kwargs = {'latency': args.latency, 'seed': args.seed}
+        if args.drop or args.garble or args.stall:
+            kwargs['faults'] = Faults(args.drop, args.garble, args.stall, seed=args.seed)
+        if args.no_baud:
+            kwargs['baudrate'] = None
+        if args.record:
+            os.makedirs(args.record, exist_ok=True)
+            kwargs['record'] = os.path.join(args.record, name + '.jsonl')
+        devices[name] = build(name, **kwargs)
+    for path in args.replay:
+        devices['replay-' + os.path.splitext(os.path.basename(path))[0]] = ReplayDevice(path, speed=args.speed)
+
+    for name, device in devices.items():
+        device.start()
+        if args.links:
+            os.makedirs(args.links, exist_ok=True)
+            link = os.path.join(args.links, name)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(device.port, link)
+        print(f"{name}: {device.port}", flush=True)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for device in devices.values():
+            device.stop()
@@ -0,0 +1,202 @@
+"""
+Simulated PICTURE-C Arduinos. They speak the '<command>' / '<reply>' framing of the sketches in arduino/. Replies
+are space separated "pin value " pairs, so a full HEMT reply splits into 31 tokens and a one-wire reply into 25, as
+the hemttemp agent expects. Readings are quantized to the 10-bit ADC like the real boards. The HEMT board also
+answers '<raw>' with a binary frame of raw ADC counts (see arduinoFraming), and '<stream ms>' makes it push
+timestamped frames on its own.
+"""
+
+import binascii
+import struct
+import threading
+import time
+
+from .ptyDevice import PtyDevice
+
+# Commands longer than this are truncated by the sketches' receive buffer
+NUM_CHARS = 64
+
+
+def adc_counts(volts, vref=5.0):
+    """
+    :return: Raw reading of a 10-bit conversion of volts
+    """
+    return min(max(round(volts / vref * 1023), 0), 1023)
+
+
+def adc(volts, vref=5.0):
+    """
+    :return: volts as the Arduino reports it after a 10-bit conversion
+    """
+    return adc_counts(volts, vref) * vref / 1023
+
+
+class FramedDevice(PtyDevice):
+    def __init__(self, **kwargs):
+        super(FramedDevice, self).__init__(**kwargs)
+        self._receiving = False
+        self._command = bytearray()
+
+    def greeting(self):
+        return [b"<Arduino is ready>\r\n"]
+
+    def feed(self, data):
+        replies = []
+        for byte in data:
+            if self._receiving:
+                if byte == ord('>'):
+                    self._receiving = False
+                    self.requests += 1
+                    command = self._command.decode('ascii', 'replace')
+                    reply = self.handle(command)
+                    if reply is not None:
+                        replies.append(reply if isinstance(reply, bytes) else f"<{reply}>".encode('ascii'))
+                elif len(self._command) < NUM_CHARS - 1:
+                    self._command.append(byte)
+            elif byte == ord('<'):
+                self._receiving = True
+                self._command.clear()
+        return replies
+
+    def handle(self, command):
+        """
+        :return: Reply text to frame, bytes to send as they are, or None for no reply
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def pairs(values):
+        return "".join(f"{pin} {value:.2f} " for pin, value in values)
+
+
+class HemtduinoSim(FramedDevice):
+    name = "hemtduino"
+    # Analog pins of each HEMT's (Vg, Id, Vd) as wired on the readout board
+    HEMT_PINS = {1: (13, 14, 15), 2: (10, 11, 12), 3: (7, 8, 9), 4: (4, 5, 6), 5: (1, 2, 3)}
+
+    def __init__(self, gateV=-0.8, drainI=1.2, drainV=2.0, noise=0.01, **kwargs):
+        """
+        :param gateV: Gate voltage of every HEMT in V
+        :param drainI: Drain current readout in V
+        :param drainV: Drain voltage in V
+        :param noise: Standard deviation of each reading in V, before quantization
+        """
+        super(HemtduinoSim, self).__init__(**kwargs)
+        self.bias = {}
+        for vgPin, idPin, vdPin in self.HEMT_PINS.values():
+            self.bias[vgPin], self.bias[idPin], self.bias[vdPin] = gateV, drainI, drainV
+        self.noiseLevel = noise
+        self.seq = 0
+        self._boot = time.monotonic()
+        self._streamThread = None
+        self._streamStop = threading.Event()
+
+    def counts(self, pin):
+        if pin in (1, 4, 7, 10, 13):
+            # Gate voltages are offset by -5 V on the board
+            return adc_counts(self.bias[pin] + 5 + self.noise(self.noiseLevel))
+        return adc_counts(self.bias[pin] + self.noise(self.noiseLevel))
+
+    def read(self, pin):
+        return self.counts(pin) * 5.0 / 1023 - (5 if pin in (1, 4, 7, 10, 13) else 0)
+
+    def raw_frame(self, timestamped=False):
+        counts = [self.counts(pin) for pin in range(1, 16)]
+        if timestamped:
+            millis = int((time.monotonic() - self._boot) * 1000) & 0xFFFFFFFF
+            body = struct.pack('<BBI15H', self.seq, 15 | 0x80, millis, *counts)
+        else:
+            body = struct.pack('<BB15H', self.seq, 15, *counts)
+        self.seq = (self.seq + 1) & 0xFF
+        return b'\xa5' + body + struct.pack('<H', binascii.crc_hqx(body, 0xFFFF))
+
+    def _stream(self, interval):
+        due = time.monotonic()
+        while not self._streamStop.wait(max(due - time.monotonic(), 0)):
+            frame = self.raw_frame(timestamped=True)
+            due += interval
+            if time.monotonic() >= due:
+                # Like the sketch, drop a frame that comes due while the last one is still on the wire
+                due = time.monotonic() + interval
+                continue
+            self.send(frame)
+
+    def stream(self, interval):
+        """
+        Start pushing timestamped frames every interval seconds, or stop if interval is 0
+        """
+        if self._streamThread is not None:
+            self._streamStop.set()
+            self._streamThread.join()
+            self._streamThread = None
+        if interval > 0:
+            self._streamStop.clear()
+            self._streamThread = threading.Thread(target=self._stream, args=(interval,), name=f"sim-{self.name}-stream",
+                                                  daemon=True)
+            self._streamThread.start()
+
+    def stop(self):
+        self.stream(0)
+        super(HemtduinoSim, self).stop()
+
+    def handle(self, command):
+        if command == "raw":
+            return self.raw_frame()
+        if command.startswith("stream"):
+            arg = command[6:].strip()
+            self.stream(int(arg) / 1000 if arg.isdigit() else 0)
+            return None
+        if command in ("all", "hemt"):
+            return self.pairs((pin, self.read(pin)) for pin in range(1, 16))
+        hemt = command[4:] if command.startswith("hemt") else command
+        if hemt.isdigit() and int(hemt) in self.HEMT_PINS:
+            return self.pairs((pin, self.read(pin)) for pin in self.HEMT_PINS[int(hemt)])
+        return f"INVALID COMMAND {command}"
+
+
+class OneWireSim(FramedDevice):
+    name = "onewire"
+
+    def __init__(self, temperatures=None, noise=0.05, **kwargs):
+        """
+        :param temperatures: Dict of sensor position (1-12): temperature in C. Defaults to 20 C everywhere
+        :param noise: Standard deviation of each reading in C
+        """
+        super(OneWireSim, self).__init__(**kwargs)
+        self.temperatures = temperatures or {position: 20.0 for position in range(1, 13)}
+        self.noiseLevel = noise
+
+    def handle(self, command):
+        if command in ("all", "temps"):
+            # The DS18B20s resolve 1/16 C
+            return self.pairs((p, round((t + self.noise(self.noiseLevel)) * 16) / 16)
+                              for p, t in sorted(self.temperatures.items()))
+        return f"INVALID COMMAND {command}"
+
+
+class MagnetduinoSim(FramedDevice):
+    name = "magnetduino"
+    R1 = 11790
+    R2 = 11690
+
+    def __init__(self, current=0.0, noise=0.005, **kwargs):
+        """
+        :param current: Magnet current in A (read back at 1 V/A through a divider)
+        :param noise: Standard deviation of the reading in V
+        """
+        super(MagnetduinoSim, self).__init__(**kwargs)
+        self.current = current
+        self.noiseLevel = noise
+        self.heatSwitch = 'closed'
+
+    def handle(self, command):
+        if command in ("current", "i", "I"):
+            divider = (self.R1 + self.R2) / self.R2
+            return self.pairs([(5, adc((self.current + self.noise(self.noiseLevel)) / divider) * divider)])
+        if command in ("open", "o"):
+            self.heatSwitch = 'open'
+            return ""
+        if command in ("close", "c"):
+            self.heatSwitch = 'closed'
+            return ""
+        return f"INVALID COMMAND {command}"
@@ -0,0 +1,41 @@
+"""
+Simulated LakeShore 240 temperature monitor module (2 or 8 channels).
+"""
+
+from .ptyDevice import LineDevice
+
+
+class LS240Sim(LineDevice):
+    name = "LS240"
+
+    def __init__(self, model=8, enabled=None, temperatures=None, noise=1e-3, baudrate=115200, **kwargs):
+        """
+        :param model: 2 or 8 channels
+        :param enabled: Channels with a sensor configured. Defaults to all of them
+        :param temperatures: Dict of channel: temperature in K. Defaults to a 300 K to 4 K spread over the channels
+        :param noise: Standard deviation of each reading in K
+        """
+        super(LS240Sim, self).__init__(baudrate=baudrate, **kwargs)
+        self.model = model
+        self.enabled = set(range(1, model + 1) if enabled is None else enabled)
+        if temperatures is None:
+            temperatures = {c: 300 - (300 - 4) * (c - 1) / max(model - 1, 1) for c in range(1, model + 1)}
+        self.temperatures = temperatures
+        self.noiseLevel = noise
+
+    def handle(self, line):
+        mnemonic, _, args = line.partition(' ')
+        mnemonic = mnemonic.upper()
+        if mnemonic == '*IDN?':
+            return f"LSCI,MODEL240-{self.model}P,LSA{self.model}0001,1.6"
+        if mnemonic == 'INTYPE?':
+            # sensor type, autorange, range, current reversal, units, enabled
+            return f"1,0,0,0,1,{1 if int(args) in self.enabled else 0}"
+        if mnemonic == 'KRDG?':
+            channel = int(args)
+            if channel not in self.enabled:
+                return "+0.0000"
+            return f"{self.temperatures[channel] + self.noise(self.noiseLevel):+.4f}"
+        if mnemonic.endswith('?'):
+            return "0"
+        return None
@@ -0,0 +1,240 @@
+"""
+Base class for the simulated instruments. Each device owns a pseudo-terminal pair. The agent under test opens
+device.port (the slave side, e.g. /dev/pts/7) exactly as it would open /dev/ttyUSB0, and a background thread serves
+the master side.
+
+Replies are held back by a response latency plus the time the bytes would take on the wire at the configured baud
+rate (10 bits per character for 8N1). Throughput measured against the simulator therefore has the same shape as on
+the real link. Faults can drop, garble or delay replies, and every exchange can be recorded to a JSON lines file for
+later replay (see replay.py).
+"""
+
+import json
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+log = logging.getLogger(__name__)
+
+
+class Faults(object):
+    def __init__(self, dropRate=0.0, garbleRate=0.0, stallRate=0.0, stallTime=2.0, seed=None):
+        """
+        Fault injection settings. Rates are probabilities per reply.
+        :param dropRate: Reply is never sent
+        :param garbleRate: One byte of the reply is replaced with a random printable character
+        :param stallRate: Reply is held back for an extra stallTime seconds (e.g. to trip read timeouts)
+        :param seed: Seed for the fault RNG, to make a faulty run repeatable
+        """
+        self.dropRate = dropRate
+        self.garbleRate = garbleRate
+        self.stallRate = stallRate
+        self.stallTime = stallTime
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.garbled = 0
+        self.stalled = 0
+
+    def apply(self, reply):
+        """
+        :return: (reply, extra delay in seconds). reply is None if it was dropped
+        """
+        if self.dropRate and self.random.random() < self.dropRate:
+            self.dropped += 1
+            return None, 0
+        if self.garbleRate and reply and self.random.random() < self.garbleRate:
+            self.garbled += 1
+            i = self.random.randrange(len(reply))
+            reply = reply[:i] + bytes([self.random.randrange(33, 127)]) + reply[i + 1:]
+        delay = 0
+        if self.stallRate and self.random.random() < self.stallRate:
+            self.stalled += 1
+            delay = self.stallTime
+        return reply, delay
+
+
+class Recorder(object):
+    def __init__(self, path):
+        """
+        Writes every exchange as a JSON line: {"t": seconds since start, "dir": "rx" or "tx", "data": text}. "rx" is
+        what the device received from the host, "tx" what it sent back.
+        """
+        self._file = open(path, 'w')
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def log(self, direction, data):
+        line = json.dumps({'t': round(time.monotonic() - self._start, 6), 'dir': direction,
+                           'data': data.decode('latin-1')})
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PtyDevice(object):
+    # Name used in log messages
+    name = "device"
+
+    def __init__(self, baudrate=9600, latency=0.0, faults=None, record=None, seed=None):
+        """
+        :param baudrate: Simulated line rate, used to pace replies. None to send replies immediately
+        :param latency: Seconds between a complete request arriving and the device starting its reply
+        :param faults: Faults instance, or None for a perfect device
+        :param record: Path of a JSON lines file to record the session to, or None
+        :param seed: Seed for the measurement noise RNG
+        """
+        self.baudrate = baudrate
+        self.latency = latency
+        self.faults = faults
+        self.recorder = Recorder(record) if record else None
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def port(self):
+        """
+        :return: Device path for the agent to open
+        """
+        return os.ttyname(self._slave)
+
+    def wire_time(self, nbytes):
+        """
+        :return: Seconds nbytes take on the wire at the simulated baud rate
+        """
+        return nbytes * 10 / self.baudrate if self.baudrate else 0
+
+    def noise(self, sigma):
+        return self.random.gauss(0, sigma) if sigma else 0
+
+    def feed(self, data):
+        """
+        Handle bytes received from the host.
+        :return: List of replies (bytes) to send back, in order. Faults and pacing apply to each one separately
+        """
+        raise NotImplementedError
+
+    def greeting(self):
+        """
+        :return: List of replies sent when the device starts (e.g. an Arduino's ready message)
+        """
+        return []
+
+    def send(self, reply):
+        """
+        Send reply to the host, paced by the latency and baud rate and subject to faults.
+        :return: None
+        """
+        if not reply:
+            return
+        delay = self.latency
+        if self.faults is not None:
+            reply, extra = self.faults.apply(reply)
+            if reply is None:
+                return
+            delay += extra
+        delay += self.wire_time(len(reply))
+        if delay:
+            time.sleep(delay)
+        if self.recorder is not None:
+            self.recorder.log('tx', reply)
+        os.write(self._master, reply)
+
+    def _serve(self):
+        for reply in self.greeting():
+            self.send(reply)
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            if self.recorder is not None:
+                self.recorder.log('rx', data)
+            # The host's bytes take time to arrive too
+            if self.baudrate:
+                time.sleep(self.wire_time(len(data)))
+            try:
+                for reply in self.feed(data):
+                    self.send(reply)
+            except Exception:
+                log.exception(f"Simulated {self.name} failed to handle {data!r}")
+
+    def start(self):
+        """
+        Open the pty pair and start serving it.
+        :return: self
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name=f"sim-{self.name}", daemon=True)
+        self._thread.start()
+        log.info(f"Simulated {self.name} on {self.port}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class LineDevice(PtyDevice):
+    """
+    Device speaking a newline-terminated ASCII command protocol (the SRS SIM modules and the LakeShore 240). Each
+    command line goes to handle(); any replies are sent back, CRLF terminated.
+    """
+    terminator = b'\r\n'
+
+    def __init__(self, **kwargs):
+        super(LineDevice, self).__init__(**kwargs)
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        replies = []
+        while True:
+            i = self._buffer.find(b'\n')
+            if i < 0:
+                break
+            line = bytes(self._buffer[:i]).decode('ascii', 'replace').strip()
+            del self._buffer[:i + 1]
+            if line:
+                self.requests += 1
+                reply = self.handle(line)
+                if reply is not None:
+                    replies.append(reply.encode('ascii') + self.terminator)
+        return replies
+
+    def handle(self, line):
+        """
+        :param line: One command, whitespace stripped
+        :return: Reply text, or None for commands with no reply
+        """
+        raise NotImplementedError
@@ -0,0 +1,98 @@
+"""
+Replays a session recorded with PtyDevice(record=...). The recording is a script of what the host sent ("rx") and
+what the device answered ("tx"). ReplayDevice waits for the host to send the next recorded request, then plays back
+the answers with their recorded delays. The host's bytes are matched as a stream, so they may arrive in different
+chunks than they did during recording. Bytes that do not match the next recorded request are logged, counted and
+discarded, and the replay keeps waiting for that request.
+"""
+
+import json
+import logging
+import time
+
+from .ptyDevice import PtyDevice
+
+log = logging.getLogger(__name__)
+
+
+def load_session(path):
+    """
+    :return: List of (t, direction, data bytes) from a recording
+    """
+    with open(path) as f:
+        return [(e['t'], e['dir'], e['data'].encode('latin-1')) for e in map(json.loads, f) if e]
+
+
+class ReplayDevice(PtyDevice):
+    name = "replay"
+
+    def __init__(self, session, speed=1.0, loop=False, **kwargs):
+        """
+        :param session: Path of a recording, or a list from load_session()
+        :param speed: Playback speed. 2 replies twice as fast as recorded, 0 replies immediately
+        :param loop: Start the script over once it runs out, e.g. for long load tests
+        """
+        super(ReplayDevice, self).__init__(baudrate=None, **kwargs)
+        self.script = load_session(session) if isinstance(session, str) else list(session)
+        self.speed = speed
+        self.loop = loop
+        self.mismatches = 0
+        self._pos = 0
+        self._received = bytearray()
+        self._lastT = 0.0
+
+    def greeting(self):
+        return self._answers()
+
+    def _answers(self):
+        """
+        Collect the tx entries at the current position.
+        :return: List of (delay, data)
+        """
+        answers = []
+        while self._pos < len(self.script) and self.script[self._pos][1] == 'tx':
+            t, _, data = self.script[self._pos]
+            answers.append((t - self._lastT, data))
+            self._lastT = t
+            self._pos += 1
+        return answers
+
+    def _next_request(self):
+        if self._pos >= len(self.script) and self.loop:
+            self._pos = 0
+            self._lastT = 0.0
+        while self._pos < len(self.script) and self.script[self._pos][1] != 'rx':
+            self._pos += 1
+        return self.script[self._pos] if self._pos < len(self.script) else None
+
+    def feed(self, data):
+        self._received += data
+        answers = []
+        while True:
+            entry = self._next_request()
+            if entry is None:
+                self._received.clear()
+                break
+            t, _, expected = entry
+            if self._received.startswith(expected):
+                del self._received[:len(expected)]
+                self.requests += 1
+                self._lastT = t
+                self._pos += 1
+                answers.extend(self._answers())
+            elif expected.startswith(bytes(self._received)):
+                break
+            else:
+                self.mismatches += 1
+                log.warning(f"Replay expected {expected!r} but got {bytes(self._received)!r}")
+                self._received.clear()
+                break
+        return answers
+
+    def send(self, answer):
+        if not answer:
+            return
+        delay, data = answer
+        if self.speed and delay > 0:
+            time.sleep(delay / self.speed)
+        super(ReplayDevice, self).send(data)
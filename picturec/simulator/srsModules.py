@@ -0,0 +1,151 @@
+"""
+Simulated Stanford Research Systems instruments: the SIM921 resistance bridge, the SIM960 PID controller and the
+SIM900 mainframe they plug into. Only the commands the PICTURE-C code uses are modelled properly. Any other
+"MNEM value" setting is stored and echoed back by "MNEM?", which is enough for the initialize() batches.
+"""
+
+from .ptyDevice import LineDevice
+
+
+class SRSModule(LineDevice):
+    idn = "Stanford_Research_Systems,SIM000,s/n000000,ver1.0"
+
+    def __init__(self, **kwargs):
+        super(SRSModule, self).__init__(**kwargs)
+        self.settings = {}
+
+    def handle(self, line):
+        mnemonic, _, args = line.partition(' ')
+        mnemonic = mnemonic.upper()
+        args = args.strip()
+        if mnemonic == '*IDN?':
+            return self.idn
+        if mnemonic == '*OPC?':
+            return '1'
+        if mnemonic == '*RST':
+            self.reset()
+            return None
+        method = getattr(self, 'cmd_' + mnemonic.rstrip('?').replace('*', ''), None)
+        if method is not None:
+            return method(mnemonic.endswith('?'), args)
+        if mnemonic.endswith('?'):
+            return self.settings.get(mnemonic[:-1], '0')
+        self.settings[mnemonic] = args
+        return None
+
+    def reset(self):
+        self.settings.clear()
+
+
+class SIM921Sim(SRSModule):
+    name = "SIM921"
+    idn = "Stanford_Research_Systems,SIM921,s/n006241,ver3.6"
+
+    def __init__(self, temperature=0.1, resistance=19400.5, noise=1e-5, **kwargs):
+        """
+        :param temperature: Temperature reported by TVAL? in K
+        :param resistance: Resistance reported by RVAL? in Ohms
+        :param noise: Relative standard deviation of the readings
+        """
+        super(SIM921Sim, self).__init__(**kwargs)
+        self.temperature = temperature
+        self.resistance = resistance
+        self.noiseLevel = noise
+        self.curves = {1: ['0', 'PIC-C RX-102A', []], 2: ['0', 'USER', []], 3: ['0', 'USER', []]}
+        self.settings['CURV'] = '1'
+
+    def reset(self):
+        super(SIM921Sim, self).reset()
+        self.settings['CURV'] = '1'
+
+    def cmd_TVAL(self, query, args):
+        return f"{self.temperature * (1 + self.noise(self.noiseLevel)):+.6E}"
+
+    def cmd_RVAL(self, query, args):
+        return f"{self.resistance * (1 + self.noise(self.noiseLevel)):+.6E}"
+
+    def cmd_CINI(self, query, args):
+        parts = [p.strip() for p in args.split(',')]
+        curve = self.curves.setdefault(int(parts[0]), ['0', 'USER', []])
+        if query:
+            return f"{curve[0]},{curve[1]},{len(curve[2])}"
+        curve[0], curve[1], curve[2] = parts[1], parts[2], []
+        return None
+
+    def cmd_CAPT(self, query, args):
+        parts = [p.strip() for p in args.split(',')]
+        points = self.curves[int(parts[0])][2]
+        if query:
+            r, t = points[int(parts[1]) - 1]
+            return f"{r:+.6E},{t:+.6E}"
+        points.append((float(parts[1]), float(parts[2])))
+        return None
+
+
+class SIM960Sim(SRSModule):
+    name = "SIM960"
+    idn = "Stanford_Research_Systems,SIM960,s/n021840,ver2.17"
+
+    def __init__(self, offset=0.05, noise=2e-4, **kwargs):
+        """
+        :param offset: OMON - MOUT in V, the offset the magnet ramp has to track
+        :param noise: Standard deviation of OMON in V
+        """
+        super(SIM960Sim, self).__init__(**kwargs)
+        self.offset = offset
+        self.noiseLevel = noise
+        self.mout = 0.0
+        self.settings['AMAN'] = '0'
+
+    def reset(self):
+        super(SIM960Sim, self).reset()
+        self.mout = 0.0
+        self.settings['AMAN'] = '0'
+
+    def cmd_MOUT(self, query, args):
+        if query:
+            return f"{self.mout:+.3f}"
+        self.mout = max(min(float(args), 10.0), -10.0)
+        return None
+
+    def cmd_OMON(self, query, args):
+        return f"{max(min(self.mout + self.offset + self.noise(self.noiseLevel), 10.0), -10.0):+.6f}"
+
+
+class SIM900Sim(LineDevice):
+    """
+    SIM900 mainframe. 'CONN slot,"escape"' routes every following line to the module in that slot until the escape
+    string is seen. Module replies go straight back to the host.
+    """
+    name = "SIM900"
+    idn = "Stanford_Research_Systems,SIM900,s/n105794,ver3.6"
+
+    def __init__(self, modules=None, **kwargs):
+        """
+        :param modules: Dict of slot number: SRSModule. The modules are not started, the mainframe drives them
+        """
+        super(SIM900Sim, self).__init__(**kwargs)
+        self.modules = modules or {}
+        self.slot = None
+        self.escape = None
+
+    def handle(self, line):
+        if self.slot is not None:
+            if line == self.escape:
+                self.slot = None
+                return None
+            return self.modules[self.slot].handle(line)
+
+        mnemonic, _, args = line.partition(' ')
+        mnemonic = mnemonic.upper()
+        if mnemonic == 'CONN':
+            slot, _, escape = args.partition(',')
+            if int(slot) in self.modules:
+                self.slot = int(slot)
+                self.escape = escape.strip().strip('"')
+            return None
+        if mnemonic == '*IDN?':
+            return self.idn
+        if mnemonic == '*OPC?':
+            return '1'
+        return None
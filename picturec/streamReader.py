@@ -0,0 +1,114 @@
+"""
+Bulk reader for historical ranges of the Redis time series streams into NumPy arrays, for cooldown analysis and the
+like. The range is fetched in XRANGE pages of pageSize entries and parsed a page at a time into preallocated
+buffers. For packed entries (see packedEncoding) a whole page of float32 blobs is joined and converted with a single
+np.frombuffer call. Plain string entries are still supported, but each one is parsed on its own.
+"""
+
+import numpy as np
+
+import packedEncoding
+
+_SCHEMA_KEY = packedEncoding.SCHEMA_FIELD.encode('ascii')
+_VALUES_KEY = packedEncoding.VALUES_FIELD.encode('ascii')
+
+
+def _entry_ms(entryId):
+    return int(entryId[:entryId.index(b'-')])
+
+
+class _Buffers(object):
+    def __init__(self, nChannels, capacity):
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.values = np.full((capacity, nChannels), np.nan, dtype=np.float64)
+        self.n = 0
+
+    def reserve(self, extra):
+        capacity = len(self.times)
+        if self.n + extra <= capacity:
+            return
+        while capacity < self.n + extra:
+            capacity *= 2
+        times = np.empty(capacity, dtype=np.float64)
+        values = np.full((capacity, self.values.shape[1]), np.nan, dtype=np.float64)
+        times[:self.n] = self.times[:self.n]
+        values[:self.n] = self.values[:self.n]
+        self.times, self.values = times, values
+
+
+def _fill_page(buffers, page, channels):
+    """
+    Parse one XRANGE page into the buffers, converting runs of packed entries that share a schema in bulk.
+    """
+    n0 = buffers.n
+    buffers.reserve(len(page))
+    buffers.times[n0:n0 + len(page)] = [_entry_ms(entryId) for entryId, _ in page]
+
+    i = 0
+    while i < len(page):
+        packed = page[i][1].get(_SCHEMA_KEY)
+        if packed is None:
+            decoded = packedEncoding.decode(page[i][1])
+            row = buffers.values[n0 + i]
+            for col, channel in enumerate(channels):
+                value = decoded.get(channel)
+                if value is not None:
+                    row[col] = value
+            i += 1
+            continue
+
+        # Gather the run of consecutive entries packed with the same schema
+        j = i + 1
+        while j < len(page) and page[j][1].get(_SCHEMA_KEY) == packed:
+            j += 1
+        schema = packedEncoding.SCHEMAS[int(packed)]
+        blob = b''.join(fields[_VALUES_KEY] for _, fields in page[i:j])
+        block = np.frombuffer(blob, dtype='<f4').reshape(j - i, len(schema))
+        for col, channel in enumerate(channels):
+            src = schema.index.get(channel)
+            if src is not None:
+                buffers.values[n0 + i:n0 + j, col] = block[:, src]
+        i = j
+
+    buffers.n += len(page)
+
+
+def read_range(redis, key, channels, start=None, end=None, pageSize=10000, columns=False):
+    """
+    Read a time range of one stream into NumPy arrays.
+    :param redis: redis.Redis (or walrus.Walrus) client
+    :param key: Stream key, e.g. 'hemt_biases'
+    :param channels: Channel names to return, e.g. ['1', '2', '3']. A channel missing from an entry reads as NaN
+    :param start: Unix time of the start of the range (inclusive). None for the start of the stream
+    :param end: Unix time of the end of the range (inclusive). None for the end of the stream
+    :param pageSize: Entries per XRANGE call
+    :param columns: If True return a dict of 1-D arrays instead of a structured array
+    :return: Structured array with a 'time' field (unix seconds) and one float64 field per channel, or a dict of
+    'time' and channel name: array if columns is True
+    """
+    channels = [str(c) for c in channels]
+    buffers = _Buffers(len(channels), pageSize)
+    lo = '-' if start is None else int(start * 1000)
+    hi = '+' if end is None else int(end * 1000)
+
+    while True:
+        page = redis.xrange(key, min=lo, max=hi, count=pageSize)
+        if page:
+            _fill_page(buffers, page, channels)
+        if len(page) < pageSize:
+            break
+        lo = b'(' + page[-1][0]
+
+    n = buffers.n
+    times = buffers.times[:n] / 1000
+    if columns:
+        result = {'time': times}
+        for col, channel in enumerate(channels):
+            result[channel] = buffers.values[:n, col]
+        return result
+
+    out = np.empty(n, dtype=[('time', np.float64)] + [(channel, np.float64) for channel in channels])
+    out['time'] = times
+    for col, channel in enumerate(channels):
+        out[channel] = buffers.values[:n, col]
+    return out
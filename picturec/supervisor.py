@@ -0,0 +1,298 @@
+"""
+Runs all of the PICTURE-C instrument polling in one process on a single asyncio event loop. Each instrument gets its
+own task with its own polling period. The blocking pyserial work for a poll is pushed to a worker thread, so a slow
+device never holds up the others. All tasks share one Redis connection and one write-behind buffer, so readings from
+every instrument go out together in pipelined batches. The writer feeds a RollupEngine, and a StreamCompactor keeps
+the streams within their retention policies.
+
+If a task's serial link fails, the supervisor logs the error, closes the device, waits and then reconnects. The other
+tasks keep running while this happens. Tasks for USB instruments wait on the DeviceRegistry. If hot-plug monitoring is
+available, a cable that is pulled and plugged back in is reconnected as soon as the port reappears, rather than after
+the full retry delay. The SIM921 and SIM960 tasks share one SIM900 and talk to their slots through it, so their polls
+take turns on the mainframe's cable.
+
+The magnet ramp and heat switch scripts in original_scripts/controls are interactive one-shot procedures rather than
+pollers, so they are not hosted here. The SIM900 port is opened exclusively, so the supervisor has to be stopped
+while controls/ramp.py drives the magnet through the same mainframe. If a ramp already holds the port, the SIM921 and
+SIM960 tasks keep failing to connect and retrying until it is released.
+
+TODO: Read the task table (ports, periods) from a config file rather than the defaults in __main__
+"""
+
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import time
+
+import serial
+import walrus
+import metrics
+import packedEncoding
+from redisWriter import BufferedStreamWriter
+from retention import RetentionPolicy, StreamCompactor
+from rollups import RollupEngine, rollup_retention
+
+REDIS_DB = 0
+INSTRUMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'original_scripts', 'instruments')
+STREAM_KEYS = ['sim921.temperature', 'sim960.output', 'ls240.temperatures']
+RETENTION = {key: RetentionPolicy(maxlen=1000000, window=3 * 24 * 3600, rollupInterval=None) for key in STREAM_KEYS}
+RETENTION.update(rollup_retention(STREAM_KEYS))
+PACKED_SCHEMAS = {'sim921.temperature': packedEncoding.SIM921_TEMPERATURE,
+                  'sim960.output': packedEncoding.SIM960_OUTPUT,
+                  'ls240.temperatures': packedEncoding.LS240_TEMPERATURES}
+
+METRICS_PORT = 9108
+# USB serial numbers of the instruments' adapters. The SIM900 sits behind a generic FTDI 0403:6001, so without its
+# serial number any other FTDI cable on the host can be taken for it. None accepts the first matching port
+SERIAL_NUMBERS = {'SIM900': None, 'LS240': None}
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class PollingTask(object):
+    def __init__(self, name, connect, poll, period, publish=None, disconnect=None, retryDelay=5, waitForDevice=None):
+        """
+        Description of one instrument for the supervisor. All of the callables are blocking and are run in a worker
+        thread.
+        :param name: Name used in log messages
+        :param connect: connect(redis, writer) -> device. Opens and initializes the instrument. Should raise (e.g.
+        serial.SerialException) if the instrument cannot be reached
+        :param poll: poll(device) -> reading. Performs one readout. Returning None means nothing to publish
+        :param period: Seconds between the starts of successive polls
+        :param publish: publish(writer, reading). Queues a reading on the shared BufferedStreamWriter. Not needed if
+        poll() publishes itself
+        :param disconnect: disconnect(device). Called when the task stops or its link fails
+        :param retryDelay: Seconds to wait before reconnecting after a failure
+        :param waitForDevice: waitForDevice(since, timeout). Blocks until the instrument's port has been plugged in
+        again after time.monotonic() value `since`, or for at most timeout seconds. Used instead of sleeping out
+        retryDelay
+        """
+        self.name = name
+        self.connect = connect
+        self.poll = poll
+        self.period = period
+        self.publish = publish
+        self.disconnect = disconnect
+        self.retryDelay = retryDelay
+        self.waitForDevice = waitForDevice
+        labels = {'task': name}
+        self.pollSeconds = metrics.REGISTRY.histogram('poll_seconds', "Time for one poll, including publishing", labels)
+        self.failures = metrics.REGISTRY.counter('task_failures_total', "Times the task lost its instrument", labels)
+
+
+class Supervisor(object):
+    def __init__(self, host='localhost', port=6379, db=REDIS_DB, retention=None, rollupKeys=(), schemas=None):
+        """
+        :param retention: Dict of stream key: RetentionPolicy covering the streams written by the tasks
+        :param rollupKeys: Raw stream keys to keep multi-resolution rollups of
+        :param schemas: Dict of stream key: packedEncoding.Schema for streams to store packed
+        """
+        self.redis = walrus.Walrus(host=host, port=port, db=db)
+        self.writer = BufferedStreamWriter(self.redis, retention=retention, schemas=schemas)
+        self.writer.rollups = RollupEngine(self.writer, rollupKeys)
+        self.compactor = StreamCompactor(self.redis, retention or {})
+        self.tasks = []
+
+    def add(self, task):
+        """
+        Register a PollingTask. Tasks must be added before run() is started.
+        :return: None
+        """
+        self.tasks.append(task)
+
+    async def _supervise(self, task):
+        """
+        Connect, poll on schedule and reconnect on failure, forever.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            device = None
+            attemptStart = time.monotonic()
+            try:
+                log.info(f"Connecting to {task.name}")
+                device = await asyncio.to_thread(task.connect, self.redis, self.writer)
+                log.info(f"{task.name} connected, polling every {task.period} s")
+
+                nextPoll = loop.time()
+                while True:
+                    pollStart = time.perf_counter()
+                    reading = await asyncio.to_thread(task.poll, device)
+                    if reading is not None and task.publish is not None:
+                        await asyncio.to_thread(task.publish, self.writer, reading)
+                    task.pollSeconds.observe(time.perf_counter() - pollStart)
+                    nextPoll = max(nextPoll + task.period, loop.time())
+                    await asyncio.sleep(nextPoll - loop.time())
+            except asyncio.CancelledError:
+                raise
+            except (serial.SerialException, OSError) as e:
+                task.failures.inc()
+                log.error(f"{task.name} serial link failed: {e}")
+            except Exception:
+                task.failures.inc()
+                log.exception(f"{task.name} task failed")
+            finally:
+                if device is not None and task.disconnect is not None:
+                    try:
+                        task.disconnect(device)
+                    except Exception as e:
+                        log.debug(f"Error while disconnecting {task.name}: {e}")
+
+            if task.waitForDevice is not None:
+                log.info(f"Restarting {task.name} when its port reappears, or in {task.retryDelay} s")
+                await asyncio.to_thread(task.waitForDevice, attemptStart, task.retryDelay)
+            else:
+                log.info(f"Restarting {task.name} in {task.retryDelay} s")
+                await asyncio.sleep(task.retryDelay)
+
+    async def run(self):
+        """
+        Run every registered task until cancelled.
+        :return: None
+        """
+        self.writer.start()
+        self.compactor.start()
+        try:
+            await asyncio.gather(*(self._supervise(task) for task in self.tasks))
+        finally:
+            self.compactor.stop()
+            self.writer.stop()
+
+
+def _require_connected(instrument):
+    if not instrument.isConnected:
+        raise serial.SerialException(f"{instrument.instrument} is not connected")
+    return instrument
+
+
+def _device_waiter(instrument, serialNumber=None):
+    """
+    waitForDevice for the instrument class of the same name in original_scripts/instruments.
+    """
+    def wait(since, timeout):
+        from deviceRegistry import get_registry
+        validIds = getattr(importlib.import_module(instrument), instrument).VALID_IDS
+        return get_registry().wait_for_device(validIds, serialNumber, since=since, timeout=timeout)
+
+    return wait
+
+
+def hemttemp_task(port="/dev/ttyS9", period=1, binary=False):
+    from hemttempAgent import Hemtduino
+
+    def connect(redis, writer):
+        hemtduino = Hemtduino(port=port, baudrate=9600, timeout=1, redis=redis, writer=writer, binary=binary)
+        hemtduino.arduino_ping()
+        return hemtduino
+
+    return PollingTask("hemttemp", connect, lambda h: h.poll(), period, disconnect=lambda h: h.close())
+
+
+def _open_mainframe(mainframe):
+    """
+    Make sure the shared SIM900 port is open and answering. If a failure in another task (or an unplugged cable) left
+    it dead, it is closed and opened again, so whichever module task reconnects first brings the mainframe back.
+    """
+    with mainframe._lock:
+        if mainframe.isConnected:
+            try:
+                if mainframe.query("*IDN?"):
+                    return
+            except (serial.SerialException, OSError) as e:
+                log.debug(f"SIM900 link is down, reopening: {e}")
+            mainframe.disconnect()
+        mainframe.connect()
+        _require_connected(mainframe)
+
+
+def _mainframe_waiter(mainframe):
+    """
+    waitForDevice for a module in the SIM900, which waits on the mainframe's own adapter.
+    """
+    def wait(since, timeout):
+        from deviceRegistry import get_registry
+        return get_registry().wait_for_device(mainframe.VALID_IDS, mainframe.serialNumber, since=since, timeout=timeout)
+
+    return wait
+
+
+def sim921_task(mainframe, slot=1, period=1):
+    """
+    :param mainframe: SIM900 the SIM921 is installed in. Shared with the SIM960 task, so both go through its lock
+    :param slot: Mainframe slot of the SIM921
+    """
+    def connect(redis, writer):
+        from SIM921 import SIM921
+        _open_mainframe(mainframe)
+        sim921 = SIM921(link=mainframe.submodule(slot))
+        sim921.connect()
+        return _require_connected(sim921)
+
+    def publish(writer, temperature):
+        writer.add('sim921.temperature', {'temperature': temperature})
+
+    return PollingTask("SIM921", connect, lambda s: float(s.query("TVAL?")), period, publish=publish,
+                       disconnect=lambda s: s.disconnect(), waitForDevice=_mainframe_waiter(mainframe))
+
+
+def sim960_task(mainframe, slot=5, period=1):
+    """
+    :param mainframe: SIM900 the SIM960 is installed in. Shared with the SIM921 task, so both go through its lock
+    :param slot: Mainframe slot of the SIM960
+    """
+    def connect(redis, writer):
+        from SIM960 import SIM960
+        _open_mainframe(mainframe)
+        sim960 = SIM960(link=mainframe.submodule(slot))
+        # Only OMON? is read here. initialize() would send *RST and MOUT 0 on every (re)connect, dropping the magnet
+        # current if the link hiccups mid-cycle, so the controller is left configured as it is
+        sim960.connect(initialize=False)
+        return _require_connected(sim960)
+
+    def publish(writer, output):
+        writer.add('sim960.output', {'omon': output})
+
+    return PollingTask("SIM960", connect, lambda s: float(s.query("OMON?")), period, publish=publish,
+                       disconnect=lambda s: s.disconnect(), waitForDevice=_mainframe_waiter(mainframe))
+
+
+def ls240_task(period=5, serialNumber=None):
+    def connect(redis, writer):
+        from LS240 import LS240
+        ls240 = LS240(serialNumber=serialNumber)
+        ls240.connect()
+        return _require_connected(ls240)
+
+    def poll(ls240):
+        reading = ls240.read_temperatures()
+        return {name: float(reading[name]) for name in reading.dtype.names[1:]}, float(reading['time'])
+
+    def publish(writer, reading):
+        temperatures, timestamp = reading
+        writer.add('ls240.temperatures', temperatures, timestamp=timestamp)
+
+    return PollingTask("LS240", connect, poll, period, publish=publish, disconnect=lambda l: l.disconnect(),
+                       waitForDevice=_device_waiter("LS240", serialNumber))
+
+
+if __name__ == "__main__":
+    sys.path.append(INSTRUMENTS_DIR)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s %(levelname)s - %(message)s')
+
+    import hemttempAgent
+    from SIM900 import SIM900
+    supervisor = Supervisor(retention=dict(RETENTION, **hemttempAgent.RETENTION),
+                            rollupKeys=STREAM_KEYS + list(hemttempAgent.STREAM_KEYS.values()),
+                            schemas=dict(PACKED_SCHEMAS, **hemttempAgent.PACKED_SCHEMAS))
+    supervisor.add(hemttemp_task())
+    # The SIM921 and SIM960 share the mainframe's one cable, so they are polled through a single SIM900
+    mainframe = SIM900(serialNumber=SERIAL_NUMBERS['SIM900'])
+    supervisor.add(sim921_task(mainframe, slot=1))
+    supervisor.add(sim960_task(mainframe, slot=5))
+    supervisor.add(ls240_task(serialNumber=SERIAL_NUMBERS['LS240']))
+    metrics.serve(METRICS_PORT)
+    metrics.RedisPublisher(supervisor.redis, 'metrics:supervisor').start()
+    asyncio.run(supervisor.run())